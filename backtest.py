@@ -0,0 +1,174 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Callable, List, NamedTuple, Optional
+import unittest
+import numpy as np
+import pandas as pd
+
+from estimators import RollingMoments
+from step3 import build_portfolio, optimize_portfolio, set_assets_stats
+
+
+class BacktestResult(NamedTuple):
+    returns: pd.Series
+    weights: pd.DataFrame
+    turnover: pd.Series
+    costs: pd.Series
+
+
+def riskfolio_optimizer(returns: pd.DataFrame, mu: np.ndarray, cov: np.ndarray, model: str = 'Classic',
+                        rm: str = 'MV', obj: str = 'Sharpe', rf: float = 0, l: float = 0) -> Optional[np.ndarray]:
+    """
+    Optimize one rebalance window with riskfolio, using precomputed mean and covariance.
+    """
+    portfolio = build_portfolio(returns)
+    set_assets_stats(portfolio, mu, cov)
+    weights = optimize_portfolio(portfolio, model=model, rm=rm, obj=obj, rf=rf, l=l, hist=True)
+    if weights is None:
+        return None
+    return weights['weights'].to_numpy()
+
+
+def equal_weight_optimizer(returns: pd.DataFrame, mu: np.ndarray, cov: np.ndarray) -> np.ndarray:
+    """
+    Baseline allocation ignoring the estimates.
+    """
+    return np.full(len(mu), 1 / len(mu))
+
+
+def walk_forward(returns: pd.DataFrame, window: int = 252, rebalance_every: int = 21, cost: float = 0.001,
+                 optimizer: Callable = riskfolio_optimizer, workers: int = 1) -> BacktestResult:
+    """
+    Walk-forward backtest re-estimating and re-optimizing the portfolio at every rebalance date.
+
+    The mean and covariance of the trailing window are rolled forward incrementally between rebalance
+    dates. The optimizations of the windows are independent and are spread over worker processes.
+    Between rebalances the weights drift with the asset returns.
+
+    Args:
+        returns (pd.DataFrame): Simple returns, dates x assets, without missing values.
+        window (int): Number of observations used for the estimates.
+        rebalance_every (int): Number of observations between rebalance dates.
+        cost (float): Proportional transaction cost charged on turnover.
+        optimizer (callable): optimizer(window_returns, mu, cov) returning the target weights, or None to keep
+                              the current ones. Must be picklable when workers > 1.
+        workers (int): Number of processes optimizing windows in parallel.
+
+    Returns:
+        BacktestResult: Daily net portfolio returns, target weights, turnover and costs per rebalance date.
+    """
+    values = returns.to_numpy(dtype=float)
+    n_obs, n_assets = values.shape
+    starts = list(range(window, n_obs, rebalance_every))
+    if not starts:
+        raise ValueError("not enough observations for a window of " + str(window))
+
+    moments = RollingMoments(n_assets)
+    moments.add(values[:window])
+    previous = window
+    estimates = []
+    for start in starts:
+        moments.add(values[previous:start])
+        moments.remove(values[previous - window:start - window])
+        previous = start
+        estimates.append((returns.iloc[start - window:start], moments.mean, moments.cov()))
+
+    windows, mus, covs = zip(*estimates)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            targets: List = list(executor.map(optimizer, windows, mus, covs))
+    else:
+        targets = list(map(optimizer, windows, mus, covs))
+
+    held = np.zeros(n_assets)
+    daily, weights, turnover = [], [], []
+    current = held
+    for start, end, target in zip(starts, starts[1:] + [n_obs], targets):
+        if target is not None:
+            current = np.asarray(target, dtype=float)
+        weights.append(current)
+        turnover.append(np.abs(current - held).sum())
+
+        # Value of the portfolio through the holding period, any unallocated weight staying in cash
+        growth = np.cumprod(1 + values[start:end], axis=0)
+        value = growth @ current + (1 - current.sum())
+        period = value / np.concatenate([[1.0], value[:-1]]) - 1
+        period[0] -= cost * turnover[-1]
+        daily.append(period)
+        held = current * growth[-1] / value[-1]
+
+    dates = returns.index[starts]
+    turnover = pd.Series(turnover, index=dates, name='turnover')
+    return BacktestResult(returns=pd.Series(np.concatenate(daily), index=returns.index[window:], name='returns'),
+                          weights=pd.DataFrame(weights, index=dates, columns=returns.columns),
+                          turnover=turnover,
+                          costs=(cost * turnover).rename('costs'))
+
+
+def summary(result: BacktestResult, periods_per_year: int = 252) -> pd.Series:
+    """
+    Annualised performance, total turnover and total costs of a backtest.
+    """
+    returns = result.returns
+    annual_return = (1 + returns).prod() ** (periods_per_year / len(returns)) - 1
+    annual_volatility = returns.std() * np.sqrt(periods_per_year)
+    return pd.Series({'annual_return': annual_return,
+                      'annual_volatility': annual_volatility,
+                      'sharpe': returns.mean() / returns.std() * np.sqrt(periods_per_year),
+                      'max_drawdown': ((1 + returns).cumprod() / (1 + returns).cumprod().cummax() - 1).min(),
+                      'turnover': result.turnover.sum(),
+                      'costs': result.costs.sum()})
+
+
+# Test cases for the walk-forward backtest
+class TestWalkForward(unittest.TestCase):
+    def test_drift_and_costs(self) -> None:
+        # A gains 10% a day and B stays flat: equal weights drift towards A between rebalances
+        returns = pd.DataFrame({'A': 0.1, 'B': 0.0}, index=pd.date_range('2020-01-01', periods=8))
+        result = walk_forward(returns, window=2, rebalance_every=3, cost=0.01, optimizer=equal_weight_optimizer)
+
+        growth = 1.1 ** np.arange(1, 4)
+        value = 0.5 * growth + 0.5
+        first = np.concatenate([[value[0] - 1 - 0.01], value[1:] / value[:-1] - 1])
+        drifted = 0.5 * growth[-1] / value[-1]
+        turnover = [1.0, 2 * (drifted - 0.5)]
+        second = first + [0.01, 0, 0]
+        second[0] -= 0.01 * turnover[1]
+
+        np.testing.assert_allclose(result.turnover.to_numpy(), turnover)
+        np.testing.assert_allclose(result.costs.to_numpy(), 0.01 * np.array(turnover))
+        np.testing.assert_allclose(result.returns.to_numpy(), np.concatenate([first, second]))
+        self.assertEqual(list(result.weights.index), list(returns.index[[2, 5]]))
+
+        report = summary(result)
+        self.assertAlmostEqual(report['turnover'], sum(turnover))
+        self.assertAlmostEqual(report['costs'], 0.01 * sum(turnover))
+        self.assertAlmostEqual(report['annual_return'], (1 + result.returns).prod() ** (252 / 6) - 1)
+        self.assertEqual(report['max_drawdown'], 0)
+
+    def test_parallel_matches_serial(self) -> None:
+        rng = np.random.default_rng(0)
+        returns = pd.DataFrame(rng.normal(0.0005, 0.01, size=(200, 4)), columns=list('ABCD'),
+                               index=pd.date_range('2020-01-01', periods=200))
+        optimizer = partial(riskfolio_optimizer, obj='MinRisk')
+        serial = walk_forward(returns, window=100, rebalance_every=25, optimizer=optimizer)
+        parallel = walk_forward(returns, window=100, rebalance_every=25, optimizer=optimizer, workers=2)
+        pd.testing.assert_frame_equal(serial.weights, parallel.weights)
+        pd.testing.assert_series_equal(serial.returns, parallel.returns)
+        self.assertEqual(len(serial.turnover), 4)
+
+    def test_short_history(self) -> None:
+        returns = pd.DataFrame(np.zeros((10, 2)), columns=['A', 'B'])
+        self.assertRaises(ValueError, walk_forward, returns, window=10)
+
+
+if __name__ == '__main__':
+    from store import PriceStore
+
+    prices = PriceStore().read(columns=['Adj Close']).pivot(index='Date', columns='ticker', values='Adj Close')
+    returns = prices.loc['2016-01-01':].pct_change().dropna()
+    report = pd.DataFrame({
+        'mean variance': summary(walk_forward(returns, optimizer=partial(riskfolio_optimizer, obj='Sharpe'), workers=4)),
+        'equal weights': summary(walk_forward(returns, optimizer=equal_weight_optimizer)),
+    })
+    print(report)
@@ -0,0 +1,277 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+import unittest
+from typing import Callable, Dict, List, Optional, Tuple
+import numpy as np
+import pandas as pd
+
+from models.boosted_hybrid import BoostedHybrid
+from models.numpy_models import EWMAModel, HoltModel, ARModel
+
+
+def synthetic_prices(tickers: int = 20, days: int = 1500, seed: int = 0) -> pd.DataFrame:
+    """
+    Generate a daily geometric random walk price panel of shape (days, tickers).
+    """
+    rng = np.random.default_rng(seed)
+    drift = rng.normal(0.0003, 0.0002, size=tickers)
+    volatility = rng.uniform(0.01, 0.03, size=tickers)
+    log_returns = drift + volatility * rng.standard_normal((days, tickers))
+    prices = 100 * np.exp(np.cumsum(log_returns, axis=0))
+    index = pd.date_range(start='2010-01-01', periods=days, name='Date')
+    return pd.DataFrame(prices, index=index, columns=['T' + str(i) for i in range(tickers)])
+
+
+def mape(actual: np.ndarray, predicted: np.ndarray) -> float:
+    return float(np.mean(np.abs((actual - predicted) / actual)))
+
+
+def benchmark_forecasters(tickers: int = 200, days: int = 1500, horizon: int = 30,
+                          prophet_tickers: int = 5) -> pd.DataFrame:
+    """
+    Compare the runtime and hold-out accuracy of the NumPy forecasters and BoostedHybrid against ProphetModel.
+
+    The NumPy models and BoostedHybrid are fitted on the whole panel in one call; ProphetModel is fitted ticker by
+    ticker on the first prophet_tickers columns only, and its time is reported per ticker.
+    """
+    prices = synthetic_prices(tickers, days)
+    train, test = prices.iloc[:-horizon], prices.iloc[-horizon:].to_numpy()
+
+    rows: List[Dict] = []
+    for name, model in [('ewma', EWMAModel()), ('holt', HoltModel()), ('ar', ARModel()),
+                        ('hybrid', BoostedHybrid())]:
+        start = time.perf_counter()
+        model.fit(train)
+        predicted, _ = model.predict(horizon)
+        elapsed = time.perf_counter() - start
+        rows.append({'model': name, 'tickers': tickers, 'seconds': elapsed,
+                     'ms_per_ticker': 1000 * elapsed / tickers, 'mape': mape(test, predicted)})
+
+    try:
+        from models.prophet_model import ProphetModel
+    except ImportError:
+        return pd.DataFrame(rows)
+
+    start = time.perf_counter()
+    errors = []
+    for column in train.columns[:prophet_tickers]:
+        model = ProphetModel()
+        model.fit(train[[column]])
+        predicted, _ = model.predict(horizon)
+        errors.append(mape(test[:, train.columns.get_loc(column)], predicted))
+    elapsed = time.perf_counter() - start
+    rows.append({'model': 'prophet', 'tickers': prophet_tickers, 'seconds': elapsed,
+                 'ms_per_ticker': 1000 * elapsed / prophet_tickers, 'mape': float(np.mean(errors))})
+    return pd.DataFrame(rows)
+
+
+def benchmark_grid(tickers: int = 30, days: int = 1000, workers: int = 4) -> pd.DataFrame:
+    """
+    Compare optimize_grid against the naive loop building, estimating and optimizing one portfolio per configuration.
+    """
+    from grid import expand_grid, optimize_grid
+    from step3 import build_portfolio, optimize_portfolio
+
+    returns = synthetic_prices(tickers, days).pct_change().dropna()
+    grid = {'rm': ['MV', 'CVaR'], 'obj': ['MinRisk', 'Sharpe', 'Utility'], 'rf': [0, 0.0001], 'l': [1, 2]}
+    configs = expand_grid(grid)
+
+    rows = []
+    start = time.perf_counter()
+    for config in configs:
+        portfolio = build_portfolio(returns)
+        portfolio.assets_stats(method_mu='hist', method_cov='hist')
+        optimize_portfolio(portfolio, **config)
+    rows.append({'method': 'naive loop', 'configs': len(configs), 'seconds': time.perf_counter() - start})
+
+    for n in sorted({1, workers}):
+        start = time.perf_counter()
+        optimize_grid(returns, grid, workers=n)
+        rows.append({'method': 'optimize_grid, ' + str(n) + ' workers', 'configs': len(configs),
+                     'seconds': time.perf_counter() - start})
+    return pd.DataFrame(rows)
+
+
+BASELINE_PATH = './benchmark_baseline.json'
+
+
+def measure(func: Callable, repeat: int = 3, setup: Optional[Callable] = None) -> Tuple[float, float]:
+    """
+    Time func and measure its peak Python memory.
+
+    The best of repeat timed runs is reported, and the peak memory comes from one additional run
+    under tracemalloc, so tracing doesn't slow down the timed runs. setup is called before every run.
+
+    Returns:
+        Tuple[float, float]: The best time in seconds and the peak traced memory in MiB.
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return min(times), peak / 2 ** 20
+
+
+def benchmark_hot_paths(tickers: int = 50, years: int = 4, prophet_tickers: int = 2, repeat: int = 3) -> pd.DataFrame:
+    """
+    Time the data, forecast and optimization hot paths on a synthetic price panel of tickers x years.
+
+    The panel is written to a price store in a temporary working directory, so load_csv and the step2
+    aggregation read it through the default relative paths and the real data is never touched.
+
+    Returns:
+        pd.DataFrame: One row per benchmark with the panel size, the best time, the throughput in items
+                      (tickers or assets) per second and the peak Python memory.
+    """
+    prices = synthetic_prices(tickers, 252 * years)
+    assets = list(prices.columns)
+    rows: List[Dict] = []
+
+    def record(name: str, func: Callable, items: int, setup: Optional[Callable] = None, runs: int = repeat) -> None:
+        seconds, peak_mb = measure(func, runs, setup)
+        rows.append({'benchmark': name, 'tickers': tickers, 'years': years, 'seconds': seconds,
+                     'items_per_second': items / seconds, 'peak_mb': peak_mb})
+
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp()
+    try:
+        os.chdir(directory)
+        from store import PriceStore
+        from step1 import load_csv
+        from step2 import _read_panel, calculate_returns, read_data
+        from step3 import build_portfolio, efficient_frontier, estimate_assets_stats, optimize_portfolio
+        from frontier import frontier_cache
+        from models.prophet_model import ProphetModel
+
+        PriceStore().write({stock: prices[[stock]].rename(columns={stock: 'Adj Close'}) for stock in assets})
+        record('load_csv', lambda: [load_csv(stock) for stock in assets], tickers)
+        record('aggregation', lambda: calculate_returns(read_data(assets, forecasted=False)), tickers,
+               setup=_read_panel.cache_clear)
+
+        train = prices.iloc[:, :prophet_tickers]
+        def fit_predict() -> None:
+            for stock in train.columns:
+                model = ProphetModel()
+                model.fit(train[[stock]])
+                model.predict(30)
+        record('prophet_fit_predict', fit_predict, prophet_tickers, runs=1)
+
+        def hybrid_fit_predict() -> None:
+            model = BoostedHybrid()
+            model.fit(prices)
+            model.predict(30)
+        record('hybrid_fit_predict', hybrid_fit_predict, tickers, runs=1)
+
+        returns = calculate_returns(prices)
+        portfolio = build_portfolio(returns)
+        record('estimate_assets_stats', lambda: estimate_assets_stats(portfolio, 'hist', 'hist'), tickers)
+        record('optimize_portfolio', lambda: optimize_portfolio(portfolio), tickers)
+        record('efficient_frontier', lambda: efficient_frontier(portfolio, points=20), tickers, setup=frontier_cache.clear)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+    return pd.DataFrame(rows)
+
+
+def save_baseline(results: pd.DataFrame, path: str = BASELINE_PATH) -> None:
+    """
+    Store the results as the baseline of later runs, keeping the baselines of other panel sizes.
+    """
+    baseline = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            baseline = json.load(f)
+    for row in results.to_dict('records'):
+        baseline[_baseline_key(row)] = {'seconds': row['seconds'], 'peak_mb': row['peak_mb']}
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+
+
+def _baseline_key(row: Dict) -> str:
+    return row['benchmark'] + '/' + str(row['tickers']) + 'x' + str(row['years'])
+
+
+def compare_to_baseline(results: pd.DataFrame, path: str = BASELINE_PATH, tolerance: float = 0.25) -> pd.DataFrame:
+    """
+    Add the baseline time and memory of every benchmark and flag the ones more than tolerance slower or larger.
+
+    Benchmarks without a baseline for their panel size are never flagged: the baseline is machine
+    specific, so it is not committed and has to be recorded once on each machine with --save-baseline.
+    """
+    baseline = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            baseline = json.load(f)
+    results = results.copy()
+    stored = [baseline.get(_baseline_key(row), {}) for row in results.to_dict('records')]
+    results['baseline_seconds'] = [entry.get('seconds', np.nan) for entry in stored]
+    results['baseline_peak_mb'] = [entry.get('peak_mb', np.nan) for entry in stored]
+    results['regression'] = ((results['seconds'] > (1 + tolerance) * results['baseline_seconds'])
+                             | (results['peak_mb'] > (1 + tolerance) * results['baseline_peak_mb']))
+    return results
+
+
+def check_regressions(results: pd.DataFrame, path: str = BASELINE_PATH) -> None:
+    """
+    Exit with an error listing the flagged benchmarks, or warn when nothing could be compared.
+    """
+    if results['baseline_seconds'].isna().all():
+        print('no baseline for these benchmarks in ' + path + ', record one with --save-baseline')
+    if results['regression'].any():
+        raise SystemExit('regressions: ' + ', '.join(results.loc[results['regression'], 'benchmark']))
+
+
+# Test cases for the baseline comparison
+class TestBaseline(unittest.TestCase):
+    def test_regressions_are_flagged(self) -> None:
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'baseline.json')
+            results = pd.DataFrame({'benchmark': ['a', 'b'], 'tickers': 10, 'years': 1,
+                                    'seconds': [1.0, 1.0], 'peak_mb': [5.0, 5.0]})
+            save_baseline(results, path)
+            slower = results.assign(seconds=[1.1, 2.0])
+            self.assertEqual(compare_to_baseline(slower, path)['regression'].tolist(), [False, True])
+            bigger = results.assign(tickers=20, peak_mb=50.0)
+            self.assertEqual(compare_to_baseline(bigger, path)['regression'].tolist(), [False, False])
+            self.assertRaises(SystemExit, check_regressions, compare_to_baseline(slower, path), path)
+            check_regressions(compare_to_baseline(results, path), path)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline benchmarks on synthetic price panels.')
+    parser.add_argument('--tickers', type=int, default=50)
+    parser.add_argument('--years', type=int, default=4)
+    parser.add_argument('--prophet-tickers', type=int, default=2)
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--all', action='store_true', help='also run the forecaster and grid comparisons')
+    args = parser.parse_args()
+
+    results = compare_to_baseline(benchmark_hot_paths(args.tickers, args.years, args.prophet_tickers))
+    # step2 sets a percent display format, which doesn't suit times and sizes
+    print(results.to_string(index=False, float_format='{:.4g}'.format))
+    if args.save_baseline:
+        save_baseline(results)
+    if args.all:
+        print(benchmark_forecasters().to_string(index=False))
+        print(benchmark_grid().to_string(index=False))
+    check_regressions(results)
@@ -0,0 +1,189 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+import unittest
+from typing import List, Optional
+
+from constants import DEFAULT_START_DATE, company_dict
+
+# Backends that must not be imported until a subcommand actually uses them
+HEAVY_MODULES = ('prophet', 'cmdstanpy', 'riskfolio', 'cvxpy', 'yfinance', 'matplotlib', 'sklearn')
+
+
+def _tickers(args: argparse.Namespace) -> List[str]:
+    return args.tickers or sorted(company_dict.keys())
+
+
+def ingest(args: argparse.Namespace) -> None:
+    from step0 import ingest as ingest_prices
+    updated = ingest_prices(_tickers(args), args.start, args.end)
+    print('appended ' + str(sum(updated.values())) + ' rows for ' + str(len(updated)) + ' tickers')
+
+
+def train(args: argparse.Namespace) -> None:
+    from step1 import plot_forecast, train_universe
+    from plotting import RenderPool
+    with RenderPool() as render_pool:
+        for stock, forecasted, error in train_universe(_tickers(args), horizon=args.horizon, workers=args.workers):
+            if error is not None:
+                print('Failed for ' + str(stock) + ': ' + error)
+            elif args.plot:
+                render_pool.submit(plot_forecast, stock, forecasted)
+
+
+def panel(args: argparse.Namespace) -> None:
+    from step2 import read_data
+    data = read_data(_tickers(args), start=args.start, end=args.end, forecasted=args.forecasted, missing=args.missing)
+    if args.output:
+        data.to_csv(args.output)
+    else:
+        print(data.tail().to_string(float_format='{:.2f}'.format))
+
+
+def optimize(args: argparse.Namespace) -> None:
+    from step3 import build_portfolio, estimate_assets_stats, optimize_portfolio, read_returns
+    portfolio = build_portfolio(read_returns(_tickers(args), start=args.start, end=args.end, forecasted=args.forecasted))
+    estimate_assets_stats(portfolio, method_mu=args.method_mu, method_cov=args.method_cov)
+    weights = optimize_portfolio(portfolio, model=args.model, rm=args.rm, obj=args.obj, rf=args.rf, l=args.l,
+                                 linkage=args.linkage, k=args.k)
+    print(weights.to_string(float_format='{:.2%}'.format))
+
+
+def pipeline(args: argparse.Namespace) -> None:
+    from pipeline import build_pipeline
+    results, timings = build_pipeline(args.tickers, horizon=args.horizon, workers=args.workers).run(force=args.force)
+    print(timings.to_string(index=False, float_format='{:.3f}'.format))
+    print(results['rebalance'].to_string(float_format='{:.2%}'.format))
+
+
+def backtest(args: argparse.Namespace) -> None:
+    from functools import partial
+    from backtest import riskfolio_optimizer, summary, walk_forward
+    from step3 import read_returns
+    returns = read_returns(_tickers(args), start=args.start, end=args.end)
+    result = walk_forward(returns, window=args.window, rebalance_every=args.rebalance_every,
+                          optimizer=partial(riskfolio_optimizer, obj=args.obj), workers=args.workers)
+    print(summary(result).to_string(float_format='{:.4f}'.format))
+
+
+def serve(args: argparse.Namespace) -> None:
+    import asyncio
+    from service import FileTailSource, RebalanceService
+    assets = _tickers(args)
+    service = RebalanceService(assets, window=args.window, estimator=args.estimator, obj=args.obj,
+                               threshold=args.threshold)
+
+    async def sink(rebalance) -> None:
+        print(str(rebalance.date) + ' drift ' + format(rebalance.drift, '.2%') + ' ' +
+              rebalance.weights.to_json(double_precision=4) + ' ' + str(service.metrics()))
+    asyncio.run(service.run(FileTailSource(args.source, assets, poll=args.poll), sink))
+
+
+def bench(args: argparse.Namespace) -> None:
+    from benchmarks import benchmark_hot_paths, check_regressions, compare_to_baseline, save_baseline
+    results = compare_to_baseline(benchmark_hot_paths(args.bench_tickers, args.years))
+    print(results.to_string(index=False, float_format='{:.4g}'.format))
+    if args.save_baseline:
+        save_baseline(results)
+    check_regressions(results)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='cli.py', description='Portfolio optimization pipeline.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    def command(name: str, func, help: str, tickers: bool = True) -> argparse.ArgumentParser:
+        subparser = subparsers.add_parser(name, help=help)
+        if tickers:
+            subparser.add_argument('--tickers', nargs='+', help='default: every ticker of constants.company_dict')
+        subparser.set_defaults(func=func)
+        return subparser
+
+    sub = command('ingest', ingest, 'update the price store')
+    sub.add_argument('--start', default=DEFAULT_START_DATE)
+    sub.add_argument('--end', help='default: today')
+
+    sub = command('train', train, 'fit and forecast every ticker in parallel')
+    sub.add_argument('--horizon', type=int, default=180)
+    sub.add_argument('--workers', type=int)
+    sub.add_argument('--plot', action='store_true', help='render the forecast figures')
+
+    for name, func, help in [('panel', panel, 'print or export the aligned price panel'),
+                             ('optimize', optimize, 'optimize the portfolio')]:
+        sub = command(name, func, help)
+        sub.add_argument('--start')
+        sub.add_argument('--end')
+        sub.add_argument('--forecasted', action='store_true')
+        if name == 'panel':
+            sub.add_argument('--missing', default='ffill', choices=['ffill', 'drop', 'keep'])
+            sub.add_argument('--output', help='CSV file to write the panel to')
+        else:
+            sub.add_argument('--method-mu', default='hist')
+            sub.add_argument('--method-cov', default='hist')
+            sub.add_argument('--model', default='Classic', help="riskfolio model, or 'HRP' / 'HERC'")
+            sub.add_argument('--linkage', default='single', help="linkage of the 'HRP' and 'HERC' clustering")
+            sub.add_argument('--k', type=int, help="number of 'HERC' clusters")
+            sub.add_argument('--rm', default='MV')
+            sub.add_argument('--obj', default='Sharpe')
+            sub.add_argument('--rf', type=float, default=0)
+            sub.add_argument('--l', type=float, default=0)
+
+    sub = command('pipeline', pipeline, 'run the cached ingest to rebalance pipeline')
+    sub.add_argument('--horizon', type=int, default=180)
+    sub.add_argument('--workers', type=int, default=4)
+    sub.add_argument('--force', nargs='*', default=[], help='stages to recompute')
+
+    sub = command('backtest', backtest, 'walk-forward backtest of the rebalancing')
+    sub.add_argument('--start')
+    sub.add_argument('--end')
+    sub.add_argument('--window', type=int, default=252)
+    sub.add_argument('--rebalance-every', type=int, default=21)
+    sub.add_argument('--obj', default='Sharpe')
+    sub.add_argument('--workers', type=int, default=1)
+
+    sub = command('serve', serve, 'rebalance live from price bars appended to a CSV file')
+    sub.add_argument('source', help="CSV file with a 'Date,<ticker>,...' header, one bar per line")
+    sub.add_argument('--window', type=int, default=252)
+    sub.add_argument('--estimator', default='hist', choices=['hist', 'ewma'])
+    sub.add_argument('--obj', default='Sharpe')
+    sub.add_argument('--threshold', type=float, default=0.05)
+    sub.add_argument('--poll', type=float, default=1.0)
+
+    sub = command('bench', bench, 'run the hot path benchmarks', tickers=False)
+    sub.add_argument('--bench-tickers', type=int, default=50, help='number of synthetic tickers')
+    sub.add_argument('--years', type=int, default=4)
+    sub.add_argument('--save-baseline', action='store_true', help='store the results as the baseline of this machine')
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = build_parser().parse_args(argv)
+    args.func(args)
+
+
+# Startup regression tests: importing the entry points must not load the heavy backends
+STARTUP_BUDGET = 2.0
+
+
+class TestStartup(unittest.TestCase):
+    def run_python(self, code: str) -> str:
+        directory = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.run([sys.executable, '-c', code], cwd=directory, check=True,
+                              capture_output=True, text=True).stdout
+
+    def test_no_heavy_imports(self) -> None:
+        code = ('import cli, step1, step2, step3\n'
+                'from lazy import is_loaded\n'
+                'print(",".join(name for name in ' + repr(HEAVY_MODULES) + ' if is_loaded(name)))')
+        self.assertEqual(self.run_python(code).strip(), '')
+
+    def test_startup_time(self) -> None:
+        start = time.perf_counter()
+        self.run_python('import cli, step2, step3; cli.build_parser().format_help()')
+        self.assertLess(time.perf_counter() - start, STARTUP_BUDGET)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,10 @@
 DEFAULT_START_DATE = "2008-01-01"
 DEFAULT_END_DATE = "2023-03-20"
 DATA_PATH = './data/original/'
+PRICE_STORE_PATH = './data/original/prices.parquet'
 FORECAST_PATH = './data/forecasted/'
+MODEL_PATH = './data/models/'
+PIPELINE_PATH = './data/pipeline/'
 FIGURE_PATH = './figures'
 
 company_dict = {
@@ -0,0 +1,270 @@
+import unittest
+import numpy as np
+import pandas as pd
+
+
+class RollingMoments:
+    """
+    Sample mean and covariance of a window of return observations, updated in O(N^2) per observation.
+
+    Observations can be added to and removed from the window, so a rolling window moves forward
+    without recomputing the statistics from the full returns matrix. Matches riskfolio's 'hist' estimates.
+    """
+    def __init__(self, n_assets: int):
+        self.count = 0
+        self.total = np.zeros(n_assets)
+        self.outer = np.zeros((n_assets, n_assets))
+
+    def add(self, x: np.ndarray) -> None:
+        """
+        Add one observation, or a (observations x assets) block of them, to the window.
+        """
+        x = np.atleast_2d(np.asarray(x, dtype=float))
+        self.count += len(x)
+        self.total += x.sum(axis=0)
+        self.outer += x.T @ x
+
+    def remove(self, x: np.ndarray) -> None:
+        """
+        Remove observations previously added to the window.
+        """
+        x = np.atleast_2d(np.asarray(x, dtype=float))
+        self.count -= len(x)
+        self.total -= x.sum(axis=0)
+        self.outer -= x.T @ x
+
+    @property
+    def mean(self) -> np.ndarray:
+        return self.total / self.count
+
+    def cov(self, ddof: int = 1) -> np.ndarray:
+        mean = self.mean
+        return (self.outer - self.count * np.outer(mean, mean)) / (self.count - ddof)
+
+
+class EWMAMoments:
+    """
+    Exponentially weighted mean and covariance, updated in O(N^2) per observation.
+
+    The newest observation has weight 1 and every older one is discounted by d per step, as in
+    pandas' ewm(alpha=1 - d, adjust=True) used by riskfolio's 'ewma1' estimates, including the
+    bias correction of the covariance. The oldest observations can be removed to keep a fixed window.
+    """
+    def __init__(self, n_assets: int, d: float = 0.94):
+        self.d = d
+        self.count = 0
+        self.weight = 0.0
+        self.squared_weight = 0.0
+        self.total = np.zeros(n_assets)
+        self.outer = np.zeros((n_assets, n_assets))
+
+    def add(self, x: np.ndarray) -> None:
+        """
+        Add one observation, or a block of them in chronological order.
+        """
+        x = np.atleast_2d(np.asarray(x, dtype=float))
+        n = len(x)
+        weights = self.d ** np.arange(n - 1, -1, -1)
+        decay = self.d ** n
+        self.count += n
+        self.weight = decay * self.weight + weights.sum()
+        self.squared_weight = decay ** 2 * self.squared_weight + (weights ** 2).sum()
+        self.total = decay * self.total + weights @ x
+        self.outer = decay * self.outer + (x * weights[:, None]).T @ x
+
+    def remove(self, x: np.ndarray) -> None:
+        """
+        Remove the oldest observations of the window, given in chronological order.
+        """
+        x = np.atleast_2d(np.asarray(x, dtype=float))
+        weights = self.d ** np.arange(self.count - 1, self.count - 1 - len(x), -1)
+        self.count -= len(x)
+        self.weight -= weights.sum()
+        self.squared_weight -= (weights ** 2).sum()
+        self.total -= weights @ x
+        self.outer -= (x * weights[:, None]).T @ x
+
+    @property
+    def mean(self) -> np.ndarray:
+        return self.total / self.weight
+
+    def cov(self) -> np.ndarray:
+        mean = self.mean
+        biased = self.outer / self.weight - np.outer(mean, mean)
+        return biased * self.weight ** 2 / (self.weight ** 2 - self.squared_weight)
+
+
+class FactorCovariance:
+    """
+    Covariance stored in factored form B B' + diag(d), with loadings B of shape (assets, k) and specific variances d.
+
+    Memory and the cost of products and of mean-variance problems grow with N * k instead of N^2.
+    """
+    def __init__(self, loadings: np.ndarray, specific: np.ndarray, assets: list):
+        self.loadings = loadings
+        self.specific = specific
+        self.assets = list(assets)
+
+    @property
+    def rank(self) -> int:
+        return self.loadings.shape[1]
+
+    def variance(self, weights: np.ndarray) -> float:
+        exposure = self.loadings.T @ weights
+        return float(exposure @ exposure + (self.specific * weights ** 2).sum())
+
+    def dot(self, x: np.ndarray) -> np.ndarray:
+        """
+        Multiply the covariance by a vector or a matrix without forming it.
+        """
+        return self.loadings @ (self.loadings.T @ x) + (self.specific * x.T).T
+
+    def dense(self) -> np.ndarray:
+        return self.loadings @ self.loadings.T + np.diag(self.specific)
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.dense(), index=self.assets, columns=self.assets)
+
+
+def ledoit_wolf(returns: pd.DataFrame, factors: int = 10) -> FactorCovariance:
+    """
+    Ledoit-Wolf shrinkage of the covariance towards a scaled identity, as sklearn.covariance.ledoit_wolf.
+
+    The shrunk matrix (1 - delta) X'X / T + delta * m * I is approximated by its top factors eigenpairs,
+    taken from a thin SVD of the returns so that no N x N product is formed, plus a diagonal holding the
+    exact variances. Memory and the cost of mean-variance problems grow with N * factors; the off-diagonal
+    covariances left out are those of the smallest eigenvalues of the sample covariance, and the matrix
+    is exact when factors >= min(N, T).
+    """
+    x = returns.to_numpy(dtype=float)
+    x = x - x.mean(axis=0)
+    n_obs, n_assets = x.shape
+    squared = x ** 2
+    variances = squared.sum(axis=0) / n_obs
+    scale = variances.sum() / n_assets
+
+    # ||X'X||^2 is the sum of the fourth powers of the singular values of X
+    _, singular_values, components = np.linalg.svd(x, full_matrices=False)
+    delta_ = (singular_values ** 4).sum() / n_obs ** 2
+    beta_ = (squared.sum(axis=1) ** 2).sum()
+    beta = (beta_ / n_obs - delta_) / (n_assets * n_obs)
+    delta = (delta_ - 2 * scale * variances.sum() + n_assets * scale ** 2) / n_assets
+    shrinkage = 0.0 if beta == 0 else min(beta, delta) / delta
+
+    k = min(factors, int((singular_values > 0).sum()))
+    loadings = components[:k].T * (singular_values[:k] * np.sqrt((1 - shrinkage) / n_obs))
+    specific = (1 - shrinkage) * variances + shrinkage * scale - (loadings ** 2).sum(axis=1)
+    return FactorCovariance(loadings, np.clip(specific, 1e-12, None), returns.columns)
+
+
+def factor_covariance(returns: pd.DataFrame, factors: int = 10) -> FactorCovariance:
+    """
+    Statistical factor model: the first principal components of the returns plus diagonal specific variances.
+    """
+    x = returns.to_numpy(dtype=float)
+    x = x - x.mean(axis=0)
+    n_obs = len(x)
+    _, singular_values, components = np.linalg.svd(x, full_matrices=False)
+    k = min(factors, len(singular_values))
+    loadings = components[:k].T * (singular_values[:k] / np.sqrt(n_obs - 1))
+    variances = (x ** 2).sum(axis=0) / (n_obs - 1)
+    specific = np.clip(variances - (loadings ** 2).sum(axis=1), 1e-12, None)
+    return FactorCovariance(loadings, specific, returns.columns)
+
+
+# Test cases for the covariance estimators, against riskfolio and sklearn
+class TestEstimators(unittest.TestCase):
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        self.returns = pd.DataFrame(rng.normal(0.0005, 0.02, size=(400, 6)), columns=list('ABCDEF'))
+
+    def assert_parity(self, estimator, window: pd.DataFrame, method: str) -> None:
+        import riskfolio as rp
+        mu = rp.mean_vector(window, method=method, d=0.94)
+        cov = rp.covar_matrix(window, method=method, d=0.94)
+        np.testing.assert_allclose(estimator.mean, np.asarray(mu).ravel(), rtol=1e-9, atol=1e-14)
+        np.testing.assert_allclose(estimator.cov(), np.asarray(cov), rtol=1e-7, atol=1e-14)
+
+    def test_hist_rolling_window(self) -> None:
+        estimator = RollingMoments(6)
+        estimator.add(self.returns.iloc[:250].to_numpy())
+        for t in range(250, 300):
+            estimator.add(self.returns.iloc[t].to_numpy())
+            estimator.remove(self.returns.iloc[t - 250].to_numpy())
+        self.assert_parity(estimator, self.returns.iloc[50:300], 'hist')
+
+    def test_ewma_streaming(self) -> None:
+        estimator = EWMAMoments(6, d=0.94)
+        estimator.add(self.returns.iloc[:100].to_numpy())
+        for t in range(100, 400):
+            estimator.add(self.returns.iloc[t].to_numpy())
+        self.assert_parity(estimator, self.returns, 'ewma1')
+
+    def test_ewma_rolling_window(self) -> None:
+        estimator = EWMAMoments(6, d=0.94)
+        estimator.add(self.returns.iloc[:60].to_numpy())
+        estimator.add(self.returns.iloc[60:90].to_numpy())
+        estimator.remove(self.returns.iloc[:30].to_numpy())
+        self.assert_parity(estimator, self.returns.iloc[30:90], 'ewma1')
+
+    def test_ledoit_wolf(self) -> None:
+        from sklearn.covariance import ledoit_wolf as sklearn_ledoit_wolf
+        expected, _ = sklearn_ledoit_wolf(self.returns.to_numpy())
+        cov = ledoit_wolf(self.returns)
+        self.assertEqual(cov.rank, 6)
+        np.testing.assert_allclose(cov.dense(), expected, rtol=1e-10, atol=1e-16)
+        # With fewer assets than observations the rank is still bounded by factors
+        cov = ledoit_wolf(self.returns, factors=2)
+        self.assertEqual(cov.loadings.shape, (6, 2))
+        np.testing.assert_allclose(np.diag(cov.dense()), np.diag(expected))
+
+    def test_ledoit_wolf_wide(self) -> None:
+        from sklearn.covariance import ledoit_wolf as sklearn_ledoit_wolf
+        rng = np.random.default_rng(1)
+        returns = pd.DataFrame(rng.normal(0, 0.01, size=(60, 3)) @ rng.normal(0, 1, size=(3, 200))
+                               + rng.normal(0, 0.005, size=(60, 200)))
+        expected, _ = sklearn_ledoit_wolf(returns.to_numpy())
+        cov = ledoit_wolf(returns, factors=5)
+        self.assertEqual(cov.loadings.shape, (200, 5))
+        np.testing.assert_allclose(np.diag(cov.dense()), np.diag(expected))
+        # The top factors carry the correlation structure, up to the dropped small eigenvalues
+        self.assertLess(np.abs(cov.dense() - expected).max(), 0.1 * np.abs(expected).max())
+        np.testing.assert_allclose(ledoit_wolf(returns, factors=60).dense(), expected, atol=1e-12)
+
+    def test_factor_covariance(self) -> None:
+        cov = factor_covariance(self.returns, factors=2)
+        self.assertEqual(cov.loadings.shape, (6, 2))
+        np.testing.assert_allclose(np.diag(cov.dense()), self.returns.var().to_numpy())
+        weights = np.full(6, 1 / 6)
+        np.testing.assert_allclose(cov.variance(weights), weights @ cov.dense() @ weights)
+        np.testing.assert_allclose(cov.dot(weights), cov.dense() @ weights)
+
+    def test_factored_optimization(self) -> None:
+        from solvers import MeanVarianceProblem
+        cov = factor_covariance(self.returns, factors=2)
+        mu = self.returns.mean().to_numpy()
+        factored = MeanVarianceProblem(6, rank=2)
+        factored.set_inputs(mu, factors=cov)
+        dense = MeanVarianceProblem(6)
+        dense.set_inputs(mu, cov=cov.dense())
+        for obj in ['MinRisk', 'Sharpe']:
+            np.testing.assert_allclose(factored.solve(obj=obj), dense.solve(obj=obj), atol=1e-3)
+
+    def test_injection(self) -> None:
+        import riskfolio as rp
+        from step3 import set_assets_stats
+        reference = rp.Portfolio(returns=self.returns)
+        reference.assets_stats(method_mu='hist', method_cov='hist')
+        portfolio = rp.Portfolio(returns=self.returns)
+        estimator = RollingMoments(6)
+        estimator.add(self.returns.to_numpy())
+        set_assets_stats(portfolio, estimator.mean, estimator.cov())
+        pd.testing.assert_frame_equal(portfolio.mu, reference.mu, check_names=False)
+        pd.testing.assert_frame_equal(portfolio.cov, reference.cov, check_names=False)
+
+
+def main() -> None:
+    unittest.main()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,384 @@
+import hashlib
+import unittest
+from unittest import mock
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import pandas as pd
+import riskfolio as rp
+
+from models.numpy_models import Z_80
+from solvers import MeanVarianceProblem, matrix_sqrt
+
+# The most recently used frontiers computed in this process, keyed by frontier_fingerprint
+frontier_cache: 'OrderedDict[str, pd.DataFrame]' = OrderedDict()
+FRONTIER_CACHE_SIZE = 64
+
+# Constraint settings of rp.Portfolio with their defaults; the other 'upper' and 'lower' bounds default to None
+CONSTRAINT_DEFAULTS = {'sht': False, 'uppersht': 0.2, 'upperlng': 1, 'lowerlng': 0, 'budget': 1, 'budgetsht': 0.2,
+                       'nea': None, 'card': None, 'allowTO': False, 'allowTE': False, 'ainequality': None,
+                       'binequality': None, 'network_sdp': None, 'network_ip': None, 'cluster_sdp': None,
+                       'cluster_ip': None, 'acentrality': None, 'bcentrality': None}
+# Settings only used when the turnover or tracking error constraints are on
+TURNOVER_SETTINGS = ('turnover', 'benchweights')
+TRACKING_SETTINGS = ('TE', 'kindbench', 'benchweights', 'benchindex')
+
+
+def portfolio_constraints(portfolio: rp.Portfolio) -> Dict[str, object]:
+    """
+    Constraint settings of the portfolio that differ from riskfolio's defaults: short selling, weight
+    bounds, budget, linear inequalities, cardinality, turnover, tracking error and risk or return bounds.
+    """
+    names = set(CONSTRAINT_DEFAULTS) | {name for name in vars(portfolio) if name.startswith(('upper', 'lower'))}
+    constraints = {}
+    for name in sorted(names):
+        default = CONSTRAINT_DEFAULTS.get(name)
+        value = getattr(portfolio, name, default)
+        if value is None and default is None:
+            continue
+        if value is not None and default is not None and np.ndim(value) == 0 and value == default:
+            continue
+        constraints[name] = value
+    for flag, settings in (('allowTO', TURNOVER_SETTINGS), ('allowTE', TRACKING_SETTINGS)):
+        if flag in constraints:
+            constraints.update({name: getattr(portfolio, name, None) for name in settings})
+    return constraints
+
+
+def frontier_fingerprint(portfolio: rp.Portfolio, model: str, rm: str, points: int, rf: float, hist: bool) -> str:
+    """
+    Hash the inputs a frontier depends on: mu, cov (and the returns for the non 'MV' risk measures), the
+    constraints of the portfolio and the settings.
+    """
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(portfolio.mu, dtype=float).tobytes())
+    digest.update(np.ascontiguousarray(portfolio.cov, dtype=float).tobytes())
+    if rm != 'MV':
+        digest.update(np.ascontiguousarray(portfolio.returns, dtype=float).tobytes())
+    for name, value in portfolio_constraints(portfolio).items():
+        digest.update(name.encode())
+        try:
+            digest.update(np.ascontiguousarray(value, dtype=float).tobytes())
+        except (TypeError, ValueError):
+            digest.update(repr(value).encode())
+    digest.update(repr((list(portfolio.cov.columns), model, rm, int(points), float(rf), hist)).encode())
+    return digest.hexdigest()
+
+
+def _cache_frontier(key: str, frontier: pd.DataFrame) -> pd.DataFrame:
+    frontier_cache[key] = frontier
+    frontier_cache.move_to_end(key)
+    while len(frontier_cache) > FRONTIER_CACHE_SIZE:
+        frontier_cache.popitem(last=False)
+    return frontier
+
+
+def _fast_frontier(portfolio: rp.Portfolio, model: str, rm: str, hist: bool) -> bool:
+    # The warm-started solver only handles the long-only, fully invested mean-variance frontier
+    return model == 'Classic' and rm == 'MV' and hist and not portfolio_constraints(portfolio)
+
+
+def _solve_frontier_chunk(mu: np.ndarray, sqrt_cov: np.ndarray, targets: np.ndarray) -> np.ndarray:
+    """
+    Solve consecutive frontier points, each one warm-started from its neighbour's solution.
+    """
+    problem = MeanVarianceProblem(len(mu))
+    problem.set_inputs(mu, sqrt_cov=sqrt_cov)
+    columns = []
+    for target in targets:
+        weights = problem.solve(obj='MinRisk', target=target)
+        columns.append(np.full(len(mu), np.nan) if weights is None else weights)
+    return np.column_stack(columns)
+
+
+def mean_variance_frontier(mu: np.ndarray, cov: np.ndarray, points: int = 50, workers: int = 1) -> np.ndarray:
+    """
+    Long-only mean-variance frontier from the minimum variance portfolio to the maximum return asset.
+
+    The target returns are split into contiguous chunks solved in parallel processes; within a chunk
+    every solve is warm-started from the previous point.
+
+    Returns:
+        np.ndarray: Weights of shape (assets, points); failed points are dropped.
+    """
+    mu = np.asarray(mu, dtype=float).ravel()
+    sqrt_cov = matrix_sqrt(cov)
+    problem = MeanVarianceProblem(len(mu))
+    problem.set_inputs(mu, sqrt_cov=sqrt_cov)
+    minimum = problem.solve(obj='MinRisk')
+    if minimum is None:
+        raise ValueError('the minimum variance portfolio could not be solved')
+    lowest = mu @ minimum
+    chunks = np.array_split(np.linspace(lowest, mu.max(), int(points)), max(1, min(workers, points)))
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            solved = list(executor.map(_solve_frontier_chunk, repeat(mu), repeat(sqrt_cov), chunks))
+    else:
+        solved = [_solve_frontier_chunk(mu, sqrt_cov, chunk) for chunk in chunks]
+    weights = np.concatenate(solved, axis=1)
+    return weights[:, ~np.isnan(weights).any(axis=0)]
+
+
+def efficient_frontier(portfolio: rp.Portfolio, model: str = 'Classic', rm: str = 'MV', points: int = 50,
+                       rf: float = 0, hist: bool = True, workers: int = 1) -> pd.DataFrame:
+    """
+    Calculate the efficient frontier of the portfolio, reusing the cached result when the inputs are unchanged.
+
+    The 'Classic' mean-variance frontier of a portfolio without constraints is solved by
+    mean_variance_frontier; constrained portfolios, other models and risk measures, and problems the
+    fast solver fails on fall back to riskfolio, which solves every point from scratch.
+
+    Returns:
+        pd.DataFrame: Weights with the assets as index and one column per frontier point, as in riskfolio.
+    """
+    key = frontier_fingerprint(portfolio, model, rm, points, rf, hist)
+    if key in frontier_cache:
+        frontier_cache.move_to_end(key)
+        return frontier_cache[key]
+    frontier = None
+    if _fast_frontier(portfolio, model, rm, hist):
+        try:
+            weights = mean_variance_frontier(portfolio.mu, portfolio.cov, points=points, workers=workers)
+            frontier = pd.DataFrame(weights, index=portfolio.cov.columns)
+        except ValueError:
+            frontier = None
+    if frontier is None:
+        frontier = portfolio.efficient_frontier(model=model, rm=rm, points=points, rf=rf, hist=hist)
+    return _cache_frontier(key, frontier)
+
+
+def _riskfolio_frontier(returns: pd.DataFrame, mu: pd.DataFrame, cov: pd.DataFrame, constraints: Dict[str, object],
+                        model: str, rm: str, points: int, rf: float, hist: bool) -> pd.DataFrame:
+    portfolio = rp.Portfolio(returns=returns)
+    portfolio.mu, portfolio.cov = mu, cov
+    for name, value in constraints.items():
+        setattr(portfolio, name, value)
+    return portfolio.efficient_frontier(model=model, rm=rm, points=points, rf=rf, hist=hist)
+
+
+def frontier_sweep(portfolio: rp.Portfolio, rms: List[str], rfs: List[float], model: str = 'Classic',
+                   points: int = 50, hist: bool = True, workers: int = 1) -> Dict[Tuple[str, float], pd.DataFrame]:
+    """
+    Compute the frontiers of every (rm, rf) combination, solving the uncached riskfolio ones in parallel processes.
+
+    The workers rebuild the portfolio from its returns, mu, cov and constraints (see portfolio_constraints),
+    so other settings of the portfolio object are not carried over to them.
+    """
+    frontiers = {}
+    remote = []
+    for rm in rms:
+        for rf in rfs:
+            key = frontier_fingerprint(portfolio, model, rm, points, rf, hist)
+            if key in frontier_cache or _fast_frontier(portfolio, model, rm, hist):
+                frontiers[(rm, rf)] = efficient_frontier(portfolio, model, rm, points, rf, hist, workers=workers)
+            else:
+                remote.append((rm, rf, key))
+
+    if remote:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            constraints = portfolio_constraints(portfolio)
+            futures = [executor.submit(_riskfolio_frontier, portfolio.returns, portfolio.mu, portfolio.cov,
+                                       constraints, model, rm, points, rf, hist) for rm, rf, _ in remote]
+            for (rm, rf, key), future in zip(remote, futures):
+                frontiers[(rm, rf)] = _cache_frontier(key, future.result())
+    return frontiers
+
+
+def forecast_return_moments(forecasts: np.ndarray, last_prices: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Expected daily returns implied by price forecasts, and their standard errors from the forecast intervals.
+
+    The standard error comes from the width of the horizon-end interval relative to yhat, so it stays
+    defined when the lower bound is negative, as Prophet's often is on long horizons for volatile assets.
+    A non-positive yhat raises a ValueError.
+
+    Args:
+        forecasts (np.ndarray): Forecasts of shape (assets, horizon, 3) with yhat, yhat_lower and yhat_upper
+                                along the last axis, as returned by step1.forecast_batch (80% intervals).
+        last_prices (np.ndarray): Last observed price of every asset.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The expected daily returns and their standard errors.
+    """
+    horizon = forecasts.shape[1]
+    final = forecasts[:, -1, :]
+    if (final[:, 0] <= 0).any():
+        raise ValueError('forecast prices must be positive, got yhat <= 0 for assets ' +
+                         str(np.flatnonzero(final[:, 0] <= 0).tolist()))
+    mu = (final[:, 0] / last_prices) ** (1 / horizon) - 1
+    # The interval of the horizon-end price, relative to yhat, gives the uncertainty of the cumulative return
+    se = (final[:, 2] - final[:, 1]) / (2 * Z_80 * final[:, 0]) / horizon
+    return mu, se
+
+
+def _resample_chunk(mu: np.ndarray, cov: np.ndarray, se: Optional[np.ndarray], n_obs: int, scenarios: int,
+                    seed: np.random.SeedSequence, points: int, obj: Optional[str], rf: float, l: float) -> Tuple[np.ndarray, int]:
+    """
+    Draw a chunk of scenarios and sum the weights of their optimal portfolios or frontiers.
+
+    The sample mean and covariance of n_obs Gaussian returns are independent, so each scenario's
+    estimates are drawn directly: the mean from N(mu + se * z, cov / n_obs) and the covariance from a
+    Wishart distribution, for all the scenarios of the chunk in one batch.
+    """
+    from scipy.stats import wishart
+    rng = np.random.default_rng(seed)
+    n_assets = len(mu)
+    sqrt_cov = matrix_sqrt(cov)
+    centers = mu + (0 if se is None else se * rng.standard_normal((scenarios, n_assets)))
+    means = centers + rng.standard_normal((scenarios, n_assets)) @ sqrt_cov / np.sqrt(n_obs)
+    covs = wishart.rvs(df=n_obs - 1, scale=cov / (n_obs - 1), size=scenarios, random_state=rng).reshape(scenarios, n_assets, n_assets)
+
+    problem = MeanVarianceProblem(n_assets)
+    total = np.zeros((n_assets, 1 if obj else points))
+    solved = 0
+    for mean, scenario_cov in zip(means, covs):
+        problem.set_inputs(mean, scenario_cov)
+        if obj:
+            weights = problem.solve(obj=obj, rf=rf, l=l)
+            columns = None if weights is None else weights[:, None]
+        else:
+            lowest = problem.solve(obj='MinRisk')
+            if lowest is None:
+                continue
+            columns = [problem.solve(obj='MinRisk', target=target)
+                       for target in np.linspace(mean @ lowest, mean.max(), points)]
+            columns = None if any(weights is None for weights in columns) else np.column_stack(columns)
+        if columns is not None:
+            total += columns
+            solved += 1
+    return total, solved
+
+
+def resampled_frontier(mu: np.ndarray, cov: np.ndarray, se: Optional[np.ndarray] = None, n_obs: int = 252,
+                       scenarios: int = 1000, points: int = 20, obj: Optional[str] = None, rf: float = 0,
+                       l: float = 0, chunk: int = 50, workers: int = 1, seed: int = 0) -> np.ndarray:
+    """
+    Resampled (Michaud) long-only mean-variance frontier, or resampled optimal portfolio when obj is given.
+
+    Every scenario re-estimates the expected returns and covariance as if from n_obs new observations,
+    with the expected returns further perturbed by their forecast standard errors se (see
+    forecast_return_moments). The frontier, or the obj portfolio, of every scenario is solved and the
+    weights are averaged rank by rank, which spreads the allocation over assets whose estimates are not
+    significantly different. Scenarios are drawn and solved in chunks, in parallel processes, so memory
+    only depends on the chunk size; each chunk has its own seed, so the result doesn't depend on workers.
+    n_obs must exceed the number of assets.
+
+    Returns:
+        np.ndarray: Averaged weights of shape (assets, points), or (assets,) when obj is given.
+    """
+    mu = np.asarray(mu, dtype=float).ravel()
+    cov = np.asarray(cov, dtype=float)
+    if n_obs <= len(mu):
+        raise ValueError('n_obs must exceed the number of assets for the resampled covariances to be invertible')
+    sizes = [min(chunk, scenarios - start) for start in range(0, scenarios, chunk)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    args = [(mu, cov, se, n_obs, size, chunk_seed, points, obj, rf, l) for size, chunk_seed in zip(sizes, seeds)]
+
+    if workers > 1 and len(args) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_resample_chunk, *zip(*args)))
+    else:
+        results = [_resample_chunk(*chunk_args) for chunk_args in args]
+
+    total = sum(weights for weights, _ in results)
+    solved = sum(count for _, count in results)
+    if not solved:
+        raise ValueError('no scenario could be solved')
+    weights = total / solved
+    return weights[:, 0] if obj else weights
+
+
+# Test cases for the frontier engine
+class TestFrontier(unittest.TestCase):
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        returns = pd.DataFrame(rng.normal(0.0005, 0.02, size=(500, 6)) + rng.normal(0, 0.01, size=(500, 1)),
+                               columns=list('ABCDEF'))
+        self.portfolio = rp.Portfolio(returns=returns)
+        self.portfolio.assets_stats(method_mu='hist', method_cov='hist')
+        frontier_cache.clear()
+
+    def test_frontier_is_efficient(self) -> None:
+        frontier = efficient_frontier(self.portfolio, points=20)
+        mu = self.portfolio.mu.to_numpy().ravel()
+        cov = self.portfolio.cov.to_numpy()
+        returns = mu @ frontier.to_numpy()
+        risks = np.sqrt(np.einsum('ip,ij,jp->p', frontier.to_numpy(), cov, frontier.to_numpy()))
+        self.assertEqual(frontier.shape, (6, 20))
+        np.testing.assert_allclose(frontier.sum(), 1)
+        self.assertTrue((np.diff(returns) > 0).all())
+        self.assertTrue((np.diff(risks) > -1e-6).all())
+
+    def test_parallel_matches_serial(self) -> None:
+        mu, cov = self.portfolio.mu, self.portfolio.cov
+        np.testing.assert_allclose(mean_variance_frontier(mu, cov, points=12, workers=3),
+                                   mean_variance_frontier(mu, cov, points=12), atol=1e-4)
+
+    def test_resampled_frontier(self) -> None:
+        mu, cov = self.portfolio.mu.to_numpy().ravel(), self.portfolio.cov.to_numpy()
+        frontier = resampled_frontier(mu, cov, scenarios=40, points=5, chunk=15)
+        self.assertEqual(frontier.shape, (6, 5))
+        np.testing.assert_allclose(frontier.sum(axis=0), 1)
+        np.testing.assert_allclose(resampled_frontier(mu, cov, scenarios=40, points=5, chunk=15, workers=2), frontier)
+
+        # Averaging over uncertain estimates spreads the optimal portfolio over more assets
+        classic = MeanVarianceProblem(6)
+        classic.set_inputs(mu, cov)
+        se = np.full(6, 0.0005)
+        robust = resampled_frontier(mu, cov, se=se, scenarios=40, obj='Sharpe')
+        self.assertAlmostEqual(robust.sum(), 1)
+        self.assertGreater((robust > 0.01).sum(), (classic.solve(obj='Sharpe') > 0.01).sum())
+
+    def test_forecast_return_moments(self) -> None:
+        forecasts = np.array([[[100, 90, 110], [121, 100, 146.41]]], dtype=float)
+        mu, se = forecast_return_moments(forecasts, np.array([100.0]))
+        np.testing.assert_allclose(mu, [0.1])
+        np.testing.assert_allclose(se, [46.41 / (2 * Z_80 * 121) / 2])
+
+        # Lower bounds below zero still give finite standard errors usable by resampled_frontier
+        forecasts = np.array([[[100, 50, 150], [90, -20, 200]], [[100, 95, 105], [102, 94, 110]]], dtype=float)
+        mu, se = forecast_return_moments(forecasts, np.array([100.0, 100.0]))
+        self.assertTrue(np.isfinite(se).all() and (se > 0).all())
+        cov = np.diag([4e-4, 1e-4])
+        np.testing.assert_allclose(resampled_frontier(mu, cov, se=se, scenarios=10, obj='MinRisk').sum(), 1)
+        forecasts[0, -1, 0] = -5
+        self.assertRaises(ValueError, forecast_return_moments, forecasts, np.array([100.0, 100.0]))
+
+    def test_cache(self) -> None:
+        frontier = efficient_frontier(self.portfolio, points=10)
+        self.assertIs(efficient_frontier(self.portfolio, points=10), frontier)
+        self.assertIsNot(efficient_frontier(self.portfolio, points=11), frontier)
+        # Only the most recently used frontiers are kept
+        with mock.patch(__name__ + '.FRONTIER_CACHE_SIZE', 3):
+            efficient_frontier(self.portfolio, points=10)
+            for points in (12, 13):
+                efficient_frontier(self.portfolio, points=points)
+            self.assertIs(efficient_frontier(self.portfolio, points=10), frontier)
+            for points in (14, 15, 16):
+                efficient_frontier(self.portfolio, points=points)
+            self.assertEqual(len(frontier_cache), 3)
+            self.assertIsNot(efficient_frontier(self.portfolio, points=10), frontier)
+
+    def test_constraints(self) -> None:
+        unconstrained = efficient_frontier(self.portfolio, points=5)
+        self.assertEqual(portfolio_constraints(self.portfolio), {})
+        self.portfolio.upperlng = 0.3
+        self.assertEqual(portfolio_constraints(self.portfolio), {'upperlng': 0.3})
+        constrained = efficient_frontier(self.portfolio, points=5)
+        self.assertIsNot(constrained, unconstrained)
+        self.assertLessEqual(constrained.to_numpy().max(), 0.3 + 1e-6)
+        self.assertGreater(unconstrained.to_numpy().max(), 0.3 + 1e-6)
+
+    def test_failed_minimum_variance(self) -> None:
+        cov = np.full((3, 3), np.nan)
+        self.assertRaises(ValueError, mean_variance_frontier, np.zeros(3), cov)
+
+
+def main() -> None:
+    unittest.main()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from typing import Dict, List, Tuple
+import numpy as np
+import pandas as pd
+import riskfolio as rp
+
+from solvers import MeanVarianceProblem
+
+GRID_KEYS = ('model', 'rm', 'obj', 'rf', 'l')
+
+
+def expand_grid(grid: Dict[str, list]) -> List[Dict]:
+    """
+    Expand lists of model, rm, obj, rf and l values into every combination.
+    """
+    defaults = {'model': ['Classic'], 'rm': ['MV'], 'obj': ['Sharpe'], 'rf': [0], 'l': [0]}
+    values = [grid.get(key, defaults[key]) for key in GRID_KEYS]
+    return [dict(zip(GRID_KEYS, combination)) for combination in product(*values)]
+
+
+def _solve_group(returns: pd.DataFrame, mu: pd.DataFrame, cov: pd.DataFrame, configs: List[Dict]) -> List[np.ndarray]:
+    """
+    Solve the configurations sharing one (model, rm) pair.
+
+    Classic mean-variance problems are built once and re-solved with rf and l swapped in; the other
+    risk measures go through a single riskfolio portfolio holding the shared statistics.
+    """
+    n_assets = len(cov)
+    model, rm = configs[0]['model'], configs[0]['rm']
+    results = []
+    if model == 'Classic' and rm == 'MV':
+        problem = MeanVarianceProblem(n_assets)
+        problem.set_inputs(mu.to_numpy(), cov.to_numpy())
+        for config in configs:
+            weights = problem.solve(obj=config['obj'], rf=config['rf'], l=config['l'])
+            results.append(np.full(n_assets, np.nan) if weights is None else weights)
+    else:
+        portfolio = rp.Portfolio(returns=returns)
+        portfolio.mu, portfolio.cov = mu, cov
+        for config in configs:
+            weights = portfolio.optimization(hist=True, **config)
+            results.append(np.full(n_assets, np.nan) if weights is None else weights['weights'].to_numpy())
+    return results
+
+
+def optimize_grid(returns: pd.DataFrame, grid: Dict[str, list], method_mu: str = 'hist', method_cov: str = 'hist',
+                  workers: int = 1) -> pd.DataFrame:
+    """
+    Optimize the portfolio for every combination of a grid of model, rm, obj, rf and l values.
+
+    The asset statistics are estimated once and shared by every configuration. Each (model, rm) group
+    is built once and re-solved with new parameters; configurations that riskfolio has to rebuild are
+    spread over the workers. The tasks run in parallel processes.
+
+    Args:
+        returns (pd.DataFrame): Asset returns.
+        grid (dict): Lists of values keyed by 'model', 'rm', 'obj', 'rf' and 'l'. Missing keys use the
+                     optimize_portfolio defaults.
+        method_mu (str): Method used to estimate the expected returns.
+        method_cov (str): Method used to estimate the covariance.
+        workers (int): Number of worker processes.
+
+    Returns:
+        pd.DataFrame: One row per configuration and asset with columns model, rm, obj, rf, l, asset and weight.
+                      Weights are NaN for configurations the solver could not solve.
+    """
+    portfolio = rp.Portfolio(returns=returns)
+    portfolio.assets_stats(method_mu=method_mu, method_cov=method_cov)
+
+    groups: Dict[Tuple[str, str], List[Dict]] = {}
+    for config in expand_grid(grid):
+        groups.setdefault((config['model'], config['rm']), []).append(config)
+
+    # Parametric mean-variance groups stay whole; riskfolio groups are split so they spread over the workers
+    tasks = []
+    for (model, rm), configs in groups.items():
+        if model == 'Classic' and rm == 'MV':
+            tasks.append(configs)
+        else:
+            size = -(-len(configs) // max(1, workers))
+            tasks.extend(configs[i:i + size] for i in range(0, len(configs), size))
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_solve_group, returns, portfolio.mu, portfolio.cov, configs) for configs in tasks]
+            solved = [future.result() for future in futures]
+    else:
+        solved = [_solve_group(returns, portfolio.mu, portfolio.cov, configs) for configs in tasks]
+
+    assets = list(returns.columns)
+    rows = []
+    for configs, results in zip(tasks, solved):
+        for config, weights in zip(configs, results):
+            for asset, weight in zip(assets, weights):
+                rows.append(dict(config, asset=asset, weight=weight))
+    return pd.DataFrame(rows, columns=list(GRID_KEYS) + ['asset', 'weight'])
+
+
+# Test cases for the grid optimizer
+class TestOptimizeGrid(unittest.TestCase):
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        self.returns = pd.DataFrame(rng.normal(0.001, 0.02, size=(300, 4)) + rng.normal(0, 0.01, size=(300, 1)),
+                                    columns=list('ABCD'))
+
+    def test_table_and_parity(self) -> None:
+        grid = {'rm': ['MV', 'CVaR'], 'obj': ['Sharpe', 'MinRisk'], 'rf': [0, 0.0005]}
+        table = optimize_grid(self.returns, grid, workers=2)
+        self.assertEqual(len(table), 2 * 2 * 2 * 4)
+        np.testing.assert_allclose(table.groupby(['rm', 'obj', 'rf'])['weight'].sum(), 1, atol=1e-6)
+
+        portfolio = rp.Portfolio(returns=self.returns)
+        portfolio.assets_stats(method_mu='hist', method_cov='hist')
+        for rm in grid['rm']:
+            expected = portfolio.optimization(model='Classic', rm=rm, obj='Sharpe', rf=0.0005, l=0, hist=True)
+            selected = table[(table['rm'] == rm) & (table['obj'] == 'Sharpe') & (table['rf'] == 0.0005)]
+            np.testing.assert_allclose(selected['weight'].to_numpy(), expected['weights'].to_numpy(), atol=2e-3)
+
+
+def main() -> None:
+    unittest.main()
+
+if __name__ == "__main__":
+    main()
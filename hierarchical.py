@@ -0,0 +1,262 @@
+import time
+import unittest
+from typing import List, Optional, Tuple
+import numpy as np
+import pandas as pd
+from scipy.cluster import hierarchy
+from scipy.spatial.distance import squareform
+
+HC_MODELS = ('HRP', 'HERC')
+LINKAGES = ('single', 'complete', 'average', 'ward')
+
+
+def correlation_distance(cov: np.ndarray) -> np.ndarray:
+    """
+    Condensed correlation distances sqrt((1 - rho) / 2) of a covariance matrix, as expected by scipy's linkage.
+
+    The correlation is obtained by scaling the covariance in place on a copy, so only two N x N arrays
+    are allocated whatever the number of assets.
+    """
+    cov = np.asarray(cov, dtype=float)
+    inv_std = 1 / np.sqrt(np.diag(cov))
+    distance = cov * inv_std[:, None]
+    distance *= inv_std
+    np.subtract(1, distance, out=distance)
+    distance *= 0.5
+    np.clip(distance, 0, None, out=distance)
+    np.sqrt(distance, out=distance)
+    np.fill_diagonal(distance, 0)
+    return squareform(distance, checks=False)
+
+
+def cluster_assets(distance: np.ndarray, linkage: str = 'single') -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Hierarchical clustering of the assets on their condensed correlation distances (see correlation_distance).
+
+    Returns:
+        tuple: The scipy linkage matrix and the dendrogram order of the assets (quasi-diagonal order).
+    """
+    if linkage not in LINKAGES:
+        raise ValueError("linkage must be one of " + str(LINKAGES) + ", got " + str(linkage))
+    tree = hierarchy.linkage(distance, method=linkage)
+    return tree, hierarchy.leaves_list(tree)
+
+
+def _node_ranges(tree: np.ndarray, order: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Position and size of every node in dendrogram order; each subtree is a contiguous range
+    n_assets = len(order)
+    start = np.empty(2 * n_assets - 1, dtype=int)
+    size = np.ones(2 * n_assets - 1, dtype=int)
+    start[order] = np.arange(n_assets)
+    for i, (a, b) in enumerate(tree[:, :2].astype(int)):
+        start[n_assets + i] = min(start[a], start[b])
+        size[n_assets + i] = size[a] + size[b]
+    return start, size
+
+
+def _cut(tree: np.ndarray, k: int) -> List[int]:
+    # Nodes created by the top k - 1 merges are split, the nodes below them are the k clusters
+    n_assets = len(tree) + 1
+    if k == 1:
+        return [2 * n_assets - 2]
+    return [int(node) for i in range(n_assets - k, n_assets - 1) for node in tree[i, :2] if node < 2 * n_assets - k]
+
+
+def optimal_clusters(tree: np.ndarray, distance: np.ndarray, max_k: int = 10) -> int:
+    """
+    Number of clusters given by the two-difference gap statistic, as riskfolio's two_diff_gap_stat.
+
+    For every k up to min(max_k, sqrt(N)) + 2, W_k sums the standard deviations of the pairwise
+    distances within each of the k clusters, and the k maximising W_k+2 + W_k - 2 W_k+1 is chosen.
+    Only the distance blocks of the clusters of these few levels are read.
+    """
+    n_assets = len(tree) + 1
+    order = hierarchy.leaves_list(tree)
+    ordered = squareform(distance)[np.ix_(order, order)]
+    start, size = _node_ranges(tree, order)
+    limit = int(np.floor(min(max_k, np.sqrt(n_assets)) + 2))
+
+    within = [-np.inf]
+    for k in range(2, min(limit, n_assets) + 1):
+        total = 0.0
+        for node in _cut(tree, k):
+            first, count = start[node], size[node]
+            if count < 2:
+                continue
+            block = ordered[first:first + count, first:first + count]
+            pairs = count * (count - 1) / 2
+            mean = block.sum() / 2 / pairs
+            total += np.sqrt(max((block ** 2).sum() / 2 / pairs - mean ** 2, 0))
+        within.append(total)
+    if len(within) < 3:
+        return 1
+    within = np.array(within)
+    gaps = within[2:] + within[:-2] - 2 * within[1:-1]
+    return int(np.argmax(gaps)) + 1
+
+
+class _OrderedCovariance:
+    """
+    Covariance reordered along the dendrogram and scaled for the inverse-variance cluster variances.
+
+    In dendrogram order every cluster is a contiguous block, so the variance of a cluster held with
+    inverse-variance weights is the sum of a block of C_ij / (v_i v_j) divided by (sum of 1 / v_i)^2.
+    """
+    def __init__(self, cov: np.ndarray, order: np.ndarray):
+        self.inv_var = 1 / np.diag(cov)[order]
+        self.scaled = cov[np.ix_(order, order)]
+        self.scaled *= self.inv_var[:, None]
+        self.scaled *= self.inv_var
+        self.cum_inv_var = np.concatenate([[0], np.cumsum(self.inv_var)])
+
+    def variance(self, start: int, stop: int) -> float:
+        total = self.cum_inv_var[stop] - self.cum_inv_var[start]
+        return float(self.scaled[start:stop, start:stop].sum()) / total ** 2
+
+    def inverse_variance(self, start: int, stop: int) -> np.ndarray:
+        return self.inv_var[start:stop] / (self.cum_inv_var[stop] - self.cum_inv_var[start])
+
+
+def hrp_weights(cov: np.ndarray, order: np.ndarray) -> np.ndarray:
+    """
+    Hierarchical risk parity weights: recursive bisection of the assets in dendrogram order.
+
+    Each half of a cluster gets a share inversely proportional to its inverse-variance portfolio variance.
+    """
+    ordered = _OrderedCovariance(np.asarray(cov, dtype=float), order)
+    weights = np.ones(len(order))
+    clusters = [(0, len(order))]
+    while clusters:
+        start, stop = clusters.pop()
+        if stop - start < 2:
+            continue
+        middle = start + (stop - start) // 2
+        left, right = ordered.variance(start, middle), ordered.variance(middle, stop)
+        alpha = 1 - left / (left + right)
+        weights[start:middle] *= alpha
+        weights[middle:stop] *= 1 - alpha
+        clusters += [(start, middle), (middle, stop)]
+
+    result = np.empty(len(order))
+    result[order] = weights
+    return result
+
+
+def herc_weights(cov: np.ndarray, tree: np.ndarray, order: np.ndarray, k: int) -> np.ndarray:
+    """
+    Hierarchical equal risk contribution weights: the dendrogram is cut into k clusters, the top k - 1
+    merges split the weight between their two sides inversely to the summed variance of the clusters
+    on each side, and each cluster is held with inverse-variance weights.
+    """
+    n_assets = len(order)
+    ordered = _OrderedCovariance(np.asarray(cov, dtype=float), order)
+    merges = tree[:, :2].astype(int)
+    start, size = _node_ranges(tree, order)
+    top = range(n_assets - k, n_assets - 1)
+    clusters = _cut(tree, k)
+    risk = {node: ordered.variance(start[node], start[node] + size[node]) for node in clusters}
+    for i in top:
+        risk[n_assets + i] = risk[merges[i, 0]] + risk[merges[i, 1]]
+
+    share = {2 * n_assets - 2: 1.0}
+    for i in reversed(top):
+        a, b = merges[i]
+        alpha = 1 - risk[a] / (risk[a] + risk[b])
+        share[a], share[b] = share[n_assets + i] * alpha, share[n_assets + i] * (1 - alpha)
+
+    weights = np.empty(n_assets)
+    for node in clusters:
+        first, stop = start[node], start[node] + size[node]
+        weights[first:stop] = share[node] * ordered.inverse_variance(first, stop)
+    result = np.empty(n_assets)
+    result[order] = weights
+    return result
+
+
+def hierarchical_weights(cov: np.ndarray, model: str = 'HRP', linkage: str = 'single', k: Optional[int] = None,
+                         max_k: int = 10) -> np.ndarray:
+    """
+    Long-only hierarchical clustering allocation (HRP or HERC) of a covariance matrix.
+
+    No optimization problem is solved: the cost is the O(N^2) correlation distance and linkage plus
+    block sums of the covariance, so thousands of assets take seconds. Like riskfolio's HCPortfolio
+    with codependence='pearson', rm='MV' and leaf_order=False; when k is not given, HERC picks it with
+    the two-difference gap statistic (see optimal_clusters).
+
+    Args:
+        cov (np.ndarray): Covariance matrix of the assets.
+        model (str): 'HRP' or 'HERC'.
+        linkage (str): Linkage method, one of LINKAGES.
+        k (int, optional): Number of HERC clusters.
+        max_k (int): Largest number of HERC clusters considered when k is not given.
+    """
+    if model not in HC_MODELS:
+        raise ValueError("model must be one of " + str(HC_MODELS) + ", got " + str(model))
+    cov = np.asarray(cov, dtype=float)
+    distance = correlation_distance(cov)
+    tree, order = cluster_assets(distance, linkage)
+    if model == 'HRP':
+        return hrp_weights(cov, order)
+    return herc_weights(cov, tree, order, k or optimal_clusters(tree, distance, max_k))
+
+
+# Test cases for the hierarchical allocations, against riskfolio
+class TestHierarchical(unittest.TestCase):
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        sectors = rng.normal(0, 0.01, size=(500, 4))
+        returns = rng.normal(0.0005, 0.015, size=(500, 24)) + np.repeat(sectors, 6, axis=1)
+        self.returns = pd.DataFrame(returns, columns=['A' + str(i) for i in range(24)])
+
+    def riskfolio_weights(self, model: str, linkage: str, k: Optional[int] = None) -> np.ndarray:
+        import riskfolio as rp
+        portfolio = rp.HCPortfolio(returns=self.returns)
+        weights = portfolio.optimization(model=model, codependence='pearson', rm='MV', linkage=linkage, k=k,
+                                         leaf_order=False)
+        return weights.to_numpy().ravel()
+
+    def test_matches_riskfolio(self) -> None:
+        cov = self.returns.cov().to_numpy()
+        for linkage in ('single', 'ward'):
+            np.testing.assert_allclose(hierarchical_weights(cov, 'HRP', linkage),
+                                       self.riskfolio_weights('HRP', linkage), atol=1e-10)
+            for k in (None, 1, 4, 7):
+                np.testing.assert_allclose(hierarchical_weights(cov, 'HERC', linkage, k=k),
+                                           self.riskfolio_weights('HERC', linkage, k), atol=1e-10)
+
+    def test_optimal_clusters(self) -> None:
+        from riskfolio.src.AuxFunctions import two_diff_gap_stat
+        uncorrelated = pd.DataFrame(np.random.default_rng(2).normal(0, 0.01, size=(500, 8)), columns=list('ABCDEFGH'))
+        for returns in (self.returns, uncorrelated):
+            cov = returns.cov().to_numpy()
+            distance = correlation_distance(cov)
+            for linkage in ('single', 'ward'):
+                tree, _ = cluster_assets(distance, linkage)
+                square = pd.DataFrame(squareform(distance), index=returns.columns, columns=returns.columns)
+                self.assertEqual(optimal_clusters(tree, distance), two_diff_gap_stat(square, tree)[0])
+
+        # Uncorrelated assets stay close to equal weights, as with riskfolio
+        self.returns = uncorrelated
+        for linkage in ('single', 'ward'):
+            weights = hierarchical_weights(uncorrelated.cov().to_numpy(), 'HERC', linkage)
+            np.testing.assert_allclose(weights, self.riskfolio_weights('HERC', linkage), atol=1e-10)
+            self.assertLess(weights.max() / weights.min(), 2)
+
+    def test_large_universe(self) -> None:
+        rng = np.random.default_rng(1)
+        n_assets = 2000
+        loadings = rng.normal(0, 0.01, size=(n_assets, 20))
+        cov = loadings @ loadings.T + np.diag(rng.uniform(1e-4, 4e-4, n_assets))
+        start = time.perf_counter()
+        for model in HC_MODELS:
+            weights = hierarchical_weights(cov, model)
+            self.assertAlmostEqual(weights.sum(), 1)
+            self.assertTrue((weights > 0).all())
+        self.assertLess(time.perf_counter() - start, 10)
+
+
+def main() -> None:
+    unittest.main()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+import atexit
+import collections
+import functools
+import inspect
+import json
+import os
+import resource
+import threading
+import time
+import tracemalloc
+import unittest
+from contextlib import contextmanager
+from typing import Callable, Deque, Dict, Iterator, Optional
+
+# Comma separated hooks to enable at import: 'cprofile' profiles the whole process and 'tracemalloc'
+# records the peak Python allocations of every span
+PROFILE_ENV = 'PORTFOLIO_PROFILE'
+# Path the records are written to at exit: a Chrome trace for '.json', JSON lines otherwise
+TRACE_ENV = 'PORTFOLIO_TRACE'
+# Set by a tracing process for its workers: the directory their records are spooled to, and its own pid
+SPOOL_ENV = 'PORTFOLIO_TRACE_SPOOL'
+SPOOL_PID_ENV = 'PORTFOLIO_TRACE_PID'
+
+
+class Recorder:
+    """
+    Collect timing and memory records of the pipeline stages of the current process.
+
+    Every record holds the stage name, its labels (e.g. the ticker), the wall clock start and duration
+    in seconds, the process and thread ids, the peak resident set size of the process and, when
+    tracemalloc is tracing, the peak Python allocations during the span. Spans are only recorded once
+    enabled, which PORTFOLIO_TRACE and the tracemalloc hook do at import, and only the last max_records
+    records are kept, so long-running processes do not grow without limit.
+
+    Worker processes exit without running atexit hooks, so after share_with_workers their records are
+    also appended, as soon as each span ends, to a per-pid JSON lines file of a spool directory, which
+    collect_workers (called by export) merges back into the records of the tracing process.
+    """
+    def __init__(self, max_records: int = 100000):
+        self.enabled = False
+        self.records: Deque[Dict] = collections.deque(maxlen=max_records)
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.spool: Optional[str] = None
+
+    @contextmanager
+    def span(self, stage: str, **labels) -> Iterator[Dict]:
+        """
+        Time the enclosed block as one record of the given stage. The yielded labels may be extended inside the block.
+        """
+        if not self.enabled:
+            yield labels
+            return
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+        start = time.time()
+        counter = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            record = {'stage': stage, 'labels': labels, 'start': start, 'seconds': time.perf_counter() - counter,
+                      'pid': os.getpid(), 'tid': threading.get_ident(),
+                      'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+            if tracing:
+                record['peak_alloc_bytes'] = tracemalloc.get_traced_memory()[1]
+            with self.lock:
+                self.records.append(record)
+                if self.spool is not None and record['pid'] != self.pid:
+                    with open(os.path.join(self.spool, str(record['pid']) + '.jsonl'), 'a') as f:
+                        f.write(json.dumps(record, default=str) + '\n')
+
+    def share_with_workers(self, directory: str) -> None:
+        """
+        Have the worker processes started from now on (forked or spawned) spool their records to directory.
+        """
+        self.spool = directory
+        os.environ[SPOOL_ENV] = directory
+        os.environ[SPOOL_PID_ENV] = str(self.pid)
+
+    def collect_workers(self) -> None:
+        """
+        Move the records spooled by the worker processes into the records of this process.
+        """
+        if self.spool is None or os.getpid() != self.pid:
+            return
+        for name in sorted(os.listdir(self.spool)):
+            path = os.path.join(self.spool, name)
+            with open(path) as f:
+                records = [json.loads(line) for line in f if line.endswith('\n')]
+            os.remove(path)
+            with self.lock:
+                self.records.extend(records)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.records.clear()
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """
+        Total time, call count and slowest call of every stage.
+        """
+        stages: Dict[str, Dict[str, float]] = {}
+        for record in self.records:
+            stats = stages.setdefault(record['stage'], {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            stats['calls'] += 1
+            stats['seconds'] += record['seconds']
+            stats['max_seconds'] = max(stats['max_seconds'], record['seconds'])
+        return stages
+
+    def to_jsonl(self, path: str) -> None:
+        with open(path, 'w') as f:
+            for record in self.records:
+                f.write(json.dumps(record, default=str) + '\n')
+
+    def to_chrome_trace(self, path: str) -> None:
+        """
+        Write the records in the Chrome trace event format, viewable in chrome://tracing or Perfetto.
+        """
+        events = [{'name': record['stage'], 'cat': 'pipeline', 'ph': 'X', 'ts': record['start'] * 1e6,
+                   'dur': record['seconds'] * 1e6, 'pid': record['pid'], 'tid': record['tid'],
+                   'args': dict(record['labels'], max_rss_kb=record['max_rss_kb'],
+                                **({'peak_alloc_bytes': record['peak_alloc_bytes']} if 'peak_alloc_bytes' in record else {}))}
+                  for record in self.records]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, default=str)
+
+    def export(self, path: str) -> None:
+        self.collect_workers()
+        if path.endswith('.json'):
+            self.to_chrome_trace(path)
+        else:
+            self.to_jsonl(path)
+
+
+recorder = Recorder()
+span = recorder.span
+
+
+def instrumented(stage: str, label: Optional[str] = None) -> Callable:
+    """
+    Decorator recording every call of the function as a span of the given stage.
+
+    :param stage: Stage name of the records.
+    :param label: Name of the argument to record as the 'ticker' label, e.g. 'stock_name'.
+    """
+    def decorator(func: Callable) -> Callable:
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            labels = {}
+            if label is not None:
+                bound = signature.bind_partial(*args, **kwargs)
+                if label in bound.arguments:
+                    labels['ticker'] = bound.arguments[label]
+            with recorder.span(stage, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _enable_hooks() -> None:
+    hooks = {hook.strip() for hook in os.environ.get(PROFILE_ENV, '').split(',') if hook.strip()}
+    if 'tracemalloc' in hooks:
+        recorder.enabled = True
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+    if 'cprofile' in hooks:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+        def dump() -> None:
+            profiler.disable()
+            profiler.dump_stats('profile-' + str(os.getpid()) + '.prof')
+        atexit.register(dump)
+    if os.environ.get(SPOOL_ENV) and os.environ.get(SPOOL_PID_ENV) != str(os.getpid()):
+        # Spawned worker of a traced process: its records go to the spool of that process
+        recorder.enabled = True
+        recorder.spool = os.environ[SPOOL_ENV]
+        recorder.pid = int(os.environ[SPOOL_PID_ENV])
+    elif os.environ.get(TRACE_ENV):
+        import shutil
+        import tempfile
+        recorder.enabled = True
+        recorder.share_with_workers(tempfile.mkdtemp(prefix='portfolio-trace-'))
+
+        def export() -> None:
+            recorder.export(os.environ[TRACE_ENV])
+            shutil.rmtree(recorder.spool, ignore_errors=True)
+        atexit.register(export)
+
+_enable_hooks()
+
+
+def _traced_work(ticker: str) -> int:
+    with span('fit', ticker=ticker):
+        return os.getpid()
+
+
+# Test cases for the instrumentation
+class TestInstrument(unittest.TestCase):
+    def setUp(self) -> None:
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        self.enabled = recorder.enabled
+        recorder.enabled = True
+        recorder.clear()
+
+    def tearDown(self) -> None:
+        import shutil
+        shutil.rmtree(self.directory)
+        recorder.enabled = self.enabled
+        recorder.clear()
+
+    def test_spans_and_exports(self) -> None:
+        @instrumented('fit', label='stock_name')
+        def fit(stock_name: str, size: int = 1000) -> int:
+            return len(list(range(size)))
+
+        fit('AAPL')
+        fit(stock_name='MSFT', size=10)
+        with span('optimize', assets=2) as labels:
+            labels['obj'] = 'Sharpe'
+        self.assertEqual([record['labels'].get('ticker') for record in recorder.records], ['AAPL', 'MSFT', None])
+        self.assertEqual(recorder.records[2]['labels'], {'assets': 2, 'obj': 'Sharpe'})
+        self.assertEqual(recorder.summary()['fit']['calls'], 2)
+
+        recorder.export(os.path.join(self.directory, 'trace.jsonl'))
+        with open(os.path.join(self.directory, 'trace.jsonl')) as f:
+            self.assertEqual([json.loads(line)['stage'] for line in f], ['fit', 'fit', 'optimize'])
+        recorder.export(os.path.join(self.directory, 'trace.json'))
+        with open(os.path.join(self.directory, 'trace.json')) as f:
+            events = json.load(f)['traceEvents']
+        self.assertEqual(events[0]['ph'], 'X')
+        self.assertEqual(events[1]['args']['ticker'], 'MSFT')
+
+    def test_worker_records(self) -> None:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        previous = (recorder.spool, os.environ.get(SPOOL_ENV), os.environ.get(SPOOL_PID_ENV))
+        recorder.share_with_workers(self.directory)
+        try:
+            for method in ('fork', 'spawn'):
+                with ProcessPoolExecutor(2, mp_context=multiprocessing.get_context(method)) as executor:
+                    pids = set(executor.map(_traced_work, ['A', 'B', 'C']))
+                recorder.collect_workers()
+                records = recorder.records
+                self.assertEqual(sorted(record['labels']['ticker'] for record in records), ['A', 'B', 'C'])
+                self.assertEqual({record['pid'] for record in records}, pids)
+                self.assertEqual(os.listdir(self.directory), [])
+                recorder.clear()
+        finally:
+            recorder.spool = previous[0]
+            for variable, value in zip((SPOOL_ENV, SPOOL_PID_ENV), previous[1:]):
+                if value is None:
+                    os.environ.pop(variable, None)
+                else:
+                    os.environ[variable] = value
+
+    def test_disabled_and_bounded(self) -> None:
+        recorder.enabled = False
+        with span('bar', date='2024-01-02') as labels:
+            labels['assets'] = 3
+        self.assertEqual(len(recorder.records), 0)
+
+        bounded = Recorder(max_records=3)
+        bounded.enabled = True
+        for i in range(10):
+            with bounded.span('bar', i=i):
+                pass
+        self.assertEqual([record['labels']['i'] for record in bounded.records], [7, 8, 9])
+
+    def test_tracemalloc(self) -> None:
+        tracemalloc.start()
+        try:
+            with span('alloc'):
+                block = bytearray(10 ** 6)
+        finally:
+            tracemalloc.stop()
+        self.assertGreaterEqual(recorder.records[0]['peak_alloc_bytes'], 10 ** 6)
+        del block
+
+
+def main() -> None:
+    unittest.main()
+
+if __name__ == "__main__":
+    main()
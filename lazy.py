@@ -0,0 +1,46 @@
+import importlib
+import sys
+from types import ModuleType
+
+
+class LazyModule:
+    """
+    Stand-in for a module that is imported on first attribute access.
+
+    The stand-in is not registered in sys.modules, so code scanning the loaded modules (inspect.getmodule,
+    warnings) never triggers the import by accident; the module itself goes through the regular import.
+    """
+    def __init__(self, name: str):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self) -> ModuleType:
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr: str, value) -> None:
+        setattr(self._load(), attr, value)
+
+    def __repr__(self) -> str:
+        return '<lazy module ' + repr(self._name) + '>'
+
+
+def lazy_import(name: str) -> LazyModule:
+    """
+    Import a module only when one of its attributes is first used.
+
+    Heavy backends (riskfolio, cvxpy, prophet, matplotlib) are imported this way at module level, so
+    importing a step script stays cheap and a backend is loaded only by the code that uses it.
+    """
+    return LazyModule(name)
+
+
+def is_loaded(name: str) -> bool:
+    """
+    Tell whether a module has actually been imported.
+    """
+    return name in sys.modules
@@ -1,27 +0,0 @@
-# You'll add fit and predict methods to this minimal class
-class BoostedHybrid:
-    def __init__(self, model_1, model_2):
-        self.model_1 = model_1
-        self.model_2 = model_2
-        self.y_columns = None  # store column names from fit method
-        def fit(self, X_1, X_2, y):
-        # Train model_1
-        self.model_1.fit(X_1, y)
-
-        # Make predictions
-        y_fit = pd.DataFrame(
-            self.model_1.predict(X_1), 
-            index=X_1.index, columns=y.columns,)
-
-            # Compute residuals
-            y_resid = y - y_fit
-            y_resid = y_resid.stack().squeeze() # wide to long
-
-            # Train model_2 on residuals
-            self.model_2.fit(X_2, y_resid)
-    
-    # Save column names for predict method
-    self.y_columns = y.columns
-    # Save data for question checking
-    self.y_fit = y_fit
-    self.y_resid = y_resid
\ No newline at end of file
@@ -0,0 +1,142 @@
+from typing import Tuple
+import pandas as pd
+import numpy as np
+import unittest
+
+from models.numpy_models import HoltModel, VectorizedModel
+
+
+class BoostedHybrid(VectorizedModel):
+    """
+    Hybrid forecaster: a trend regression on time features plus a residual model learned across tickers.
+
+    The trend stage regresses every ticker on the same deterministic features (polynomial time trend
+    and optional Fourier seasonality) in one least-squares solve, or with model_1, any regressor accepting
+    a multi-output target. The residuals are standardized per ticker, stacked into one long table of
+    lagged residuals for the whole universe and used to train a single model_2, a gradient boosting
+    regressor by default. Forecasts extend the trend and feed the residual forecasts back as lags,
+    predicting every ticker in one model_2 call per step. The intervals use the standard deviation of
+    the in-sample one-step errors, growing with the square root of the horizon.
+    """
+    def __init__(self, model_1=None, model_2=None, lags: int = 5, order: int = 1, fourier: int = 0,
+                 period: float = 252):
+        """
+        :param model_1: Trend regressor with fit(X, Y) and predict(X) for a (dates, tickers) target. Default is least squares.
+        :param model_2: Residual regressor with fit(X, y) and predict(X). Default is sklearn's HistGradientBoostingRegressor.
+        :param lags: Number of lagged residuals used as features by model_2.
+        :param order: Degree of the polynomial time trend.
+        :param fourier: Number of Fourier pairs of the seasonality.
+        :param period: Seasonality period, in observations.
+        """
+        super().__init__()
+        self.model_1 = model_1
+        self.model_2 = model_2
+        self.lags = lags
+        self.order = order
+        self.fourier = fourier
+        self.period = period
+
+    def _trend_features(self, t: np.ndarray) -> np.ndarray:
+        scaled = t / max(self.n_obs - 1, 1)
+        columns = [scaled ** k for k in range(self.order + 1)]
+        for k in range(1, self.fourier + 1):
+            angle = 2 * np.pi * k * t / self.period
+            columns += [np.sin(angle), np.cos(angle)]
+        return np.stack(columns, axis=1)
+
+    def _trend(self, features: np.ndarray) -> np.ndarray:
+        if self.model_1 is None:
+            return features @ self.coefficients
+        return np.asarray(self.model_1.predict(features)).reshape(len(features), -1)
+
+    def _lagged(self, z: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # Long format: one row per (date, ticker), the most recent lag first
+        windows = np.lib.stride_tricks.sliding_window_view(z, self.lags + 1, axis=0)
+        return windows[..., -2::-1].reshape(-1, self.lags), windows[..., -1].ravel()
+
+    def _fit(self, values: np.ndarray) -> None:
+        n_features = self.order + 1 + 2 * self.fourier
+        if len(values) <= max(self.lags, n_features) + 1:
+            raise ValueError("not enough observations for " + str(self.lags) + " lags and " +
+                             str(n_features) + " trend features")
+        self.n_obs = len(values)
+        features = self._trend_features(np.arange(self.n_obs))
+        if self.model_1 is None:
+            self.coefficients = np.linalg.lstsq(features, values, rcond=None)[0]
+        else:
+            self.model_1.fit(features, values)
+        residuals = values - self._trend(features)
+
+        self.scale = residuals.std(axis=0)
+        self.scale[self.scale == 0] = 1
+        z = residuals / self.scale
+        if self.model_2 is None:
+            from sklearn.ensemble import HistGradientBoostingRegressor
+            self.model_2 = HistGradientBoostingRegressor(early_stopping=False, random_state=0)
+        lagged, target = self._lagged(z)
+        self.model_2.fit(lagged, target)
+
+        errors = (target - self.model_2.predict(lagged)).reshape(-1, values.shape[1]) * self.scale
+        self.sigma = np.sqrt((errors ** 2).mean(axis=0))
+        self.recent = z[-self.lags:][::-1].T
+
+    def _predict(self, periods: int) -> Tuple[np.ndarray, np.ndarray]:
+        trend = self._trend(self._trend_features(np.arange(self.n_obs, self.n_obs + periods)))
+        history = self.recent.copy()
+        z = np.empty((periods, history.shape[0]))
+        for h in range(periods):
+            z[h] = self.model_2.predict(history)
+            history = np.concatenate([z[h][:, None], history[:, :-1]], axis=1)
+        std = self.sigma * np.sqrt(np.arange(1, periods + 1))[:, None]
+        return trend + z * self.scale, std
+
+
+# Test cases for the boosted hybrid forecaster
+class TestBoostedHybrid(unittest.TestCase):
+    def setUp(self) -> None:
+        # Linear trends plus AR(1) deviations with a different scale per ticker
+        rng = np.random.default_rng(0)
+        n_obs, n_tickers = 600, 20
+        deviations = np.zeros((n_obs, n_tickers))
+        for t in range(1, n_obs):
+            deviations[t] = 0.9 * deviations[t - 1] + rng.normal(size=n_tickers)
+        slopes = rng.uniform(0.01, 0.1, n_tickers)
+        scales = rng.uniform(0.5, 3, n_tickers)
+        values = 100 + np.arange(n_obs)[:, None] * slopes + deviations * scales
+        self.data = pd.DataFrame(values, index=pd.date_range('2020-01-01', periods=n_obs),
+                                 columns=['T' + str(i) for i in range(n_tickers)])
+
+    def test_shapes(self) -> None:
+        model = BoostedHybrid()
+        model.fit(self.data)
+        values, widths = model.predict(10)
+        self.assertEqual(values.shape, (10, 20))
+        self.assertTrue((np.diff(widths, axis=0) > 0).all())
+        model.fit(self.data[['T0']])
+        values, widths = model.predict(10)
+        self.assertEqual(values.shape, (10,))
+
+    def test_beats_holt_on_mean_reverting_residuals(self) -> None:
+        train, test = self.data.iloc[:-5], self.data.iloc[-5:].to_numpy()
+        errors = {}
+        for name, model in [('hybrid', BoostedHybrid()), ('holt', HoltModel())]:
+            model.fit(train)
+            errors[name] = np.abs(model.predict(5)[0] - test).mean()
+        self.assertLess(errors['hybrid'], errors['holt'])
+
+    def test_custom_trend_model(self) -> None:
+        from sklearn.linear_model import LinearRegression
+        default, custom = BoostedHybrid(fourier=2), BoostedHybrid(model_1=LinearRegression(fit_intercept=False), fourier=2)
+        default.fit(self.data)
+        custom.fit(self.data)
+        np.testing.assert_allclose(custom.predict(5)[0], default.predict(5)[0], rtol=1e-6)
+
+    def test_short_series(self) -> None:
+        self.assertRaises(ValueError, BoostedHybrid(lags=5).fit, self.data.iloc[:6])
+
+
+def main() -> None:
+    unittest.main()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import unittest
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+
+# Prophet is imported on first use, so creating a cache stays cheap
+def _prophet_dumps(model) -> str:
+    from prophet.serialize import model_to_json
+    return model_to_json(model)
+
+
+def _prophet_loads(text: str):
+    from prophet.serialize import model_from_json
+    return model_from_json(text)
+
+
+class ModelCache:
+    """
+    Cache of fitted models keyed by ticker, training data fingerprint and model hyperparameters.
+
+    An in-process LRU layer sits over an on-disk store of serialized models. The disk store is
+    bounded in bytes and evicts the least recently used files first.
+    """
+    def __init__(self, directory: str, max_bytes: int = 512 * 1024 ** 2, max_items: int = 64,
+                 dumps: Optional[Callable[[object], str]] = None, loads: Optional[Callable[[str], object]] = None):
+        """
+        :param directory: Directory of the on-disk store.
+        :param max_bytes: Maximum total size of the on-disk store.
+        :param max_items: Maximum number of models kept in memory.
+        :param dumps: Model serializer returning a string. Defaults to Prophet's JSON serialization.
+        :param loads: Inverse of dumps.
+        """
+        if dumps is None or loads is None:
+            dumps, loads = _prophet_dumps, _prophet_loads
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.dumps = dumps
+        self.loads = loads
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(ticker: str, fingerprint: str, params: Optional[Dict] = None) -> str:
+        digest = hashlib.sha1(json.dumps([fingerprint, params or {}], sort_keys=True).encode()).hexdigest()
+        return ticker + '--' + digest
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, ticker: str, fingerprint: str, params: Optional[Dict] = None):
+        """
+        Return the cached model, or None on a miss.
+        """
+        key = self.key(ticker, fingerprint, params)
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key]
+
+        path = self._path(key)
+        if os.path.exists(path):
+            with open(path) as f:
+                model = self.loads(f.read())
+            os.utime(path)
+            self._remember(key, model)
+            self.disk_hits += 1
+            return model
+
+        self.misses += 1
+        return None
+
+    def put(self, ticker: str, fingerprint: str, model, params: Optional[Dict] = None, persist: bool = True) -> None:
+        """
+        Add a model to the memory layer and, if persist is True, to the on-disk store.
+        """
+        key = self.key(ticker, fingerprint, params)
+        self._remember(key, model)
+        if persist:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.dumps(model))
+            os.replace(tmp_path, self._path(key))
+            self._evict()
+
+    def latest(self, ticker: str):
+        """
+        Return the most recently used model of a ticker regardless of its data, or None.
+
+        Used to warm-start a refit when the data has changed.
+        """
+        for key in reversed(self.memory):
+            if key.startswith(ticker + '--'):
+                return self.memory[key]
+        if not os.path.exists(self.directory):
+            return None
+        files = [f for f in os.listdir(self.directory) if f.startswith(ticker + '--') and f.endswith('.json')]
+        if not files:
+            return None
+        newest = max(files, key=lambda f: os.path.getmtime(os.path.join(self.directory, f)))
+        with open(os.path.join(self.directory, newest)) as f:
+            return self.loads(f.read())
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses}
+
+    def _remember(self, key: str, model) -> None:
+        self.memory[key] = model
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_items:
+            self.memory.popitem(last=False)
+
+    def _evict(self) -> None:
+        paths = [os.path.join(self.directory, f) for f in os.listdir(self.directory) if f.endswith('.json')]
+        paths.sort(key=os.path.getmtime)
+        total = sum(os.path.getsize(p) for p in paths)
+        while paths and total > self.max_bytes:
+            path = paths.pop(0)
+            total -= os.path.getsize(path)
+            os.remove(path)
+
+
+# Test cases for ModelCache
+class TestModelCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        self.cache = ModelCache(self.directory, max_items=2, dumps=json.dumps, loads=json.loads)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.directory)
+
+    def test_memory_and_disk_hits(self) -> None:
+        self.cache.put('AAPL', 'abc', {'k': 1})
+        self.assertEqual(self.cache.get('AAPL', 'abc'), {'k': 1})
+        self.cache.memory.clear()
+        self.assertEqual(self.cache.get('AAPL', 'abc'), {'k': 1})
+        self.assertIsNone(self.cache.get('AAPL', 'other'))
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'disk_hits': 1, 'misses': 1})
+
+    def test_params_are_part_of_the_key(self) -> None:
+        self.cache.put('AAPL', 'abc', {'k': 1}, params={'n_changepoints': 10})
+        self.assertIsNone(self.cache.get('AAPL', 'abc'))
+        self.assertEqual(self.cache.get('AAPL', 'abc', params={'n_changepoints': 10}), {'k': 1})
+
+    def test_memory_lru_eviction(self) -> None:
+        for i in range(3):
+            self.cache.put('AAPL', str(i), {'k': i}, persist=False)
+        self.assertEqual(len(self.cache.memory), 2)
+        self.assertIsNone(self.cache.get('AAPL', '0'))
+
+    def test_disk_size_eviction(self) -> None:
+        self.cache.max_bytes = 30
+        for i in range(3):
+            self.cache.put('AAPL', str(i), {'k': 'x' * 10})
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+    def test_latest(self) -> None:
+        self.cache.put('AAPL', 'old', {'k': 1})
+        self.cache.put('AAPL', 'new', {'k': 2})
+        self.cache.memory.clear()
+        os.utime(self.cache._path(self.cache.key('AAPL', 'old')), (0, 0))
+        self.assertEqual(self.cache.latest('AAPL'), {'k': 2})
+        self.assertIsNone(self.cache.latest('MSFT'))
+
+
+def main() -> None:
+    unittest.main()
+
+if __name__ == "__main__":
+    main()
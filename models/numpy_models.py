@@ -0,0 +1,212 @@
+from typing import Tuple
+import pandas as pd
+import numpy as np
+import unittest
+
+from models.base_model import BaseModel
+
+# Quantile of the standard normal for an 80% interval, Prophet's default interval_width.
+Z_80 = 1.2815515655446004
+
+
+class VectorizedModel(BaseModel):
+    """
+    Base class of the NumPy forecasters, fitted on every column of a wide (dates x tickers) frame at once.
+
+    predict returns arrays of shape (periods,) when fitted on a single series and (periods, tickers)
+    otherwise. As for ProphetModel, the volatilities are the widths of the 80% prediction intervals.
+    """
+    def __init__(self):
+        super().__init__()
+        self.columns = None
+
+    def fit(self, data: pd.DataFrame) -> None:
+        """
+        Fit the model with given data.
+
+        :param data: Input data to train the model, one column per series, without missing values.
+        """
+        values = np.asarray(data, dtype=float)
+        if values.ndim == 1:
+            values = values[:, None]
+        if np.isnan(values).any():
+            raise ValueError("data must not contain missing values")
+        self._fit(values)
+        self.columns = list(data.columns) if isinstance(data, pd.DataFrame) else [0]
+
+    def predict(self, periods: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Predict using the trained model.
+
+        :param periods: Number of periods to forecast.
+        :return: Tuple containing predicted values and prediction interval widths.
+        """
+        if self.columns is None:
+            raise ValueError("Model has not been fitted yet.")
+        mean, std = self._predict(periods)
+        width = 2 * Z_80 * std
+        if len(self.columns) == 1:
+            return mean[:, 0], width[:, 0]
+        return mean, width
+
+    def _fit(self, values: np.ndarray) -> None:
+        raise NotImplementedError
+
+    def _predict(self, periods: int) -> Tuple[np.ndarray, np.ndarray]:
+        raise NotImplementedError
+
+
+class EWMAModel(VectorizedModel):
+    """
+    Simple exponential smoothing: flat forecast at the exponentially weighted level.
+    """
+    def __init__(self, alpha: float = 0.1):
+        super().__init__()
+        self.alpha = alpha
+
+    def _fit(self, values: np.ndarray) -> None:
+        level = values[0].copy()
+        squared_errors = np.zeros(values.shape[1])
+        for y in values[1:]:
+            error = y - level
+            squared_errors += error ** 2
+            level += self.alpha * error
+        self.level = level
+        self.sigma = np.sqrt(squared_errors / max(len(values) - 1, 1))
+
+    def _predict(self, periods: int) -> Tuple[np.ndarray, np.ndarray]:
+        h = np.arange(1, periods + 1)[:, None]
+        mean = np.repeat(self.level[None, :], periods, axis=0)
+        std = self.sigma * np.sqrt(1 + (h - 1) * self.alpha ** 2)
+        return mean, std
+
+
+class HoltModel(VectorizedModel):
+    """
+    Holt's linear trend exponential smoothing.
+    """
+    def __init__(self, alpha: float = 0.1, beta: float = 0.01):
+        super().__init__()
+        self.alpha = alpha
+        self.beta = beta
+
+    def _fit(self, values: np.ndarray) -> None:
+        if len(values) < 2:
+            raise ValueError("Holt's model needs at least two observations")
+        level = values[0].copy()
+        trend = values[1] - values[0]
+        squared_errors = np.zeros(values.shape[1])
+        for y in values[1:]:
+            error = y - (level + trend)
+            squared_errors += error ** 2
+            level = level + trend + self.alpha * error
+            trend = trend + self.alpha * self.beta * error
+        self.level = level
+        self.trend = trend
+        self.sigma = np.sqrt(squared_errors / (len(values) - 1))
+
+    def _predict(self, periods: int) -> Tuple[np.ndarray, np.ndarray]:
+        h = np.arange(1, periods + 1)[:, None]
+        mean = self.level + h * self.trend
+        # Error correction form: the h-step variance is sigma^2 * (1 + sum_{j<h} (alpha + j * alpha * beta)^2)
+        c = self.alpha * (1 + np.arange(periods) * self.beta)
+        c[0] = 0
+        std = self.sigma * np.sqrt(1 + np.cumsum(c ** 2))[:, None]
+        return mean, std
+
+
+class ARModel(VectorizedModel):
+    """
+    Autoregressive model with drift on the first differences, fitted by batched least squares.
+    """
+    def __init__(self, lags: int = 5):
+        super().__init__()
+        self.lags = lags
+
+    def _fit(self, values: np.ndarray) -> None:
+        p = self.lags
+        diffs = np.diff(values, axis=0)
+        if len(diffs) <= 2 * p + 1:
+            raise ValueError("not enough observations for " + str(p) + " lags")
+
+        # Design matrices of every series stacked as (series, observations, 1 + lags)
+        target = diffs[p:].T
+        lagged = np.stack([diffs[p - i:len(diffs) - i] for i in range(1, p + 1)], axis=-1)
+        design = np.concatenate([np.ones(lagged.shape[:2] + (1,)), lagged], axis=-1).transpose(1, 0, 2)
+        gram = np.einsum('nti,ntj->nij', design, design)
+        moment = np.einsum('nti,nt->ni', design, target)
+        coefficients = np.linalg.solve(gram, moment[..., None])[..., 0]
+        residuals = target - np.einsum('nti,ni->nt', design, coefficients)
+
+        self.intercept = coefficients[:, 0]
+        self.phi = coefficients[:, 1:]
+        self.sigma = np.sqrt((residuals ** 2).sum(axis=1) / (target.shape[1] - p - 1))
+        self.last_value = values[-1]
+        self.recent_diffs = diffs[-p:][::-1].T
+
+    def _predict(self, periods: int) -> Tuple[np.ndarray, np.ndarray]:
+        history = self.recent_diffs.copy()
+        steps = np.empty((periods, len(self.intercept)))
+        for h in range(periods):
+            steps[h] = self.intercept + (self.phi * history).sum(axis=1)
+            history = np.concatenate([steps[h][:, None], history[:, :-1]], axis=1)
+        mean = self.last_value + np.cumsum(steps, axis=0)
+
+        # psi weights of the differences, accumulated to get those of the level
+        psi = np.zeros((periods, len(self.intercept)))
+        psi[0] = 1
+        for j in range(1, periods):
+            k = min(j, self.lags)
+            psi[j] = (self.phi[:, :k] * psi[j - 1::-1][:k].T).sum(axis=1)
+        std = self.sigma * np.sqrt(np.cumsum(np.cumsum(psi, axis=0) ** 2, axis=0))
+        return mean, std
+
+
+# Test cases for the NumPy forecasters
+class TestNumpyModels(unittest.TestCase):
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        index = pd.date_range(start='2020-01-01', periods=300)
+        self.data = pd.DataFrame(100 + np.cumsum(rng.normal(0.1, 1, size=(300, 4)), axis=0),
+                                 index=index, columns=['A', 'B', 'C', 'D'])
+
+    def test_shapes(self) -> None:
+        for model in [EWMAModel(), HoltModel(), ARModel()]:
+            model.fit(self.data)
+            values, volatilities = model.predict(10)
+            self.assertEqual(values.shape, (10, 4))
+            self.assertTrue((np.diff(volatilities, axis=0) >= 0).all())
+            model.fit(self.data[['A']])
+            values, volatilities = model.predict(10)
+            self.assertEqual(values.shape, (10,))
+
+    def test_predict_before_fit(self) -> None:
+        self.assertRaises(ValueError, ARModel().predict, 10)
+
+    def test_missing_values(self) -> None:
+        data = self.data.copy()
+        data.iloc[3, 1] = np.nan
+        self.assertRaises(ValueError, HoltModel().fit, data)
+
+    def test_linear_trend(self) -> None:
+        line = pd.DataFrame({'y': 2.0 * np.arange(100)})
+        model = HoltModel()
+        model.fit(line)
+        values, _ = model.predict(5)
+        np.testing.assert_allclose(values, 2.0 * np.arange(100, 105))
+
+    def test_ar_recovers_coefficient(self) -> None:
+        rng = np.random.default_rng(1)
+        diffs = np.zeros(5000)
+        for t in range(1, 5000):
+            diffs[t] = 0.5 * diffs[t - 1] + rng.normal()
+        model = ARModel(lags=1)
+        model.fit(pd.DataFrame({'y': np.cumsum(diffs)}))
+        self.assertAlmostEqual(model.phi[0, 0], 0.5, delta=0.05)
+
+
+def main() -> None:
+    unittest.main()
+
+if __name__ == "__main__":
+    main()
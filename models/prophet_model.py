@@ -1,26 +1,103 @@
+import hashlib
 import pandas as pd
 import numpy as np
 from prophet import Prophet
-from typing import Tuple
+from typing import Dict, Optional, Tuple
 import unittest
 
 from models.base_model import BaseModel
 
+
+def data_fingerprint(data: pd.DataFrame) -> str:
+    """
+    Hash the content of a training frame, index included.
+
+    :param data: Training data.
+    :return: Hex digest identifying the data.
+    """
+    return hashlib.sha1(pd.util.hash_pandas_object(data, index=True).values.tobytes()).hexdigest()
+
+
+def _structure(model: Prophet) -> Tuple:
+    # Settings that determine the meaning and the shapes of the fitted parameters
+    return (model.growth, model.n_changepoints, model.changepoint_range, model.seasonality_mode,
+            dict(model.seasonalities), dict(model.extra_regressors), getattr(model, 'scaling', None))
+
+
+def warm_start_params(previous: Prophet, df: pd.DataFrame, params: Optional[Dict] = None) -> Optional[Dict[str, object]]:
+    """
+    Extract the fitted parameters of a previous Prophet model as initial values of Prophet.fit(init=...) on df.
+
+    k, m, delta and beta are expressed in the scaled units of the previous fit, so they are only reused
+    when the new model has the same structure (growth, changepoints, seasonalities and regressors) and
+    df extends the previous history from the same start with the same y scale; the slopes are rescaled
+    to the longer time scale. Otherwise None is returned and the model should be fitted from scratch.
+
+    :param previous: A fitted Prophet model.
+    :param df: Training data of the new fit, with 'ds' and 'y' columns.
+    :param params: Keyword arguments of Prophet() for the new fit.
+    :return: Dictionary of initial values for the Stan optimizer, or None.
+    """
+    if not getattr(previous, 'params', None) or previous.history is None:
+        return None
+    probe = Prophet(**(params or {}))
+    inputs = probe.preprocess(df)
+    history, extended = previous.history, probe.history
+    if (_structure(probe) != _structure(previous) or probe.start != previous.start
+            or probe.y_scale != previous.y_scale or len(extended) < len(history)
+            or inputs.S != previous.params['delta'].shape[1] or inputs.K != previous.params['beta'].shape[1]
+            or not (extended['ds'].iloc[:len(history)].to_numpy() == history['ds'].to_numpy()).all()
+            or not np.allclose(extended['y'].iloc[:len(history)].to_numpy(), history['y'].to_numpy())):
+        return None
+
+    ratio = probe.t_scale / previous.t_scale
+    return {'m': previous.params['m'][0][0], 'sigma_obs': previous.params['sigma_obs'][0][0],
+            'k': previous.params['k'][0][0] * ratio, 'delta': previous.params['delta'][0] * ratio,
+            'beta': previous.params['beta'][0]}
+
+
+def fit_prophet(df: pd.DataFrame, previous: Prophet = None, params: Optional[Dict] = None) -> Prophet:
+    """
+    Fit a new Prophet model, warm-started from a previous fit when its parameters apply (see warm_start_params).
+
+    :param df: Training data with 'ds' and 'y' columns.
+    :param previous: Previously fitted model whose parameters initialise the optimizer.
+    :param params: Keyword arguments of Prophet(), e.g. {'changepoint_prior_scale': 0.5}.
+    :return: The fitted model, tagged with the fingerprint of its training data.
+    """
+    model = Prophet(**(params or {}))
+    init = None if previous is None else warm_start_params(previous, df, params)
+    if init is not None:
+        model.fit(df, init=init)
+    else:
+        model.fit(df)
+    model.data_hash = data_fingerprint(df)
+    return model
+
+
 class ProphetModel(BaseModel):
-    def __init__(self):
+    def __init__(self, **params):
+        """
+        :param params: Keyword arguments of Prophet(), e.g. changepoint_prior_scale or seasonality_mode.
+        """
         super().__init__()
+        self.params = params
         self.model = None
 
     def fit(self, data: pd.DataFrame) -> None:
         """
         Fit the model with given data.
 
+        Refitting on unchanged data is a no-op, and refitting on new data starts the optimizer
+        from the previous fit's parameters.
+
         :param data: Input data to train the model.
         """
         df = data.reset_index()
         df.columns = ['ds', 'y']
-        self.model = Prophet()
-        self.model.fit(df)
+        if self.model is not None and getattr(self.model, 'data_hash', None) == data_fingerprint(df):
+            return
+        self.model = fit_prophet(df, previous=self.model, params=self.params)
 
     def predict(self, periods: int) -> Tuple[np.ndarray, np.ndarray]:
         """
@@ -32,10 +109,10 @@ class ProphetModel(BaseModel):
         if self.model is None:
             raise ValueError("Model has not been fitted yet.")
 
-        future = self.model.make_future_dataframe(periods=periods)
+        future = self.model.make_future_dataframe(periods=periods, include_history=False)
         forecast = self.model.predict(future)
-        predicted_returns = forecast['yhat'].values[-periods:]
-        predicted_volatilities = forecast['yhat_upper'].values[-periods:] - forecast['yhat_lower'].values[-periods:]
+        predicted_returns = forecast['yhat'].values
+        predicted_volatilities = forecast['yhat_upper'].values - forecast['yhat_lower'].values
         return predicted_returns, predicted_volatilities
 
 # Test cases for ProphetModel
@@ -54,6 +131,40 @@ class TestProphetModel(unittest.TestCase):
         self.assertEqual(len(returns), 10)
         self.assertEqual(len(volatilities), 10)
 
+    def test_params(self) -> None:
+        model = ProphetModel(changepoint_prior_scale=0.01, interval_width=0.9)
+        model.fit(self.data)
+        self.assertEqual(model.model.changepoint_prior_scale, 0.01)
+        self.assertEqual(model.model.interval_width, 0.9)
+
+    def test_refit_unchanged_data_is_skipped(self) -> None:
+        self.prophet_model.fit(self.data)
+        fitted = self.prophet_model.model
+        self.prophet_model.fit(self.data.copy())
+        self.assertIs(self.prophet_model.model, fitted)
+
+    def test_refit_new_data_is_warm_started(self) -> None:
+        self.prophet_model.fit(self.data)
+        fitted = self.prophet_model.model
+        extended = pd.concat([self.data, pd.DataFrame({'y': [0.5]}, index=[pd.Timestamp('2020-04-10')])])
+        self.prophet_model.fit(extended)
+        self.assertIsNot(self.prophet_model.model, fitted)
+        self.assertEqual(len(self.prophet_model.model.history), 101)
+
+    def test_warm_start_only_when_compatible(self) -> None:
+        self.prophet_model.fit(self.data)
+        fitted = self.prophet_model.model
+        frame = lambda data: data.reset_index().set_axis(['ds', 'y'], axis=1)
+        next_day = pd.Timestamp('2020-04-10')
+        init = warm_start_params(fitted, frame(pd.concat([self.data, pd.DataFrame({'y': [0.0]}, index=[next_day])])))
+        self.assertEqual(init['beta'].shape, fitted.params['beta'][0].shape)
+        self.assertGreater(abs(init['k']), abs(fitted.params['k'][0][0]))
+        # A new y scale, other seasonalities or a history that is not extended need a cold fit
+        higher = pd.concat([self.data, pd.DataFrame({'y': [100.0]}, index=[next_day])])
+        self.assertIsNone(warm_start_params(fitted, frame(higher)))
+        self.assertIsNone(warm_start_params(fitted, frame(self.data), {'weekly_seasonality': False}))
+        self.assertIsNone(warm_start_params(fitted, frame(self.data.iloc[1:])))
+
 def main() -> None:
     unittest.main()
 
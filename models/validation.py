@@ -0,0 +1,203 @@
+import hashlib
+import json
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from typing import Callable, Dict, List, Optional, Tuple
+import numpy as np
+import pandas as pd
+
+from models.base_model import BaseModel
+
+METRICS = ('mape', 'rmse', 'coverage')
+
+# Scores of the folds already evaluated in this process, keyed by fold_key
+fold_cache: Dict[str, Tuple[float, float, float]] = {}
+
+
+def rolling_origins(n_obs: int, initial: int, horizon: int, period: int) -> List[int]:
+    """
+    Cutoffs of a rolling-origin evaluation: each fold trains on the first cutoff rows and tests on the next horizon.
+    """
+    return list(range(initial, n_obs - horizon + 1, period))
+
+
+def expand_params(param_grid: Dict[str, list]) -> List[Dict]:
+    """
+    Expand lists of hyperparameter values into every combination.
+    """
+    keys = sorted(param_grid)
+    return [dict(zip(keys, values)) for values in product(*(param_grid[key] for key in keys))]
+
+
+def fold_key(model_factory: Callable, params: Dict, series: pd.DataFrame, cutoff: int, horizon: int) -> str:
+    """
+    Identify a fold by the model, its hyperparameters, the training and test data and the horizon.
+    """
+    digest = hashlib.sha1()
+    digest.update(repr((model_factory.__module__, model_factory.__qualname__, horizon, cutoff)).encode())
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+    digest.update(pd.util.hash_pandas_object(series.iloc[:cutoff + horizon], index=True).values.tobytes())
+    return digest.hexdigest()
+
+
+def score_fold(model_factory: Callable[..., BaseModel], params: Dict, train: pd.DataFrame,
+               actual: np.ndarray) -> Tuple[float, float, float]:
+    """
+    Fit a fresh model on the training data and score its forecast of the actual values.
+
+    :return: MAPE, RMSE and the share of actual values inside the prediction interval.
+    """
+    model = model_factory(**params)
+    model.fit(train)
+    predicted, width = model.predict(len(actual))
+    predicted, width = np.ravel(predicted), np.ravel(width)
+    error = actual - predicted
+    return (float(np.mean(np.abs(error / actual))),
+            float(np.sqrt(np.mean(error ** 2))),
+            float(np.mean(np.abs(error) <= width / 2)))
+
+
+def _score_folds(model_factory: Callable[..., BaseModel], params: Dict, series: pd.DataFrame, cutoffs: List[int],
+                 horizon: int) -> List[Tuple[float, float, float]]:
+    return [score_fold(model_factory, params, series.iloc[:cutoff], series.iloc[cutoff:cutoff + horizon].to_numpy().ravel())
+            for cutoff in cutoffs]
+
+
+def cross_validate(prices: pd.DataFrame, model_factory: Callable[..., BaseModel], param_grid: Dict[str, list],
+                   initial: int = 750, horizon: int = 30, period: int = 90, workers: int = 1,
+                   stop_ratio: Optional[float] = 1.5, min_folds: int = 2) -> pd.DataFrame:
+    """
+    Rolling-origin cross-validation of a grid of hyperparameters, for every ticker of a price panel.
+
+    Every (ticker, hyperparameters, cutoff) fold fits a fresh model_factory(**params) on the data up to
+    the cutoff and scores its forecast of the next horizon rows. The folds run in parallel processes in
+    two rounds: the first min_folds cutoffs of every configuration, then the remaining cutoffs of the
+    configurations whose MAPE so far is within stop_ratio times the best of their ticker; the others are
+    stopped early. Fold scores are cached in fold_cache, so re-running a search only fits the new folds.
+
+    Args:
+        prices (pd.DataFrame): Prices indexed by date, one column per ticker.
+        model_factory (callable): BaseModel class, or any picklable callable returning one, e.g. ProphetModel.
+        param_grid (dict): Lists of hyperparameter values keyed by keyword argument of model_factory.
+        initial (int): Number of rows of the first training window.
+        horizon (int): Number of rows forecast by each fold.
+        period (int): Number of rows between consecutive cutoffs.
+        workers (int): Number of worker processes.
+        stop_ratio (float, optional): Early stopping threshold; None evaluates every fold.
+        min_folds (int): Number of folds evaluated before early stopping applies.
+
+    Returns:
+        pd.DataFrame: One row per ticker and configuration with the hyperparameters, the number of
+                      folds evaluated, whether the configuration was stopped early, and the mean MAPE,
+                      RMSE and coverage over its folds.
+    """
+    configs = expand_params(param_grid)
+    series = {ticker: prices[[ticker]].dropna() for ticker in prices.columns}
+    cutoffs = {ticker: rolling_origins(len(data), initial, horizon, period) for ticker, data in series.items()}
+    scores: Dict[Tuple[str, int], Dict[int, Tuple[float, float, float]]] = {
+        (ticker, i): {} for ticker in series for i in range(len(configs))}
+
+    def evaluate(tasks: List[Tuple[str, int, List[int]]]) -> None:
+        # Cached folds are reused; the rest are grouped per (ticker, configuration) and spread over the workers
+        pending = []
+        for ticker, i, fold_cutoffs in tasks:
+            missing = []
+            for cutoff in fold_cutoffs:
+                key = fold_key(model_factory, configs[i], series[ticker], cutoff, horizon)
+                if key in fold_cache:
+                    scores[(ticker, i)][cutoff] = fold_cache[key]
+                else:
+                    missing.append(cutoff)
+            if missing:
+                pending.append((ticker, i, missing))
+
+        if workers > 1 and len(pending) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(_score_folds, model_factory, configs[i], series[ticker], missing, horizon)
+                           for ticker, i, missing in pending]
+                results = [future.result() for future in futures]
+        else:
+            results = [_score_folds(model_factory, configs[i], series[ticker], missing, horizon)
+                       for ticker, i, missing in pending]
+
+        for (ticker, i, missing), fold_scores in zip(pending, results):
+            for cutoff, score in zip(missing, fold_scores):
+                fold_cache[fold_key(model_factory, configs[i], series[ticker], cutoff, horizon)] = score
+                scores[(ticker, i)][cutoff] = score
+
+    evaluate([(ticker, i, cutoffs[ticker][:min_folds]) for ticker in series for i in range(len(configs))])
+
+    stopped = set()
+    if stop_ratio is not None:
+        for ticker in series:
+            mapes = {i: np.mean([score[0] for score in scores[(ticker, i)].values()]) for i in range(len(configs))}
+            best = min(mapes.values())
+            stopped.update((ticker, i) for i, value in mapes.items() if value > stop_ratio * best)
+    evaluate([(ticker, i, cutoffs[ticker][min_folds:]) for ticker in series for i in range(len(configs))
+              if (ticker, i) not in stopped])
+
+    rows = []
+    for (ticker, i), fold_scores in scores.items():
+        values = np.array(list(fold_scores.values())).reshape(-1, len(METRICS))
+        row = {'ticker': ticker, **configs[i], 'folds': len(fold_scores), 'stopped': (ticker, i) in stopped}
+        row.update(zip(METRICS, values.mean(axis=0) if len(values) else [np.nan] * len(METRICS)))
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def best_params(table: pd.DataFrame, metric: str = 'mape') -> pd.DataFrame:
+    """
+    Best configuration of every ticker among the ones evaluated on every fold.
+    """
+    complete = table[~table['stopped']]
+    return complete.loc[complete.groupby('ticker')[metric].idxmin()].set_index('ticker')
+
+
+# Test cases for the cross-validation harness
+class TestCrossValidation(unittest.TestCase):
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        trend = np.linspace(100, 160, 600)[:, None]
+        noise = np.cumsum(rng.normal(0, 0.5, size=(600, 2)), axis=0)
+        self.prices = pd.DataFrame(trend + noise, index=pd.date_range('2018-01-01', periods=600), columns=['A', 'B'])
+        fold_cache.clear()
+
+    def test_rolling_origins(self) -> None:
+        self.assertEqual(rolling_origins(100, 50, 10, 20), [50, 70, 90])
+
+    def test_grid_search(self) -> None:
+        from models.numpy_models import HoltModel
+        grid = {'alpha': [0.05, 0.5], 'beta': [0.0001, 0.9]}
+        table = cross_validate(self.prices, HoltModel, grid, initial=300, horizon=20, period=50, workers=2,
+                               stop_ratio=1.5, min_folds=2)
+        self.assertEqual(len(table), 2 * 4)
+        self.assertEqual(set(table.columns), {'ticker', 'alpha', 'beta', 'folds', 'stopped'} | set(METRICS))
+        n_folds = len(rolling_origins(600, 300, 20, 50))
+        self.assertTrue((table.loc[~table['stopped'], 'folds'] == n_folds).all())
+        self.assertTrue((table.loc[table['stopped'], 'folds'] == 2).all())
+        self.assertTrue(table['stopped'].any())
+        self.assertTrue(table['coverage'].between(0, 1).all())
+        self.assertEqual(list(best_params(table).index), ['A', 'B'])
+
+        # Re-running reuses every cached fold and gives the same table
+        cached = len(fold_cache)
+        pd.testing.assert_frame_equal(cross_validate(self.prices, HoltModel, grid, initial=300, horizon=20,
+                                                     period=50, stop_ratio=1.5, min_folds=2), table)
+        self.assertEqual(len(fold_cache), cached)
+
+    def test_parallel_matches_serial(self) -> None:
+        from models.numpy_models import EWMAModel
+        grid = {'alpha': [0.1, 0.3]}
+        serial = cross_validate(self.prices, EWMAModel, grid, initial=300, horizon=20, period=100, stop_ratio=None)
+        fold_cache.clear()
+        parallel = cross_validate(self.prices, EWMAModel, grid, initial=300, horizon=20, period=100, stop_ratio=None,
+                                  workers=2)
+        pd.testing.assert_frame_equal(serial, parallel)
+
+
+def main() -> None:
+    unittest.main()
+
+if __name__ == "__main__":
+    main()
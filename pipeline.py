@@ -0,0 +1,289 @@
+import hashlib
+import os
+import pickle
+import time
+import unittest
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+import numpy as np
+import pandas as pd
+
+from constants import DEFAULT_START_DATE, PIPELINE_PATH, company_dict
+
+
+class Stage(NamedTuple):
+    name: str
+    func: Callable
+    deps: Tuple[str, ...]
+    params: Dict[str, Any]
+
+
+class Pipeline:
+    """
+    Dependency graph of stages, each cached on disk by the hash of its parameters and of its inputs.
+
+    A stage is called as func(*results of deps, **params). Its cache key combines the function, the
+    parameters and the digests of the dependency results, so a stage is recomputed only when one of
+    them changed, and a recomputed stage returning the same result leaves its dependents cached.
+    Stale stages whose dependencies are ready run concurrently in a thread pool; the heavy stages
+    (fitting, optimizing) start their own worker processes.
+    """
+    def __init__(self, directory: str = PIPELINE_PATH):
+        self.directory = directory
+        self.stages: Dict[str, Stage] = {}
+
+    def add(self, name: str, func: Callable, deps: Sequence[str] = (), **params) -> None:
+        for dep in deps:
+            if dep not in self.stages:
+                raise KeyError('unknown dependency ' + dep + ' of stage ' + name)
+        self.stages[name] = Stage(name, func, tuple(deps), params)
+
+    def key(self, stage: Stage, digests: Dict[str, str]) -> str:
+        digest = hashlib.sha1()
+        digest.update(repr((stage.name, stage.func.__module__, stage.func.__qualname__)).encode())
+        digest.update(repr(sorted(stage.params.items())).encode())
+        for dep in stage.deps:
+            digest.update(digests[dep].encode())
+        return digest.hexdigest()
+
+    def _path(self, name: str, key: str) -> str:
+        return os.path.join(self.directory, name + '-' + key + '.pkl')
+
+    def _load(self, name: str, key: str) -> Optional[Tuple[str, Any]]:
+        try:
+            with open(self._path(name, key), 'rb') as f:
+                return pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def _run_stage(self, stage: Stage, inputs: List[Any], key: str) -> Tuple[str, Any, float]:
+        start = time.perf_counter()
+        result = stage.func(*inputs, **stage.params)
+        elapsed = time.perf_counter() - start
+        payload = pickle.dumps(result)
+        result_digest = hashlib.sha1(payload).hexdigest()
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(stage.name, key)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump((result_digest, result), f)
+        os.replace(path + '.tmp', path)
+        return result_digest, result, elapsed
+
+    def _upstream(self, targets: Sequence[str]) -> List[str]:
+        """
+        List the targets and everything they depend on, in insertion (topological) order.
+        """
+        needed = set()
+        stack = list(targets)
+        while stack:
+            name = stack.pop()
+            if name not in needed:
+                needed.add(name)
+                stack.extend(self.stages[name].deps)
+        return [name for name in self.stages if name in needed]
+
+    def run(self, targets: Optional[Sequence[str]] = None, workers: int = 4,
+            force: Sequence[str] = ()) -> Tuple[Dict[str, Any], pd.DataFrame]:
+        """
+        Run the stages needed by the targets, skipping the ones whose cached result is still valid.
+
+        Args:
+            targets (list, optional): Stages to compute. Default is every stage.
+            workers (int): Maximum number of stages running at the same time.
+            force (list): Stages to recompute even when cached.
+
+        Returns:
+            Tuple[dict, pd.DataFrame]: The results by stage name, and one row per stage with its
+                                       status ('cached' or 'run'), its run time in seconds and its cache key.
+        """
+        order = self._upstream(targets or list(self.stages))
+        results: Dict[str, Any] = {}
+        digests: Dict[str, str] = {}
+        timings: Dict[str, Dict] = {}
+        waiting = list(order)
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            while waiting or running:
+                for name in [name for name in waiting if all(dep in digests for dep in self.stages[name].deps)]:
+                    waiting.remove(name)
+                    stage = self.stages[name]
+                    key = self.key(stage, digests)
+                    cached = None if name in force else self._load(name, key)
+                    if cached is not None:
+                        digests[name], results[name] = cached
+                        timings[name] = {'stage': name, 'status': 'cached', 'seconds': 0.0, 'key': key}
+                    else:
+                        inputs = [results[dep] for dep in stage.deps]
+                        running[executor.submit(self._run_stage, stage, inputs, key)] = (name, key)
+                if not running:
+                    continue
+
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, key = running.pop(future)
+                    digests[name], results[name], elapsed = future.result()
+                    timings[name] = {'stage': name, 'status': 'run', 'seconds': elapsed, 'key': key}
+
+        return results, pd.DataFrame([timings[name] for name in order], columns=['stage', 'status', 'seconds', 'key'])
+
+
+def ingest_stage(assets: List[str], start_date: str, end_date: str) -> Dict[str, pd.Timestamp]:
+    """
+    Bring the price store up to date and return the last stored date of every asset.
+    """
+    from step0 import ingest
+    from store import PriceStore
+    ingest(assets, start_date, end_date)
+    last_dates = PriceStore().last_dates()
+    return {stock: last_dates.get(stock) for stock in assets}
+
+
+def _fit_one(stock_name: str) -> str:
+    from step1 import _pin_threads, fit_model
+    _pin_threads()
+    return fit_model(stock_name, save=True).data_hash
+
+
+def fit_stage(last_dates: Dict[str, pd.Timestamp], workers: int = 4) -> Dict[str, str]:
+    """
+    Fit (or reuse from the model cache) the Prophet model of every asset and return the fingerprints of their data.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    assets = list(last_dates)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(assets, executor.map(_fit_one, assets)))
+
+
+def forecast_stage(fingerprints: Dict[str, str], horizon: int = 180) -> pd.DataFrame:
+    """
+    Forecast every asset and return the forecasts in long format (ticker, ds, yhat, yhat_lower, yhat_upper).
+    """
+    from step1 import FORECAST_FIELDS, forecast_batch
+    assets = list(fingerprints)
+    values, dates = forecast_batch(assets, horizon)
+    frame = pd.DataFrame(values.reshape(-1, len(FORECAST_FIELDS)), columns=list(FORECAST_FIELDS))
+    frame.insert(0, 'ds', dates.ravel())
+    frame.insert(0, 'ticker', np.repeat(assets, horizon))
+    return frame
+
+
+def aggregate_stage(forecasts: pd.DataFrame, missing: str = 'ffill') -> pd.DataFrame:
+    """
+    Date-align the forecasts into a dates x tickers panel, with the same missing-data policies as step2.read_data.
+    """
+    from step2 import align_panel
+    return align_panel(forecasts.pivot(index='ds', columns='ticker', values='yhat'), missing=missing)
+
+
+def optimize_stage(panel: pd.DataFrame, method_mu: str = 'hist', method_cov: str = 'hist', model: str = 'Classic',
+                   rm: str = 'MV', obj: str = 'Sharpe', rf: float = 0, l: float = 0) -> pd.DataFrame:
+    """
+    Optimize the portfolio on the forecasted returns.
+    """
+    from step3 import build_portfolio, calculate_returns, estimate_assets_stats, optimize_portfolio
+    portfolio = build_portfolio(calculate_returns(panel, list(panel.columns)))
+    estimate_assets_stats(portfolio, method_mu=method_mu, method_cov=method_cov)
+    return optimize_portfolio(portfolio, model=model, rm=rm, obj=obj, rf=rf, l=l)
+
+
+def rebalance_stage(weights: pd.DataFrame, holdings: Optional[Dict[str, float]] = None) -> pd.DataFrame:
+    """
+    Compare the target weights with the current holdings (equal weights by default) and return the trades.
+    """
+    target = weights['weights']
+    current = pd.Series(holdings) if holdings else pd.Series(1 / len(target), index=target.index)
+    current = current.reindex(target.index).fillna(0.0)
+    return pd.DataFrame({'current': current, 'target': target, 'trade': target - current})
+
+
+def build_pipeline(assets: Optional[List[str]] = None, start_date: str = DEFAULT_START_DATE,
+                   end_date: Optional[str] = None, horizon: int = 180, workers: int = 4,
+                   directory: str = PIPELINE_PATH, **optimize_params) -> Pipeline:
+    """
+    Build the ingest -> fit -> forecast -> aggregate -> optimize -> rebalance pipeline of step0 to step3.
+
+    end_date defaults to today, so the ingest stage runs again once a day and the following stages only
+    when the stored prices actually changed.
+    """
+    assets = sorted(assets or company_dict.keys())
+    end_date = end_date or pd.Timestamp.today().strftime('%Y-%m-%d')
+    pipeline = Pipeline(directory)
+    pipeline.add('ingest', ingest_stage, assets=assets, start_date=start_date, end_date=end_date)
+    pipeline.add('fit', fit_stage, ['ingest'], workers=workers)
+    pipeline.add('forecast', forecast_stage, ['fit'], horizon=horizon)
+    pipeline.add('aggregate', aggregate_stage, ['forecast'])
+    pipeline.add('optimize', optimize_stage, ['aggregate'], **optimize_params)
+    pipeline.add('rebalance', rebalance_stage, ['optimize'])
+    return pipeline
+
+
+# Test cases for the pipeline runner
+calls: List[str] = []
+
+
+def _source(value: int) -> int:
+    calls.append('source')
+    return value % 2
+
+
+def _double(x: int) -> int:
+    calls.append('double')
+    return 2 * x
+
+
+def _add(x: int, y: int, offset: int = 0) -> int:
+    calls.append('add')
+    return x + y + offset
+
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self) -> None:
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        calls.clear()
+
+    def tearDown(self) -> None:
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def build(self, value: int = 1, offset: int = 0) -> Pipeline:
+        pipeline = Pipeline(self.directory)
+        pipeline.add('source', _source, value=value)
+        pipeline.add('double', _double, ['source'])
+        pipeline.add('add', _add, ['source', 'double'], offset=offset)
+        return pipeline
+
+    def test_cached_rerun(self) -> None:
+        results, timings = self.build().run()
+        self.assertEqual(results['add'], 3)
+        self.assertEqual(timings['status'].tolist(), ['run'] * 3)
+        results, timings = self.build().run()
+        self.assertEqual(results['add'], 3)
+        self.assertEqual(timings['status'].tolist(), ['cached'] * 3)
+        self.assertEqual(len(calls), 3)
+
+    def test_stale_stages(self) -> None:
+        self.build().run()
+        calls.clear()
+        _, timings = self.build(offset=1).run()
+        self.assertEqual(calls, ['add'])
+        # The source reruns with a new parameter but returns the same value, so its dependents stay cached
+        calls.clear()
+        _, timings = self.build(value=3, offset=1).run()
+        self.assertEqual(calls, ['source'])
+        _, timings = self.build(value=2, offset=1).run(targets=['double'])
+        self.assertEqual(timings['stage'].tolist(), ['source', 'double'])
+        self.assertEqual(timings['status'].tolist(), ['run', 'run'])
+
+    def test_force(self) -> None:
+        self.build().run()
+        _, timings = self.build().run(force=['double'])
+        self.assertEqual(timings['status'].tolist(), ['cached', 'run', 'cached'])
+
+
+if __name__ == "__main__":
+    results, timings = build_pipeline().run()
+    print(timings.to_string(index=False))
+    print(results['rebalance'].to_string())
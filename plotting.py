@@ -0,0 +1,130 @@
+from __future__ import annotations
+
+import os
+import unittest
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import TYPE_CHECKING, Callable, List, Optional, Tuple
+
+from instrument import span
+from lazy import lazy_import
+
+if TYPE_CHECKING:
+    from matplotlib.axes import Axes
+    from matplotlib.figure import Figure
+
+matplotlib = lazy_import('matplotlib')
+
+
+def use_headless() -> None:
+    """
+    Switch matplotlib to the non-interactive Agg backend, e.g. on servers or in render workers.
+    """
+    matplotlib.use('Agg')
+
+
+def new_figure(show: bool = False, width: float = 10, height: float = 6) -> Tuple[Figure, Axes]:
+    """
+    Create a figure for one plot.
+
+    Figures that are only saved are standalone Figure objects that pyplot doesn't track, so they are
+    freed with their last reference; figures to show go through pyplot and are closed by finish_figure.
+    """
+    if show:
+        import matplotlib.pyplot as plt
+        fig, ax = plt.subplots(figsize=(width, height))
+    else:
+        from matplotlib.figure import Figure
+        fig = Figure(figsize=(width, height))
+        ax = fig.add_subplot()
+    return fig, ax
+
+
+def finish_figure(fig: Figure, path: Optional[str] = None, show: bool = False) -> None:
+    """
+    Save the figure when a path is given, show it if requested, then release it.
+    """
+    if path is not None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with span('plotting', path=path):
+            fig.savefig(path)
+    if show:
+        import matplotlib.pyplot as plt
+        plt.show()
+        plt.close(fig)
+    fig.clear()
+
+
+class RenderPool:
+    """
+    Render figures in background worker processes so that plotting never blocks training or forecasting.
+
+    Tasks are plotting functions called with show=False; they run with the Agg backend and their
+    arguments must be picklable. Use it as a context manager to wait for every figure on exit.
+    """
+    def __init__(self, workers: int = 2):
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=use_headless)
+        self.futures: List[Future] = []
+
+    def submit(self, func: Callable, *args, **kwargs) -> Future:
+        future = self.executor.submit(func, *args, show=False, **kwargs)
+        self.futures.append(future)
+        return future
+
+    def wait(self) -> List[BaseException]:
+        """
+        Wait for the submitted figures and return the errors of the ones that failed.
+        """
+        errors = [future.exception() for future in self.futures]
+        self.futures = []
+        return [error for error in errors if error is not None]
+
+    def close(self) -> None:
+        self.wait()
+        self.executor.shutdown()
+
+    def __enter__(self) -> 'RenderPool':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+# Test cases for the headless rendering helpers
+def _render_line(path: str, show: bool = False) -> str:
+    fig, ax = new_figure(show)
+    ax.plot([0, 1, 2], [1, 0, 1])
+    finish_figure(fig, path, show)
+    return path
+
+
+class TestPlotting(unittest.TestCase):
+    def setUp(self) -> None:
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def test_figures_are_not_tracked(self) -> None:
+        import matplotlib.pyplot as plt
+        before = plt.get_fignums()
+        path = _render_line(os.path.join(self.directory, 'line.png'))
+        self.assertTrue(os.path.getsize(path) > 0)
+        self.assertEqual(plt.get_fignums(), before)
+
+    def test_render_pool(self) -> None:
+        paths = [os.path.join(self.directory, str(i), 'line.png') for i in range(3)]
+        with RenderPool(workers=2) as pool:
+            futures = [pool.submit(_render_line, path) for path in paths]
+        self.assertEqual([future.result() for future in futures], paths)
+        self.assertTrue(all(os.path.exists(path) for path in paths))
+
+
+def main() -> None:
+    unittest.main()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import unittest
+from typing import List, Optional, Tuple, Union
+import numpy as np
+import pandas as pd
+
+from estimators import RollingMoments
+
+RETURN_KINDS = ('simple', 'log')
+
+
+class ReturnsMatrix:
+    """
+    Dates x assets returns held in one contiguous array, float32 by default and optionally memory-mapped.
+
+    The returns are computed from the prices chunk by chunk straight into the output array, so the
+    only full-size allocation is the result itself (on disk when a path is given). to_frame wraps the
+    array in a DataFrame without copying it, for rp.Portfolio, and moments computes the mean and
+    covariance chunk by chunk with float64 accumulators, for set_assets_stats or the optimizer.
+    """
+    def __init__(self, values: np.ndarray, dates: pd.Index, assets: List[str]):
+        self.values = values
+        self.dates = dates
+        self.assets = list(assets)
+
+    @classmethod
+    def from_prices(cls, prices: pd.DataFrame, assets: Optional[List[str]] = None, kind: str = 'simple',
+                    dtype: Union[str, np.dtype] = np.float32, path: Optional[str] = None,
+                    chunk_rows: int = 4096) -> 'ReturnsMatrix':
+        """
+        Compute the returns of a dates x tickers price panel.
+
+        Rows with a missing return (a NaN price on either date) are dropped.
+
+        Args:
+            prices (pd.DataFrame): Prices indexed by date.
+            assets (list, optional): Columns to use. Default is every column. A missing column raises a KeyError.
+            kind (str): 'simple' for p_t / p_t-1 - 1 or 'log' for log(p_t / p_t-1).
+            dtype: Data type of the returns, float32 by default.
+            path (str, optional): .npy file backing the returns as a memory map. Default keeps them in memory.
+            chunk_rows (int): Number of dates processed at once.
+        """
+        if kind not in RETURN_KINDS:
+            raise ValueError("kind must be one of " + str(RETURN_KINDS) + ", got " + str(kind))
+        assets = list(prices.columns) if assets is None else list(assets)
+        columns = prices.columns.get_indexer(assets)
+        if (columns < 0).any():
+            raise KeyError('unknown assets: ' + str([asset for asset, i in zip(assets, columns) if i < 0]))
+        shape = (max(len(prices) - 1, 0), len(assets))
+        if path is None:
+            out = np.empty(shape, dtype=dtype)
+        else:
+            out = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+
+        # Rows holding a NaN are skipped while writing, so the result is compacted in the same pass
+        kept = np.empty(shape[0], dtype=bool)
+        written = 0
+        for start in range(0, shape[0], chunk_rows):
+            stop = min(start + chunk_rows, shape[0])
+            # Only the requested columns of the chunk are read, so the panel is never copied whole
+            block = np.array(prices.iloc[start:stop + 1, columns], dtype=np.float64)
+            chunk = block[1:]
+            np.divide(chunk, block[:-1], out=chunk)
+            if kind == 'log':
+                np.log(chunk, out=chunk)
+            else:
+                chunk -= 1
+            valid = ~np.isnan(chunk).any(axis=1)
+            kept[start:stop] = valid
+            count = int(valid.sum())
+            out[written:written + count] = chunk[valid]
+            written += count
+
+        if path is not None:
+            out.flush()
+            del out
+            out = _truncate_npy(path, written)
+        return cls(out[:written], prices.index[1:][kept], assets)
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.values.shape
+
+    @property
+    def nbytes(self) -> int:
+        return self.values.nbytes
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        View the returns as a DataFrame sharing the array, with no copy.
+        """
+        return pd.DataFrame(self.values, index=self.dates, columns=self.assets, copy=False)
+
+    def moments(self, chunk_rows: int = 4096) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Sample mean and covariance, as riskfolio's 'hist' estimates, accumulated in float64 chunk by chunk.
+        """
+        estimator = RollingMoments(len(self.assets))
+        for start in range(0, len(self.values), chunk_rows):
+            estimator.add(self.values[start:start + chunk_rows])
+        return estimator.mean, estimator.cov()
+
+
+def _truncate_npy(path: str, rows: int) -> np.memmap:
+    """
+    Shrink a C-ordered .npy file to its first rows, rewriting the shape in its header, and map it again.
+    """
+    import io
+    import os
+    array = np.load(path, mmap_mode='r')
+    offset, shape, dtype = array.offset, (rows,) + array.shape[1:], array.dtype
+    del array
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(header, {'descr': np.lib.format.dtype_to_descr(dtype),
+                                                  'fortran_order': False, 'shape': shape})
+    if len(header.getvalue()) == offset:
+        # The header is padded to a fixed size, so the new shape is written in place
+        with open(path, 'r+b') as f:
+            f.write(header.getvalue())
+            f.truncate(offset + int(np.prod(shape)) * dtype.itemsize)
+    else:
+        kept = np.array(np.load(path, mmap_mode='r')[:rows])
+        np.save(path + '.tmp.npy', kept)
+        del kept
+        os.replace(path + '.tmp.npy', path)
+    return np.load(path, mmap_mode='r+')
+
+
+# Test cases for the compact returns matrix
+class TestReturnsMatrix(unittest.TestCase):
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        values = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, size=(1000, 5)), axis=0))
+        values[[10, 500], [1, 3]] = np.nan
+        self.prices = pd.DataFrame(values, index=pd.date_range('2010-01-01', periods=1000), columns=list('ABCDE'))
+
+    def test_parity_with_pandas(self) -> None:
+        expected = self.prices[['E', 'A', 'C']].pct_change(fill_method=None).dropna()
+        matrix = ReturnsMatrix.from_prices(self.prices, ['E', 'A', 'C'], dtype=np.float64, chunk_rows=97)
+        pd.testing.assert_frame_equal(matrix.to_frame(), expected, check_freq=False)
+        compact = ReturnsMatrix.from_prices(self.prices, chunk_rows=97)
+        self.assertEqual(compact.values.dtype, np.float32)
+        self.assertEqual(compact.nbytes * 2, ReturnsMatrix.from_prices(self.prices, dtype=np.float64).nbytes)
+        log = ReturnsMatrix.from_prices(self.prices, kind='log', dtype=np.float64)
+        np.testing.assert_allclose(log.values, np.log1p(self.prices.pct_change(fill_method=None).dropna().to_numpy()))
+
+    def test_unknown_asset(self) -> None:
+        with self.assertRaises(KeyError):
+            ReturnsMatrix.from_prices(self.prices, ['A', 'XYZ'])
+
+    def test_memmap_and_moments(self) -> None:
+        import os
+        import tempfile
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'returns.npy')
+            matrix = ReturnsMatrix.from_prices(self.prices, path=path, chunk_rows=100)
+            self.assertIsInstance(matrix.values, np.memmap)
+            # The dropped rows are not left at the end of the file
+            np.testing.assert_array_equal(np.load(path), matrix.values)
+            self.assertEqual(os.path.getsize(path), matrix.values.offset + matrix.nbytes)
+            frame = matrix.to_frame()
+            self.assertTrue(np.shares_memory(frame.to_numpy(), matrix.values))
+            expected = self.prices.pct_change(fill_method=None).dropna()
+            mean, cov = matrix.moments(chunk_rows=64)
+            np.testing.assert_allclose(mean, expected.mean().to_numpy(), rtol=1e-5)
+            np.testing.assert_allclose(cov, expected.cov().to_numpy(), rtol=1e-4)
+            del matrix, frame
+        finally:
+            import shutil
+            shutil.rmtree(directory)
+
+
+def main() -> None:
+    unittest.main()
+
+if __name__ == "__main__":
+    main()
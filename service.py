@@ -0,0 +1,257 @@
+import asyncio
+import logging
+import os
+import time
+import unittest
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+import numpy as np
+import pandas as pd
+
+from estimators import EWMAMoments, RollingMoments
+from instrument import recorder, span
+from solvers import MeanVarianceProblem
+
+logger = logging.getLogger(__name__)
+
+
+class Rebalance(NamedTuple):
+    date: pd.Timestamp
+    weights: pd.Series
+    drift: float
+
+
+class ReplaySource:
+    """
+    In-process price source replaying the rows of a dates x tickers price frame, one bar every delay seconds.
+    """
+    def __init__(self, prices: pd.DataFrame, delay: float = 0.0):
+        self.prices = prices
+        self.delay = delay
+
+    async def __aiter__(self) -> AsyncIterator[Tuple[pd.Timestamp, np.ndarray]]:
+        for date, row in zip(self.prices.index, self.prices.to_numpy(dtype=float)):
+            yield date, row
+            await asyncio.sleep(self.delay)
+
+
+class FileTailSource:
+    """
+    Price source following a CSV file as bars are appended to it, like tail -f.
+
+    The file starts with a 'Date,<ticker>,...' header and every following line is one bar. An empty
+    price field is read as NaN; lines that can't be parsed are skipped and counted in skipped.
+    The source stops after idle_timeout seconds without a new line, or never when it is None.
+    """
+    def __init__(self, path: str, assets: List[str], poll: float = 1.0, idle_timeout: Optional[float] = None):
+        self.path = path
+        self.assets = assets
+        self.poll = poll
+        self.idle_timeout = idle_timeout
+        self.skipped = 0
+
+    async def __aiter__(self) -> AsyncIterator[Tuple[pd.Timestamp, np.ndarray]]:
+        with open(self.path) as f:
+            columns = f.readline().strip().split(',')
+            order = [columns.index(asset) for asset in self.assets]
+            idle = 0.0
+            buffer = ''
+            while self.idle_timeout is None or idle < self.idle_timeout:
+                buffer += f.readline()
+                if not buffer.endswith('\n'):
+                    await asyncio.sleep(self.poll)
+                    idle += self.poll
+                    continue
+                idle = 0.0
+                line, buffer = buffer.strip(), ''
+                fields = line.split(',')
+                try:
+                    if len(fields) != len(columns):
+                        raise ValueError('expected ' + str(len(columns)) + ' fields, got ' + str(len(fields)))
+                    bar = pd.Timestamp(fields[0]), np.array([float(fields[i]) if fields[i] else np.nan for i in order])
+                except ValueError as error:
+                    self.skipped += 1
+                    logger.warning('skipping line %r of %s: %s', line, self.path, error)
+                    continue
+                yield bar
+
+
+class RebalanceService:
+    """
+    Long-running rebalancer updating the return statistics and the target weights on every price bar.
+
+    Each bar updates the rolling ('hist') or exponentially weighted ('ewma') mean and covariance of
+    the last window returns in O(N^2), and re-solves the long-only mean-variance problem built once
+    in solvers.MeanVarianceProblem, warm-started from the previous solution. The held weights drift
+    with prices; new target weights are emitted only when the turnover needed to reach them,
+    0.5 * sum |target - held|, crosses the threshold. When a bar can't be solved, e.g. 'Sharpe' with no
+    asset above rf, the previous target is kept. A bar with a missing price is skipped, and the return
+    of the next bar is measured from the last valid price of each asset. The processing time of every bar is kept in
+    latencies (seconds) and summarised by metrics.
+    """
+    def __init__(self, assets: List[str], window: int = 252, estimator: str = 'hist', d: float = 0.94,
+                 obj: str = 'Sharpe', rf: float = 0, l: float = 0, threshold: float = 0.05, min_bars: int = 60):
+        if estimator not in ('hist', 'ewma'):
+            raise ValueError("estimator must be 'hist' or 'ewma', got " + str(estimator))
+        n_assets = len(assets)
+        self.assets = list(assets)
+        self.window = window
+        self.obj, self.rf, self.l = obj, rf, l
+        self.threshold = threshold
+        self.min_bars = max(min_bars, 2)
+        self.moments = RollingMoments(n_assets) if estimator == 'hist' else EWMAMoments(n_assets, d=d)
+        self.history: deque = deque()
+        self.problem = MeanVarianceProblem(n_assets)
+        self.last_prices: Optional[np.ndarray] = None
+        self.held: Optional[np.ndarray] = None
+        self.target: Optional[np.ndarray] = None
+        self.latencies: deque = deque(maxlen=10000)
+
+    def update(self, date: pd.Timestamp, prices: np.ndarray) -> Optional[Rebalance]:
+        """
+        Process one bar and return the new target weights when they should be traded, otherwise None.
+        """
+        start = time.perf_counter()
+        if recorder.enabled:
+            with span('rebalance_bar', date=str(date)):
+                rebalance = self._update(date, np.asarray(prices, dtype=float))
+        else:
+            rebalance = self._update(date, np.asarray(prices, dtype=float))
+        self.latencies.append(time.perf_counter() - start)
+        return rebalance
+
+    def _update(self, date: pd.Timestamp, prices: np.ndarray) -> Optional[Rebalance]:
+        # Missing prices keep the last valid price of their asset, so one bad bar doesn't drop the next one too
+        previous = self.last_prices
+        self.last_prices = prices if previous is None else np.where(np.isnan(prices), previous, prices)
+        if previous is None or np.isnan(previous).any():
+            return None
+        returns = prices / previous - 1
+        if np.isnan(returns).any():
+            return None
+
+        self.moments.add(returns)
+        self.history.append(returns)
+        if len(self.history) > self.window:
+            self.moments.remove(self.history.popleft())
+        if self.held is not None:
+            grown = self.held * (1 + returns)
+            self.held = grown / grown.sum()
+        if len(self.history) < self.min_bars:
+            return None
+
+        self.problem.set_inputs(self.moments.mean, self.moments.cov())
+        weights = self.problem.solve(obj=self.obj, rf=self.rf, l=self.l)
+        if weights is None:
+            return None
+        self.target = weights
+
+        drift = 1.0 if self.held is None else 0.5 * float(np.abs(weights - self.held).sum())
+        if drift < self.threshold:
+            return None
+        self.held = weights
+        return Rebalance(date, pd.Series(weights, index=self.assets, name='weights'), drift)
+
+    def metrics(self) -> Dict[str, float]:
+        """
+        Number of processed bars and their latency statistics in milliseconds.
+        """
+        latencies = 1000 * np.array(self.latencies)
+        if not len(latencies):
+            return {'bars': 0}
+        return {'bars': len(latencies), 'mean_ms': float(latencies.mean()),
+                'p50_ms': float(np.percentile(latencies, 50)), 'p95_ms': float(np.percentile(latencies, 95)),
+                'max_ms': float(latencies.max())}
+
+    async def run(self, source, sink: Callable[[Rebalance], Awaitable[None]]) -> None:
+        """
+        Consume the bars of an async source and await sink(rebalance) for every emitted rebalance.
+
+        The statistics update and the solve run in a worker thread, so the event loop keeps serving
+        the source and the sink while a bar is processed.
+        """
+        async for date, prices in source:
+            rebalance = await asyncio.to_thread(self.update, date, prices)
+            if rebalance is not None:
+                await sink(rebalance)
+
+
+# Test cases for the rebalancing service
+class TestRebalanceService(unittest.TestCase):
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        log_returns = rng.normal(0.0004, 0.01, size=(300, 4)) + rng.normal(0, 0.005, size=(300, 1))
+        self.prices = pd.DataFrame(100 * np.exp(np.cumsum(log_returns, axis=0)), columns=list('ABCD'),
+                                   index=pd.date_range('2020-01-01', periods=300))
+
+    def run_service(self, service: RebalanceService, source) -> List[Rebalance]:
+        emitted = []
+
+        async def sink(rebalance: Rebalance) -> None:
+            emitted.append(rebalance)
+        asyncio.run(service.run(source, sink))
+        return emitted
+
+    def test_replay(self) -> None:
+        service = RebalanceService(list('ABCD'), window=120, threshold=0.02)
+        emitted = self.run_service(service, ReplaySource(self.prices))
+        self.assertGreater(len(emitted), 0)
+        self.assertLess(len(emitted), 300 - service.min_bars)
+        for rebalance in emitted:
+            self.assertAlmostEqual(rebalance.weights.sum(), 1)
+            self.assertGreaterEqual(rebalance.drift, 0.02)
+        self.assertEqual(service.metrics()['bars'], 300)
+
+        # The streamed statistics and target match a batch solve on the last window
+        window = self.prices.pct_change().dropna().iloc[-120:]
+        np.testing.assert_allclose(service.moments.cov(), window.cov().to_numpy(), atol=1e-12)
+        batch = MeanVarianceProblem(4)
+        batch.set_inputs(window.mean().to_numpy(), window.cov().to_numpy())
+        np.testing.assert_allclose(service.target, batch.solve(obj='Sharpe'), atol=1e-3)
+
+    def test_file_tail(self) -> None:
+        import tempfile
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'bars.csv')
+            self.prices.iloc[:100].to_csv(path, index_label='Date')
+            service = RebalanceService(list('DCBA'), estimator='ewma', obj='MinRisk', threshold=0.0)
+            emitted = self.run_service(service, FileTailSource(path, list('DCBA'), poll=0.01, idle_timeout=0.05))
+            self.assertEqual(service.metrics()['bars'], 100)
+            self.assertEqual(len(emitted), 100 - service.min_bars)
+            self.assertEqual(list(emitted[-1].weights.index), list('DCBA'))
+        finally:
+            import shutil
+            shutil.rmtree(directory)
+
+    def test_bad_bars(self) -> None:
+        import tempfile
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'bars.csv')
+            self.prices.iloc[:80].to_csv(path, index_label='Date')
+            with open(path, 'a') as f:
+                f.write('2020-03-21,101,abc,99,100\n2020-03-22,101\nnot a date,1,2,3,4\n\n2020-03-23,,100,100,100\n')
+                f.write('2020-03-24,100,100,100,100\n')
+            source = FileTailSource(path, list('ABCD'), poll=0.01, idle_timeout=0.05)
+            service = RebalanceService(list('ABCD'), obj='MinRisk', threshold=0.0)
+            with self.assertLogs(logger, 'WARNING') as logs:
+                self.run_service(service, source)
+            self.assertEqual(source.skipped, 4)
+            self.assertEqual(len(logs.output), 4)
+            # The bar with a missing price of A is processed but adds no return...
+            self.assertEqual(service.metrics()['bars'], 82)
+            self.assertEqual(len(service.history), 80)
+            # ...and the next bar measures A from its last valid price
+            np.testing.assert_allclose(service.history[-1],
+                                       100 / np.array([self.prices['A'].iloc[79], 100, 100, 100]) - 1)
+        finally:
+            import shutil
+            shutil.rmtree(directory)
+
+
+def main() -> None:
+    unittest.main()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+import unittest
+from typing import Dict, Optional, Tuple
+import numpy as np
+import cvxpy as cp
+
+
+def matrix_sqrt(cov: np.ndarray) -> np.ndarray:
+    """
+    Return S such that cov = S.T @ S, using a Cholesky factor or, for singular matrices, an eigen decomposition.
+    """
+    cov = np.asarray(cov, dtype=float)
+    try:
+        return np.linalg.cholesky(cov).T
+    except np.linalg.LinAlgError:
+        values, vectors = np.linalg.eigh(cov)
+        return (vectors * np.sqrt(np.clip(values, 0, None))).T
+
+
+class MeanVarianceProblem:
+    """
+    Long-only, fully invested mean-variance problems built once with cvxpy Parameters.
+
+    The expected returns, the covariance square root, rf, l and the target return are parameters,
+    so new inputs are swapped in and the problem re-solved without being rebuilt, warm-starting
+    from the previous solution. The objectives follow riskfolio's 'Classic' model with rm='MV'.
+
+    The variance is ||S w||^2 + ||s * w||^2: S is a dense square root of the covariance with s = 0, or,
+    for a factored covariance B B' + diag(d) with rank k, S = B' (k x N) and s = sqrt(d), so the
+    problem size grows with N * k instead of N^2.
+    """
+    OBJECTIVES = ('MinRisk', 'Utility', 'Sharpe', 'MaxRet')
+
+    def __init__(self, n_assets: int, rank: Optional[int] = None):
+        self.n_assets = n_assets
+        self.mu = cp.Parameter(n_assets)
+        self.sqrt_cov = cp.Parameter((rank or n_assets, n_assets))
+        self.specific = cp.Parameter(n_assets, nonneg=True)
+        self.rf = cp.Parameter()
+        self.l = cp.Parameter(nonneg=True)
+        self.target = cp.Parameter()
+        self._problems: Dict[Tuple[str, bool], Tuple[cp.Problem, cp.Variable, Optional[cp.Variable]]] = {}
+
+    def set_inputs(self, mu: np.ndarray, cov: Optional[np.ndarray] = None, sqrt_cov: Optional[np.ndarray] = None,
+                   factors=None) -> None:
+        """
+        Set the expected returns and the covariance, given either dense, as its square root S (cov = S.T @ S),
+        or as a factored covariance (estimators.FactorCovariance) when the problem was built with its rank.
+        """
+        self.mu.value = np.asarray(mu, dtype=float).ravel()
+        if factors is not None:
+            self.sqrt_cov.value = factors.loadings.T
+            self.specific.value = np.sqrt(factors.specific)
+        else:
+            self.sqrt_cov.value = matrix_sqrt(cov) if sqrt_cov is None else np.asarray(sqrt_cov, dtype=float)
+            self.specific.value = np.zeros(self.n_assets)
+
+    def _risk(self, weights: cp.Variable) -> cp.Expression:
+        return cp.sum_squares(self.sqrt_cov @ weights) + cp.sum_squares(cp.multiply(self.specific, weights))
+
+    def _build(self, obj: str, targeted: bool) -> Tuple[cp.Problem, cp.Variable, Optional[cp.Variable]]:
+        weights = cp.Variable(self.n_assets)
+        scale = None
+        constraints = [weights >= 0]
+        if obj == 'Sharpe':
+            # Homogenized problem: weights = y / k with (mu - rf)' y = 1
+            scale = cp.Variable(nonneg=True)
+            constraints += [cp.sum(weights) == scale, self.mu @ weights - self.rf * scale == 1]
+            objective = cp.Minimize(self._risk(weights))
+        else:
+            constraints += [cp.sum(weights) == 1]
+            if obj == 'MinRisk':
+                objective = cp.Minimize(self._risk(weights))
+            elif obj == 'Utility':
+                # Epigraph variable keeps the problem DPP: l * variance would multiply two parameters
+                variance = cp.Variable(nonneg=True)
+                constraints += [self._risk(weights) <= variance]
+                objective = cp.Maximize(self.mu @ weights - self.l * variance)
+            elif obj == 'MaxRet':
+                objective = cp.Maximize(self.mu @ weights)
+            else:
+                raise ValueError("obj must be one of " + str(self.OBJECTIVES) + ", got " + str(obj))
+        if targeted:
+            constraints += [self.mu @ weights >= self.target]
+        return cp.Problem(objective, constraints), weights, scale
+
+    def solve(self, obj: str = 'Sharpe', rf: float = 0, l: float = 0, target: Optional[float] = None,
+              **solver_kwargs) -> Optional[np.ndarray]:
+        """
+        Solve for the optimal weights, or return None when the solver fails.
+
+        :param obj: One of 'MinRisk', 'Utility', 'Sharpe' or 'MaxRet'.
+        :param rf: Risk free rate, for 'Sharpe'.
+        :param l: Risk aversion, for 'Utility'.
+        :param target: Optional minimum expected return.
+        """
+        key = (obj, target is not None)
+        if key not in self._problems:
+            self._problems[key] = self._build(obj, target is not None)
+        problem, weights, scale = self._problems[key]
+
+        self.rf.value = rf
+        self.l.value = l
+        self.target.value = 0.0 if target is None else target
+        try:
+            problem.solve(warm_start=True, **solver_kwargs)
+        except cp.error.SolverError:
+            return None
+        if weights.value is None or problem.status not in ('optimal', 'optimal_inaccurate'):
+            return None
+
+        solution = weights.value if scale is None else weights.value / scale.value
+        solution = np.clip(solution, 0, None)
+        return solution / solution.sum()
+
+
+# Test cases for MeanVarianceProblem, against riskfolio
+class TestMeanVarianceProblem(unittest.TestCase):
+    def setUp(self) -> None:
+        import pandas as pd
+        rng = np.random.default_rng(0)
+        self.returns = pd.DataFrame(rng.normal(0.001, 0.02, size=(500, 5)) + rng.normal(0, 0.01, size=(500, 1)),
+                                    columns=list('ABCDE'))
+        self.problem = MeanVarianceProblem(5)
+        self.problem.set_inputs(self.returns.mean().to_numpy(), self.returns.cov().to_numpy())
+
+    def riskfolio_weights(self, obj: str, rf: float = 0, l: float = 0) -> np.ndarray:
+        import riskfolio as rp
+        portfolio = rp.Portfolio(returns=self.returns)
+        portfolio.assets_stats(method_mu='hist', method_cov='hist')
+        return portfolio.optimization(model='Classic', rm='MV', obj=obj, rf=rf, l=l, hist=True)['weights'].to_numpy()
+
+    def test_parity_with_riskfolio(self) -> None:
+        configurations = [('MinRisk', 0, 0), ('Sharpe', 0, 0), ('Sharpe', 0.0005, 0),
+                          ('Utility', 0, 0.05), ('Utility', 0, 5), ('MaxRet', 0, 0)]
+        for obj, rf, l in configurations:
+            weights = self.problem.solve(obj=obj, rf=rf, l=l)
+            np.testing.assert_allclose(weights, self.riskfolio_weights(obj, rf, l), atol=2e-3)
+
+    def test_target_return(self) -> None:
+        mu = self.returns.mean().to_numpy()
+        target = 0.5 * (mu.max() + mu.min())
+        weights = self.problem.solve(obj='MinRisk', target=target)
+        self.assertGreaterEqual(weights @ mu, target - 1e-6)
+
+    def test_singular_covariance(self) -> None:
+        cov = np.ones((3, 3))
+        np.testing.assert_allclose(matrix_sqrt(cov).T @ matrix_sqrt(cov), cov, atol=1e-12)
+
+
+def main() -> None:
+    unittest.main()
+
+if __name__ == "__main__":
+    main()
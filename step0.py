@@ -1,35 +1,153 @@
 import os
-import sys
+import shutil
+import tempfile
+import unittest
+from typing import Callable, Dict, List, Optional
+import numpy as np
 import pandas as pd
-from constants import DEFAULT_START_DATE, DEFAULT_END_DATE, company_dict, DATA_PATH
+from constants import DEFAULT_START_DATE, DEFAULT_END_DATE, company_dict
 import yfinance as yf
+from store import PriceStore
+from instrument import span
 
 
 
 
 def download_and_save_stock_data(stock_name: str, start_date: str = DEFAULT_START_DATE, end_date: str = DEFAULT_END_DATE) -> None:
     """
-    Download stock data for a given stock symbol and save it as a CSV file in the 'data' folder.
+    Download stock data for a given stock symbol and save it in the price store.
 
     :param stock_name: Stock symbol to download data for.
     :param start_date: Start date for downloading stock data.
     :param end_date: End date for downloading stock data.
     """
-    print(stock_name)
-    stock_data = yf.download(stock_name, start=DEFAULT_START_DATE, end=DEFAULT_END_DATE)
-        # Extract the date and adjusted close price columns
+    with span('download', ticker=stock_name):
+        stock_data = yf.download(stock_name, start=start_date, end=end_date)
+    # Extract the date and adjusted close price columns
     stock_data = stock_data[['Adj Close']]
 
-    directory = os.path.join(DATA_PATH, stock_name)
+    PriceStore().write({stock_name: stock_data})
 
-    if not os.path.exists(directory):
-        os.makedirs(directory)
 
-    stock_data.to_csv(os.path.join(directory, "stock_data.csv"))
-    print("done")
+def split_bulk_download(data: pd.DataFrame, tickers: List[str], column: str = 'Adj Close') -> Dict[str, pd.DataFrame]:
+    """
+    Split a multi-symbol download into one single-column frame per ticker.
+
+    :param data: Frame returned by yf.download for several symbols, with (field, ticker) columns.
+    :param tickers: Symbols that were requested.
+    :param column: Price field to keep.
+    :return: Dictionary mapping each ticker to its non-empty price frame.
+    """
+    frames = {}
+    for stock_name in tickers:
+        if isinstance(data.columns, pd.MultiIndex):
+            if (column, stock_name) not in data.columns:
+                continue
+            series = data[(column, stock_name)]
+        else:
+            # yfinance drops the ticker level when a single symbol is requested
+            series = data[column]
+        series = series.dropna()
+        if not series.empty:
+            frames[stock_name] = series.to_frame(column)
+    return frames
+
+
+def ingest(tickers: List[str], start_date: str = DEFAULT_START_DATE, end_date: Optional[str] = None,
+           batch_size: int = 50, downloader: Callable = yf.download, store: Optional[PriceStore] = None) -> Dict[str, int]:
+    """
+    Incrementally update the price store with the missing tail of each ticker's history.
+
+    Tickers already in the store are fetched from the day after their last stored date, new tickers
+    from start_date. Tickers sharing the same fetch window are downloaded together in bulk requests of
+    at most batch_size symbols, and everything is appended to the store in one atomic write.
+
+    :param tickers: Stock symbols to update.
+    :param start_date: Start date for tickers that are not in the store yet.
+    :param end_date: End date (exclusive, as in yf.download). Default is today, so a scheduled run fetches the latest rows.
+    :param batch_size: Maximum number of symbols per bulk request.
+    :param downloader: Callable with the yf.download signature, replaceable for offline use.
+    :param store: Price store to update. Default is the store at PRICE_STORE_PATH.
+    :return: Dictionary mapping each updated ticker to the number of appended rows.
+    """
+    store = store or PriceStore()
+    last_dates = store.last_dates()
+    end = pd.Timestamp(end_date) if end_date else pd.Timestamp.today().normalize()
+
+    # Group the tickers by the first missing date so each group is one bulk request.
+    windows: Dict[pd.Timestamp, List[str]] = {}
+    for stock_name in tickers:
+        if stock_name in last_dates:
+            fetch_start = last_dates[stock_name].normalize() + pd.Timedelta(days=1)
+        else:
+            fetch_start = pd.Timestamp(start_date)
+        if fetch_start < end:
+            windows.setdefault(fetch_start, []).append(stock_name)
+
+    frames = {}
+    for fetch_start, group in windows.items():
+        for i in range(0, len(group), batch_size):
+            batch = group[i:i + batch_size]
+            with span('download', tickers=batch, start=str(fetch_start.date())):
+                data = downloader(batch, start=fetch_start.strftime('%Y-%m-%d'), end=end.strftime('%Y-%m-%d'),
+                                  group_by='column', progress=False)
+            frames.update(split_bulk_download(data, batch))
+
+    if frames:
+        store.append(frames)
+    return {stock_name: len(frame) for stock_name, frame in frames.items()}
+
+
+class FakeDownloader:
+    """
+    Offline stand-in for yf.download returning deterministic business day prices.
+    """
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, tickers, start, end, **kwargs) -> pd.DataFrame:
+        self.calls.append((list(tickers), start, end))
+        dates = pd.bdate_range(start, pd.Timestamp(end) - pd.Timedelta(days=1), name='Date')
+        columns = pd.MultiIndex.from_product([['Adj Close'], tickers])
+        values = np.add.outer(np.arange(len(dates), dtype=float), np.arange(len(tickers), dtype=float))
+        return pd.DataFrame(values, index=dates, columns=columns)
+
+
+# Test cases for the incremental ingestion
+class TestIngest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        self.store = PriceStore(os.path.join(self.directory, 'prices.parquet'))
+        self.downloader = FakeDownloader()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.directory)
+
+    def test_bulk_first_run(self) -> None:
+        appended = ingest(['AAPL', 'MSFT', 'V'], '2020-01-01', '2020-02-01', batch_size=2,
+                          downloader=self.downloader, store=self.store)
+        self.assertEqual(len(self.downloader.calls), 2)
+        self.assertEqual(appended['AAPL'], 23)
+        self.assertEqual(self.store.tickers(), ['AAPL', 'MSFT', 'V'])
+
+    def test_fetches_only_missing_tail(self) -> None:
+        ingest(['AAPL'], '2020-01-01', '2020-02-01', downloader=self.downloader, store=self.store)
+        appended = ingest(['AAPL', 'MSFT'], '2020-01-01', '2020-02-08', downloader=self.downloader, store=self.store)
+        self.assertIn((['AAPL'], '2020-02-01', '2020-02-08'), self.downloader.calls)
+        self.assertEqual(appended['AAPL'], 5)
+        self.assertEqual(len(self.store.read_ticker('AAPL')), 28)
+        self.assertEqual(len(self.store.read_ticker('MSFT')), 28)
+
+    def test_up_to_date_is_noop(self) -> None:
+        ingest(['AAPL'], '2020-01-01', '2020-02-01', downloader=self.downloader, store=self.store)
+        self.assertEqual(ingest(['AAPL'], '2020-01-01', '2020-02-01', downloader=self.downloader, store=self.store), {})
+        self.assertEqual(len(self.downloader.calls), 1)
 
+    def test_end_defaults_to_today(self) -> None:
+        start = (pd.Timestamp.today() - pd.Timedelta(days=10)).strftime('%Y-%m-%d')
+        ingest(['AAPL'], start, downloader=self.downloader, store=self.store)
+        self.assertEqual(self.downloader.calls[0][2], pd.Timestamp.today().strftime('%Y-%m-%d'))
 
 
 if __name__ == "__main__":
-    for key,value in company_dict.items():
-        download_and_save_stock_data(key)
\ No newline at end of file
+    ingest(list(company_dict.keys()))
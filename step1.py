@@ -1,14 +1,31 @@
-import pickle
 import os
-from typing import Type, Tuple
+import time
+import multiprocessing
+from multiprocessing.connection import wait
+import unittest
+from unittest import mock
+from typing import TYPE_CHECKING, Type, Tuple, List, Optional, Iterator
+import numpy as np
 import pandas as pd
-from prophet import Prophet
-import matplotlib.pyplot as plt
-from constants import DATA_PATH, FORECAST_PATH, FIGURE_PATH, company_dict
+from constants import DATA_PATH, FORECAST_PATH, FIGURE_PATH, MODEL_PATH, company_dict
+from store import PriceStore, read_stock_csv
+from lazy import lazy_import
+from models.cache import ModelCache
+from instrument import instrumented, span
+from plotting import RenderPool, finish_figure, new_figure
 
+if TYPE_CHECKING:
+    from prophet import Prophet
+
+# Prophet is only loaded when a model is fitted or read, not by load_csv
+prophet_model = lazy_import('models.prophet_model')
+
+model_cache = ModelCache(MODEL_PATH)
+
+@instrumented('load_csv', label='stock_name')
 def load_csv(stock_name: str, forecaster: bool = False) -> pd.DataFrame:
     """
-    Load historical stock data from a CSV file.
+    Load historical stock data from the price store, or forecasted data from a CSV file.
 
     Args:
         stock_name (str): Name of the stock to load data for.
@@ -30,74 +47,61 @@ def load_csv(stock_name: str, forecaster: bool = False) -> pd.DataFrame:
         df = df.rename(columns={'yhat': 'y'})
         df = df[['ds','y']]
     else:
-        path = DATA_PATH
-
-        # Construct the path to the CSV file.
-        directory = os.path.join(path, stock_name)
-        file_path = os.path.join(directory, "stock_data.csv")
-
-        # Parse the date column and load the CSV file as a DataFrame.
-        date_parser = lambda x: pd.to_datetime(x, utc=True)
-        df = pd.read_csv(file_path, parse_dates=['Date'], date_parser=date_parser)
-
-        # Rename columns and localize the date column to None.
+        # Read from the columnar price store, falling back to the legacy per-ticker CSV tree.
+        try:
+            df = PriceStore().read_ticker(stock_name, columns=['Adj Close'])
+        except (FileNotFoundError, KeyError):
+            file_path = os.path.join(DATA_PATH, stock_name, "stock_data.csv")
+            df = read_stock_csv(file_path).reset_index()
+
+        # Rename columns to the Prophet convention.
         df = df.rename(columns={'Date': 'ds', 'Adj Close': 'y'})
-        df['ds'] = df['ds'].dt.tz_localize(None)
 
     return df
 
 
-def fit_model(stock_name: str, save: bool = False) -> Prophet:
+@instrumented('fit_model', label='stock_name')
+def fit_model(stock_name: str, save: bool = False, warm_start: bool = True) -> 'Prophet':
     """
     Fit a Prophet model to the stock data for a given stock name.
 
     Args:
         stock_name (str): The name of the stock to fit the model to.
-        save (bool): If True, save the model to a pickle file. Defaults to False.
-        model (type): The Prophet model class to use. Defaults to Prophet.
-        forecaster (bool): If True, use the forecasted data. If False (default), use historical data.
+        save (bool): If True, persist the model in the on-disk model cache. Defaults to False.
+        warm_start (bool): If True (default), initialise the fit from the stock's most recently used model.
 
     Returns:
-        Prophet: The fitted Prophet model.
+        Prophet: The fitted Prophet model. A model already fitted on the same data is returned without refitting.
 
     """
     df = load_csv(stock_name, forecaster=False)
-    model = Prophet()
-    model.fit(df)
-    if save:
-        path = DATA_PATH
-        directory = os.path.join(path, stock_name)
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-        model_path = os.path.join(directory, 'prophet_model.pkl')
-        with open(model_path, 'wb') as f:
-            pickle.dump(model, f)
+    fingerprint = prophet_model.data_fingerprint(df)
+    model = model_cache.get(stock_name, fingerprint)
+    if model is not None:
+        return model
+
+    previous = model_cache.latest(stock_name) if warm_start else None
+    model = prophet_model.fit_prophet(df, previous=previous)
+    model_cache.put(stock_name, fingerprint, model, persist=save)
     return model
 
 def load_model(stock_name: str):
     """
-    Load a saved Prophet model from a pickle file.
+    Load the Prophet model fitted on the current stock data from the model cache.
 
     Args:
         stock_name (str): The name of the stock to load the model for.
-        model_name (str): The name of the saved model file.
-        forecaster (bool, optional): If True, load the model from the forecasted_data directory. Otherwise, load the model from the data directory. Default is False.
 
     Returns:
         Prophet: The loaded  model (Prophet by defaut).
-    """
-    # Determine the path to the data directory.
-    path = DATA_PATH
-
-    # Construct the path to the model file.
-    directory = os.path.join(path, stock_name)
-    model_name='prophet'
-    model_path = os.path.join(directory, f"{model_name}_model.pkl")
-
-    # Load the model from the pickle file.
-    with open(model_path, 'rb') as f:
-        model = pickle.load(f)
 
+    Raises:
+        FileNotFoundError: If no model has been fitted on the current data, so a stale model is never used.
+    """
+    fingerprint = prophet_model.data_fingerprint(load_csv(stock_name, forecaster=False))
+    model = model_cache.get(stock_name, fingerprint)
+    if model is None:
+        raise FileNotFoundError('no model fitted on the current data of ' + stock_name)
     return model
 
 
@@ -125,27 +129,21 @@ def plot_training_accuracy(stock_name: str, save: bool = True, show: bool = True
     # Generate forecast using the model
     forecast = model.predict(df)
 
-    # Plot actual and predicted values
-    plt.plot(df['ds'], df['y'], label='Actual')
-    plt.plot(forecast['ds'], forecast['yhat'], label='Predicted')
-    plt.legend()
-    plt.title('Training Set Accuracy')
-    plt.xlabel('Date')
-    plt.ylabel('Value')
-
-    # Save the plot if save=True
-    if save:
-        directory = os.path.join(FIGURE_PATH, stock_name)
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-        plot_path = os.path.join(directory, "training_set_accuracy.png")
-        plt.savefig(plot_path)
+    # Plot actual and predicted values on a figure of its own
+    fig, ax = new_figure(show)
+    ax.plot(df['ds'], df['y'], label='Actual')
+    ax.plot(forecast['ds'], forecast['yhat'], label='Predicted')
+    ax.legend()
+    ax.set_title('Training Set Accuracy')
+    ax.set_xlabel('Date')
+    ax.set_ylabel('Value')
 
-    # Display the plot if show=True
-    if show:
-        plt.show()
+    # Save and/or display the plot, then release the figure
+    plot_path = os.path.join(FIGURE_PATH, stock_name, "training_set_accuracy.png") if save else None
+    finish_figure(fig, plot_path, show)
 
 
+@instrumented('forecast', label='stock_name')
 def forecast(stock_name: str, horizon: int,save=False):
     """
     Forecast the stock price using the Prophet model.
@@ -163,8 +161,8 @@ def forecast(stock_name: str, horizon: int,save=False):
                                            - The second dataframe contains the lower and upper bounds of the forecast.
     """
     model=load_model(stock_name)
-    # Create future dates for forecasting
-    future = model.make_future_dataframe(periods=horizon)
+    # Create future dates for forecasting, leaving out the history
+    future = model.make_future_dataframe(periods=horizon, include_history=False)
     # Forecast future stock prices using the model
     forecast = model.predict(future)
 
@@ -176,13 +174,41 @@ def forecast(stock_name: str, horizon: int,save=False):
             os.makedirs(directory)
         forecast_path = os.path.join(directory, "stock_data.csv")
         print('saved in: '+str(forecast_path))
-        forecast[['ds', 'yhat', 'yhat_lower', 'yhat_upper']].tail(horizon).to_csv(forecast_path, index=False)
+        forecast[['ds', 'yhat', 'yhat_lower', 'yhat_upper']].to_csv(forecast_path, index=False)
     
-    return forecast[['ds', 'yhat', 'yhat_lower', 'yhat_upper']].tail(horizon)
+    return forecast[['ds', 'yhat', 'yhat_lower', 'yhat_upper']]
+
 
 
 
 
+FORECAST_FIELDS = ('yhat', 'yhat_lower', 'yhat_upper')
+
+
+def forecast_batch(stock_names: List[str], horizon: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Forecast several stocks at once into one contiguous array, predicting only the future rows.
+
+    Args:
+        stock_names (list): The names of the stocks to forecast.
+        horizon (int): The number of periods to forecast.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: A tuple of two arrays:
+                                       - The forecasts, of shape (stocks, horizon, 3), with FORECAST_FIELDS along the last axis.
+                                       - The forecast dates, of shape (stocks, horizon).
+    """
+    values = np.empty((len(stock_names), horizon, len(FORECAST_FIELDS)))
+    dates = np.empty((len(stock_names), horizon), dtype='datetime64[ns]')
+    for i, stock_name in enumerate(stock_names):
+        model = load_model(stock_name)
+        with span('forecast', ticker=stock_name):
+            future = model.make_future_dataframe(periods=horizon, include_history=False)
+            prediction = model.predict(future)
+        values[i] = prediction[list(FORECAST_FIELDS)].to_numpy()
+        dates[i] = future['ds'].to_numpy()
+    return values, dates
+
 
 def plot_forecast(stock_name: str, forecast: pd.DataFrame, save: bool = True, show: bool = True) -> None:
     """
@@ -201,34 +227,201 @@ def plot_forecast(stock_name: str, forecast: pd.DataFrame, save: bool = True, sh
     """
     # Check if the required columns are present
 
-    # Plot the forecast and confidence intervals
-    plt.plot(forecast['ds'], forecast['yhat'], label='Predicted')
-    plt.fill_between(forecast['ds'], forecast['yhat_lower'], forecast['yhat_upper'], alpha=0.2)
-    plt.legend()
-    plt.title(f"Forecast for {stock_name}")
-    plt.xlabel('Date')
-    plt.ylabel('Value')
+    # Plot the forecast and confidence intervals on a figure of its own
+    fig, ax = new_figure(show)
+    ax.plot(forecast['ds'], forecast['yhat'], label='Predicted')
+    ax.fill_between(forecast['ds'], forecast['yhat_lower'], forecast['yhat_upper'], alpha=0.2)
+    ax.legend()
+    ax.set_title(f"Forecast for {stock_name}")
+    ax.set_xlabel('Date')
+    ax.set_ylabel('Value')
+
+    # Save and/or show the plot, then release the figure
+    plot_path = os.path.join(FORECAST_PATH, stock_name, "forecast.png") if save else None
+    finish_figure(fig, plot_path, show)
 
-    # Save the plot to a file if requested
-    if save:
-        path = FORECAST_PATH
-        directory = os.path.join(path, stock_name)
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-        plot_path = os.path.join(directory, "forecast.png")
-        plt.savefig(plot_path)
 
-    # Show the plot on screen if requested
-    if show:
-        plt.show()
+def _pin_threads(threads: int = 1) -> None:
+    """
+    Limit Stan and the BLAS/OpenMP pools of the current process so that parallel workers don't oversubscribe the cores.
+
+    The pools of the libraries already loaded, such as numpy's BLAS inherited from the parent, ignore
+    the environment and are resized with threadpoolctl; the variables cover the libraries loaded later
+    and the cmdstan subprocesses.
+    """
+    from threadpoolctl import threadpool_limits
+    for variable in ('STAN_NUM_THREADS', 'OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        os.environ[variable] = str(threads)
+    threadpool_limits(threads)
+
+
+def _train_worker(stock_name: str, horizon: int, connection) -> None:
+    """
+    Fit and forecast one stock in a worker process and send back (forecast, error).
+    """
+    _pin_threads()
+    try:
+        fit_model(stock_name, save=True)
+        connection.send((forecast(stock_name, horizon, save=True), None))
+    except Exception as error:
+        connection.send((None, repr(error)))
+    finally:
+        connection.close()
+
+
+def train_universe(stocks: List[str], horizon: int = 180, workers: Optional[int] = None,
+                   timeout: float = 900.0) -> Iterator[Tuple[str, Optional[pd.DataFrame], Optional[str]]]:
+    """
+    Fit and forecast several stocks in parallel, one worker process per stock.
+
+    Args:
+        stocks (list): The names of the stocks to train.
+        horizon (int): The number of periods to forecast.
+        workers (int, optional): The maximum number of concurrent worker processes. Defaults to the number of cores.
+        timeout (float): Seconds after which a stock's worker is killed.
+
+    Yields:
+        Tuple[str, pd.DataFrame, str]: (stock name, forecast, error) as soon as each stock finishes.
+                                       The forecast is None and error is set when the stock failed or timed out.
+    """
+    workers = workers or os.cpu_count() or 1
+    pending = list(stocks)
+    running = {}
+
+    while pending or running:
+        while pending and len(running) < workers:
+            stock_name = pending.pop(0)
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=_train_worker, args=(stock_name, horizon, sender), daemon=True)
+            process.start()
+            sender.close()
+            running[receiver] = (stock_name, process, time.monotonic() + timeout)
+
+        next_deadline = min(deadline for _, _, deadline in running.values())
+        for receiver in wait(list(running), timeout=max(0.0, next_deadline - time.monotonic())):
+            stock_name, process, _ = running.pop(receiver)
+            try:
+                result, error = receiver.recv()
+            except EOFError:
+                process.join()
+                result, error = None, 'worker exited with code ' + str(process.exitcode)
+            receiver.close()
+            process.join()
+            yield stock_name, result, error
+
+        now = time.monotonic()
+        for receiver, (stock_name, process, deadline) in list(running.items()):
+            if now >= deadline:
+                process.terminate()
+                process.join()
+                receiver.close()
+                del running[receiver]
+                yield stock_name, None, 'timed out after ' + str(timeout) + 's'
+
+
+def _fake_fit_model(stock_name: str, save: bool = False) -> None:
+    if stock_name == 'FAIL':
+        raise RuntimeError('no data for ' + stock_name)
+    if stock_name == 'SLOW':
+        time.sleep(30)
+
+
+def _fake_forecast(stock_name: str, horizon: int, save: bool = False) -> pd.DataFrame:
+    return pd.DataFrame({'ds': pd.date_range('2020-01-01', periods=horizon), 'yhat': 1.0})
+
+
+class _StubModel:
+    """
+    Stand-in for a fitted Prophet model over daily history ending on 2020-12-31.
+    """
+    def __init__(self, level: float):
+        self.level = level
+        self.predicted_rows = 0
+
+    def make_future_dataframe(self, periods: int, include_history: bool = True) -> pd.DataFrame:
+        dates = pd.date_range('2020-01-01', '2020-12-31') if include_history else pd.DatetimeIndex([])
+        return pd.DataFrame({'ds': dates.append(pd.date_range('2021-01-01', periods=periods))})
+
+    def predict(self, future: pd.DataFrame) -> pd.DataFrame:
+        self.predicted_rows += len(future)
+        yhat = self.level + np.arange(len(future), dtype=float)
+        return pd.DataFrame({'ds': future['ds'], 'yhat': yhat, 'yhat_lower': yhat - 1, 'yhat_upper': yhat + 1})
+
+
+# Test cases for the forecasts, with a stub in place of the cached Prophet models
+class TestForecast(unittest.TestCase):
+    def setUp(self) -> None:
+        self.models = {'AAA': _StubModel(10.0), 'BBB': _StubModel(20.0)}
+        patch = mock.patch(__name__ + '.load_model', self.models.get)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_forecast_batch(self) -> None:
+        values, dates = forecast_batch(['AAA', 'BBB'], horizon=4)
+        self.assertEqual(values.shape, (2, 4, 3))
+        self.assertEqual(dates.shape, (2, 4))
+        np.testing.assert_array_equal(dates[1], pd.date_range('2021-01-01', periods=4).to_numpy())
+        np.testing.assert_allclose(values[:, :, 0], [[10, 11, 12, 13], [20, 21, 22, 23]])
+        np.testing.assert_allclose(values[0, :, 2] - values[0, :, 1], 2)
+        # Only the future rows are predicted
+        self.assertEqual([model.predicted_rows for model in self.models.values()], [4, 4])
+
+    def test_forecast(self) -> None:
+        forecasted = forecast('AAA', horizon=3)
+        self.assertEqual(list(forecasted.columns), ['ds', 'yhat', 'yhat_lower', 'yhat_upper'])
+        self.assertEqual(forecasted['ds'].iloc[0], pd.Timestamp('2021-01-01'))
+        self.assertEqual(len(forecasted), 3)
+        self.assertEqual(self.models['AAA'].predicted_rows, 3)
+
+
+# Test cases for the parallel training, with the fit and forecast replaced in the forked workers
+@unittest.skipUnless(multiprocessing.get_start_method() == 'fork', 'the patched functions only reach forked workers')
+class TestTrainUniverse(unittest.TestCase):
+    def setUp(self) -> None:
+        patches = [mock.patch(__name__ + '.fit_model', _fake_fit_model),
+                   mock.patch(__name__ + '.forecast', _fake_forecast)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_failures_and_timeouts_are_isolated(self) -> None:
+        start = time.monotonic()
+        results = list(train_universe(['SLOW', 'FAIL', 'OK'], horizon=5, workers=3, timeout=2.0))
+        self.assertLess(time.monotonic() - start, 20)
+        # Results stream in completion order: the timed out stock comes last
+        self.assertEqual([stock for stock, _, _ in results][-1], 'SLOW')
+        outcomes = {stock: (forecasted, error) for stock, forecasted, error in results}
+        self.assertEqual(len(outcomes['OK'][0]), 5)
+        self.assertIsNone(outcomes['OK'][1])
+        self.assertIsNone(outcomes['FAIL'][0])
+        self.assertIn('no data for FAIL', outcomes['FAIL'][1])
+        self.assertIsNone(outcomes['SLOW'][0])
+        self.assertEqual(outcomes['SLOW'][1], 'timed out after 2.0s')
+
+    def test_pin_threads(self) -> None:
+        from threadpoolctl import threadpool_info, threadpool_limits
+        with threadpool_limits(), mock.patch.dict(os.environ):
+            _pin_threads()
+            self.assertEqual(os.environ['STAN_NUM_THREADS'], '1')
+            self.assertTrue(all(info['num_threads'] == 1 for info in threadpool_info()))
+
+    def test_worker_limit(self) -> None:
+        results = list(train_universe(['A', 'FAIL', 'B'], horizon=3, workers=1))
+        self.assertEqual([stock for stock, _, _ in results], ['A', 'FAIL', 'B'])
+        self.assertEqual([error is None for _, _, error in results], [True, False, True])
 
 
 if __name__ == '__main__':
-    for stock in company_dict.keys():
-        print('Training model for '+str(stock))
-        fit_model(stock,save=True)
-        print('Forecasting 180 days of '+str(stock))
-        forecast = forecast(stock, horizon=180)
-        print('Plotting forecast for '+str(stock))
-        plot_forecast(stock, forecast)
+    forecasts = {}
+    for stock, forecasted, error in train_universe(list(company_dict.keys()), horizon=180):
+        if error is not None:
+            print('Failed for '+str(stock)+': '+error)
+            continue
+        forecasts[stock] = forecasted
         print('Done for '+str(stock))
+
+    # The render pool owns threads, so it is only started once the training workers are no longer forked
+    with RenderPool() as render_pool:
+        for stock, forecasted in forecasts.items():
+            print('Plotting forecast for '+str(stock))
+            render_pool.submit(plot_forecast, stock, forecasted)
@@ -1,36 +1,105 @@
 import os
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import numpy as np
 import pandas as pd
-import yfinance as yf
 import warnings
-import matplotlib.pyplot as plt
-import riskfolio as rp
-from typing import Dict, Union
+from typing import Dict, Optional, Tuple, Union
 
+from lazy import lazy_import
 from step1 import load_csv
-from constants import DATA_PATH, FORECAST_PATH, FIGURE_PATH, company_dict
+from returns_matrix import ReturnsMatrix
+from plotting import finish_figure, new_figure
+from constants import DATA_PATH, FORECAST_PATH, FIGURE_PATH, PRICE_STORE_PATH, company_dict
+
+rp = lazy_import('riskfolio')
 
 warnings.filterwarnings("ignore")
 pd.options.display.float_format = '{:.4%}'.format
 
-def read_data(assets: list, forecasted: bool = True) -> pd.DataFrame:
+MISSING_POLICIES = ('drop', 'ffill', 'keep')
+
+def _load_series(stock: str, forecasted: bool) -> pd.Series:
     """
-    Download forecasted or historical price data for several assets and creates an aggregated dataframe.
+    Load the prices of one ticker as a float64 Series indexed by naive dates.
     """
-    aggregated=pd.DataFrame()
-    for stock in assets:
-        temp=load_csv(stock,forecasted)
-        if forecasted:
-            aggregated[stock]=temp['yhat']
-        else:
-            aggregated[stock]=temp['y']
-
-def calculate_returns(data: pd.DataFrame) -> pd.DataFrame:
+    df = load_csv(stock, forecasted)
+    dates = pd.to_datetime(df['ds'], utc=True).dt.tz_localize(None)
+    return pd.Series(df['y'].to_numpy(dtype='float64'), index=pd.DatetimeIndex(dates, name='Date'), name=stock)
+
+def _source_versions(assets: Tuple[str, ...], forecasted: bool) -> Tuple[int, ...]:
     """
-    Calculate the percentage returns of the assets.
+    Modification times of the files the panel is read from (-1 when missing), so a rewritten source changes the cache key.
+    """
+    if forecasted:
+        paths = [os.path.join(FORECAST_PATH, stock, 'stock_data.csv') for stock in assets]
+    else:
+        paths = [PRICE_STORE_PATH] + [os.path.join(DATA_PATH, stock, 'stock_data.csv') for stock in assets]
+    return tuple(os.stat(path).st_mtime_ns if os.path.exists(path) else -1 for path in paths)
+
+@lru_cache(maxsize=16)
+def _read_panel(assets: Tuple[str, ...], start: Optional[str], end: Optional[str], forecasted: bool,
+                missing: str, workers: int, versions: Tuple[int, ...] = ()) -> pd.DataFrame:
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        series = list(executor.map(_load_series, assets, [forecasted] * len(assets)))
+
+    # One outer join on the dates instead of assigning the columns one by one by position
+    return align_panel(pd.concat(series, axis=1, join='outer'), start, end, missing)
+
+def align_panel(data: pd.DataFrame, start: Optional[str] = None, end: Optional[str] = None,
+                missing: str = 'ffill') -> pd.DataFrame:
+    """
+    Sort and deduplicate the dates of a dates x tickers panel, then apply a missing-data policy (see read_data).
+    """
+    if missing not in MISSING_POLICIES:
+        raise ValueError("missing must be one of " + str(MISSING_POLICIES) + ", got " + str(missing))
+    data = data.sort_index()
+    data = data[~data.index.duplicated(keep='last')]
+    if missing == 'ffill':
+        # Fill before cutting the range so the first dates carry the last price known before start
+        data = data.ffill()
+    data = data.loc[start:end]
+    return data if missing == 'keep' else data.dropna()
+
+def read_data(assets: list, start: Optional[str] = None, end: Optional[str] = None, forecasted: bool = True,
+              missing: str = 'ffill', workers: int = 8) -> pd.DataFrame:
+    """
+    Load forecasted or historical price data for several assets into a date-aligned dates x tickers panel.
+
+    The tickers are loaded concurrently and the result is memoized per (assets, start, end, forecasted, missing)
+    and modification time of the price store or forecast files, so step2 and step3 share the same panel and
+    an ingest or a new forecast is picked up by the next call. A copy is returned, so callers may modify it.
+    _read_panel.cache_clear() drops every memoized panel.
+
+    Args:
+        assets (list): Tickers to load.
+        start (str, optional): First date to keep (inclusive).
+        end (str, optional): Last date to keep (inclusive).
+        forecasted (bool): If True, load the forecasts. Otherwise, load the historical prices.
+        missing (str): What to do with dates missing for some tickers: 'ffill' carries the last price forward
+                       and drops the dates before every ticker has a price, 'drop' keeps only the dates common
+                       to every ticker and 'keep' leaves NaN.
+        workers (int): Number of loader threads.
+
+    Returns:
+        pd.DataFrame: A float64 DataFrame indexed by date with one column per asset.
     """
+    if missing not in MISSING_POLICIES:
+        raise ValueError("missing must be one of " + str(MISSING_POLICIES) + ", got " + str(missing))
+    assets = tuple(assets)
+    return _read_panel(assets, start, end, forecasted, missing, workers, _source_versions(assets, forecasted)).copy()
 
-    return data.pct_change().dropna()
+def calculate_returns(data: pd.DataFrame, dtype: Optional[str] = None, path: Optional[str] = None) -> pd.DataFrame:
+    """
+    Calculate the percentage returns of the assets.
+
+    With a dtype (e.g. 'float32') or a memory map path, the returns are computed in chunks into a compact
+    ReturnsMatrix and returned as a DataFrame view of it (see step3.calculate_returns).
+    """
+    if dtype is None and path is None:
+        return data.pct_change().dropna()
+    return ReturnsMatrix.from_prices(data, dtype=dtype or np.float64, path=path).to_frame()
 
 def build_portfolio(returns: pd.DataFrame, equal_weights: bool = True) -> pd.DataFrame:
     """
@@ -45,7 +114,8 @@ def build_portfolio(returns: pd.DataFrame, equal_weights: bool = True) -> pd.Dat
         # User can initialize the weights here
         weights = pd.Series({asset: 1/len(returns.columns) for asset in returns.columns})
 
-    portfolio
+    portfolio.w = weights.to_frame('weights')
+    return weights
 
 def plot_portfolio_repartition(weights: pd.Series, start: str, end: str, forecasted: bool = True, show: bool = True, save: bool = True) -> None:
     """
@@ -54,15 +124,62 @@ def plot_portfolio_repartition(weights: pd.Series, start: str, end: str, forecas
     title = 'Portfolio Repartition'
     plot_filename = f"portfolio_repartition_{start}_{end}_{'forecasted' if forecasted else 'original'}.png"
 
-    ax = weights.plot.pie(autopct='%.1f%%', figsize=(10, 6), cmap="tab20")
+    fig, ax = new_figure(show)
+    weights.plot.pie(autopct='%.1f%%', cmap="tab20", ax=ax)
     ax.set_title(title)
     ax.set_ylabel("")
 
-    if save:
-        plot_path = os.path.join(FIGURE_PATH, plot_filename)
-        plt.savefig(plot_path)
-    if show:
-        plt.show()
+    plot_path = os.path.join(FIGURE_PATH, plot_filename) if save else None
+    finish_figure(fig, plot_path, show)
+
+# Test cases for the panel loader
+class TestReadData(unittest.TestCase):
+    def setUp(self) -> None:
+        dates = pd.date_range('2020-01-01', periods=6)
+        self.frames = {
+            'A': pd.DataFrame({'ds': dates, 'y': np.arange(6.0)}),
+            'B': pd.DataFrame({'ds': dates[[0, 2, 3, 5]], 'y': [10.0, 12.0, 13.0, 15.0]}),
+        }
+        _read_panel.cache_clear()
+
+    def read(self, **kwargs) -> pd.DataFrame:
+        from unittest import mock
+        with mock.patch(__name__ + '.load_csv', side_effect=lambda stock, forecasted: self.frames[stock]) as loader:
+            data = read_data(['A', 'B'], forecasted=False, **kwargs)
+            read_data(['A', 'B'], forecasted=False, **kwargs)
+        self.assertEqual(loader.call_count, 2)
+        return data
+
+    def test_alignment_and_policies(self) -> None:
+        kept = self.read(missing='keep')
+        self.assertEqual(kept.shape, (6, 2))
+        self.assertTrue((kept.dtypes == 'float64').all())
+        self.assertTrue(np.isnan(kept.loc['2020-01-02', 'B']))
+        self.assertEqual(kept.loc['2020-01-04', 'B'], 13.0)
+        self.assertEqual(self.read(missing='drop').index.size, 4)
+        filled = self.read(missing='ffill', start='2020-01-02', end='2020-01-05')
+        self.assertEqual(filled['B'].tolist(), [10.0, 12.0, 13.0, 13.0])
+
+    def test_reload_after_source_change(self) -> None:
+        from unittest import mock
+        with mock.patch(__name__ + '.load_csv', side_effect=lambda stock, forecasted: self.frames[stock]) as loader, \
+                mock.patch(__name__ + '._source_versions', side_effect=[(1, 1), (1, 1), (2, 1)]):
+            read_data(['A', 'B'])
+            self.frames['A'] = self.frames['A'].assign(y=100.0)
+            self.assertEqual(read_data(['A', 'B'])['A'].iloc[-1], 5.0)
+            self.assertEqual(read_data(['A', 'B'])['A'].iloc[-1], 100.0)
+        self.assertEqual(loader.call_count, 4)
+
+    def test_align_panel(self) -> None:
+        dates = pd.to_datetime(['2020-01-03', '2020-01-01', '2020-01-02', '2020-01-03'])
+        panel = pd.DataFrame({'A': [3.0, 1.0, 2.0, 4.0], 'B': [np.nan, 10.0, np.nan, 30.0]}, index=dates)
+        self.assertEqual(align_panel(panel)['B'].tolist(), [10.0, 10.0, 30.0])
+        self.assertEqual(align_panel(panel, missing='drop')['A'].tolist(), [1.0, 4.0])
+        self.assertEqual(align_panel(panel, start='2020-01-02', missing='keep').shape, (2, 2))
+
+    def test_invalid_policy(self) -> None:
+        with self.assertRaises(ValueError):
+            read_data(['A'], missing='zero')
 
 if __name__ == '__main__':
     # User settings
@@ -74,8 +191,8 @@ if __name__ == '__main__':
     assets = list(company_dict.keys())
     assets.sort()
 
-    # Download data
-    data = download_data(assets, start=start_date, end=end_date, forecasted=forecasted_data)
+    # Load data
+    data = read_data(assets, start=start_date, end=end_date, forecasted=forecasted_data)
 
     # Calculate returns
     returns = calculate_returns(data)
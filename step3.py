@@ -1,59 +1,171 @@
+from __future__ import annotations
+
 import pandas as pd
 import numpy as np
-import riskfolio as rp
-import matplotlib.pyplot as plt
-from typing import Tuple
+from typing import Optional, Tuple, Union
+
+from lazy import lazy_import
+from instrument import span
+from plotting import finish_figure, new_figure
+from estimators import factor_covariance, ledoit_wolf
+from returns_matrix import ReturnsMatrix
+
+# riskfolio and cvxpy take seconds to import, so they are only loaded by the functions using them
+rp = lazy_import('riskfolio')
+frontier_engine = lazy_import('frontier')
+solvers = lazy_import('solvers')
+hierarchical = lazy_import('hierarchical')
 
-def calculate_returns(data: pd.DataFrame, assets: list) -> pd.DataFrame:
+# Covariance estimators kept in factored form (loadings plus diagonal) instead of a dense N x N matrix
+FACTORED_COV = {'ledoit_wolf': ledoit_wolf, 'factor': factor_covariance}
+
+def calculate_returns(data: pd.DataFrame, assets: list, dtype: Optional[str] = None, path: Optional[str] = None) -> pd.DataFrame:
     """
     Calculate the returns of the given assets.
+
+    With a dtype (e.g. 'float32') or a memory map path, the returns are computed in chunks into a compact
+    ReturnsMatrix (see returns_matrix.py) and returned as a DataFrame view of it, without intermediate copies.
     """
-    return data[assets].pct_change().dropna()
+    if dtype is None and path is None:
+        return data[assets].pct_change().dropna()
+    return ReturnsMatrix.from_prices(data, assets, dtype=dtype or np.float64, path=path).to_frame()
 
-def build_portfolio(returns: pd.DataFrame) -> rp.Portfolio:
+def read_returns(assets: list, start: Optional[str] = None, end: Optional[str] = None, forecasted: bool = False) -> pd.DataFrame:
     """
-    Build a portfolio object using the given returns.
+    Calculate the returns of the assets from the memoized price panel shared with step2 (see step2.read_data).
     """
+    from step2 import read_data
+    return calculate_returns(read_data(assets, start=start, end=end, forecasted=forecasted), assets)
+
+def build_portfolio(returns: Union[pd.DataFrame, ReturnsMatrix]) -> rp.Portfolio:
+    """
+    Build a portfolio object using the given returns. A ReturnsMatrix is passed as a view, without copying it.
+    """
+    if isinstance(returns, ReturnsMatrix):
+        returns = returns.to_frame()
     return rp.Portfolio(returns=returns)
 
-def estimate_assets_stats(portfolio: rp.Portfolio, method_mu: str = 'hist', method_cov: str = 'hist', d: float = 0.94) -> None:
+def estimate_assets_stats(portfolio: rp.Portfolio, method_mu: str = 'hist', method_cov: str = 'hist', d: float = 0.94, factors: int = 10) -> None:
     """
     Estimate asset statistics using the given methods.
+
+    method_cov may also be 'ledoit_wolf' or 'factor' (a statistical model), both of rank at most factors;
+    these covariances are kept in factored form in portfolio.cov_factors and portfolio.cov is only filled in
+    when a riskfolio optimization needs it.
+    """
+    with span('assets_stats', method_mu=method_mu, method_cov=method_cov, assets=portfolio.returns.shape[1]):
+        if method_cov in FACTORED_COV:
+            portfolio.mu = rp.mean_vector(portfolio.returns, method=method_mu, d=d)
+            portfolio.cov = None
+            portfolio.cov_factors = FACTORED_COV[method_cov](portfolio.returns, factors)
+        else:
+            portfolio.assets_stats(method_mu=method_mu, method_cov=method_cov, d=d)
+            portfolio.cov_factors = None
+
+def set_assets_stats(portfolio: rp.Portfolio, mu: np.ndarray, cov: np.ndarray) -> None:
     """
-    portfolio.assets_stats(method_mu=method_mu, method_cov=method_cov, d=d)
+    Set precomputed asset statistics, e.g. from a streaming estimator of estimators.py, in place of estimate_assets_stats.
+    """
+    assets = portfolio.returns.columns
+    portfolio.mu = pd.DataFrame(np.asarray(mu, dtype=float).reshape(1, -1), columns=assets)
+    portfolio.cov = pd.DataFrame(np.asarray(cov, dtype=float), index=assets, columns=assets)
+    portfolio.cov_factors = None
 
-def optimize_portfolio(portfolio: rp.Portfolio, model: str = 'Classic', rm: str = 'MV', obj: str = 'Sharpe', rf: float = 0, l: float = 0, hist: bool = True) -> pd.DataFrame:
+def densify_cov(portfolio: rp.Portfolio) -> None:
     """
-    Optimize the portfolio using the given parameters.
+    Fill in portfolio.cov from a factored covariance for the riskfolio routines that need the dense matrix.
     """
-    return portfolio.optimization(model=model, rm=rm, obj=obj, rf=rf, l=l, hist=hist)
+    factors = getattr(portfolio, 'cov_factors', None)
+    if factors is not None and portfolio.cov is None:
+        portfolio.cov = factors.to_frame()
+
+def optimize_portfolio(portfolio: rp.Portfolio, model: str = 'Classic', rm: str = 'MV', obj: str = 'Sharpe', rf: float = 0, l: float = 0, hist: bool = True, linkage: str = 'single', k: Optional[int] = None) -> pd.DataFrame:
+    """
+    Optimize the portfolio using the given parameters.
 
-def plot_pie(weights: pd.DataFrame) -> None:
+    With a factored covariance, 'Classic' mean-variance problems are solved directly on the factors;
+    anything else densifies the covariance once for riskfolio.
+
+    model may also be 'HRP' or 'HERC' for a hierarchical clustering allocation of the covariance with the
+    given linkage (and k HERC clusters), which needs no solver and scales to thousands of assets
+    (see hierarchical.py); only rm='MV' is supported and obj, rf and l are ignored.
+    """
+    factors = getattr(portfolio, 'cov_factors', None)
+    with span('optimization', model=model, rm=rm, obj=obj, assets=portfolio.returns.shape[1]):
+        if model in ('HRP', 'HERC'):
+            if rm != 'MV':
+                raise ValueError("hierarchical models only support rm='MV', got " + str(rm))
+            if portfolio.cov is not None:
+                cov = portfolio.cov.to_numpy()
+            elif factors is not None:
+                cov = factors.dense()
+            else:
+                cov = np.cov(portfolio.returns.to_numpy(dtype=float), rowvar=False)
+            weights = hierarchical.hierarchical_weights(cov, model=model, linkage=linkage, k=k)
+            portfolio.w = pd.DataFrame(weights, index=portfolio.returns.columns, columns=['weights'])
+            return portfolio.w
+        if factors is not None and model == 'Classic' and rm == 'MV' and hist:
+            problem = solvers.MeanVarianceProblem(len(factors.assets), rank=factors.rank)
+            problem.set_inputs(portfolio.mu, factors=factors)
+            weights = problem.solve(obj=obj, rf=rf, l=l)
+            if weights is None:
+                return None
+            portfolio.w = pd.DataFrame(weights, index=factors.assets, columns=['weights'])
+            return portfolio.w
+        densify_cov(portfolio)
+        return portfolio.optimization(model=model, rm=rm, obj=obj, rf=rf, l=l, hist=hist)
+
+def plot_pie(weights: pd.DataFrame, path: Optional[str] = None, show: bool = True) -> None:
     """
-    Plot the composition of the portfolio as a pie chart.
+    Plot the composition of the portfolio as a pie chart, saved to path if given.
     """
-    rp.plot_pie(w=weights, title='Sharpe Mean Variance', others=0.05, nrow=25, cmap="tab20", height=6, width=10, ax=None)
-    plt.show()
+    fig, ax = new_figure(show)
+    rp.plot_pie(w=weights, title='Sharpe Mean Variance', others=0.05, nrow=25, cmap="tab20", height=6, width=10, ax=ax)
+    finish_figure(fig, path, show)
 
-def efficient_frontier(portfolio: rp.Portfolio, model: str = 'Classic', rm: str = 'MV', points: int = 50, rf: float = 0, hist: bool = True) -> pd.DataFrame:
+def efficient_frontier(portfolio: rp.Portfolio, model: str = 'Classic', rm: str = 'MV', points: int = 50, rf: float = 0, hist: bool = True, workers: int = 1) -> pd.DataFrame:
     """
-    Calculate the efficient frontier of the portfolio.
+    Calculate the efficient frontier of the portfolio, in parallel and cached by (mu, cov, rm, rf) (see frontier.py).
     """
-    return portfolio.efficient_frontier(model=model, rm=rm, points=points, rf=rf, hist=hist)
+    densify_cov(portfolio)
+    return frontier_engine.efficient_frontier(portfolio, model=model, rm=rm, points=points, rf=rf, hist=hist, workers=workers)
+
+def resampled_frontier(portfolio: rp.Portfolio, forecasts: Optional[np.ndarray] = None, last_prices: Optional[np.ndarray] = None, scenarios: int = 1000, points: int = 50, obj: Optional[str] = None, rf: float = 0, workers: int = 1) -> pd.DataFrame:
+    """
+    Resampled efficient frontier (or obj portfolio) from the portfolio's statistics (see frontier.resampled_frontier).
+
+    When forecasts from step1.forecast_batch and the last prices are given, the expected returns come from
+    the forecasts and their intervals set the uncertainty of each scenario's expected returns.
+    """
+    densify_cov(portfolio)
+    mu, se = np.asarray(portfolio.mu, dtype=float).ravel(), None
+    if forecasts is not None:
+        mu, se = frontier_engine.forecast_return_moments(forecasts, np.asarray(last_prices, dtype=float))
+    weights = frontier_engine.resampled_frontier(mu, portfolio.cov.to_numpy(), se=se, n_obs=len(portfolio.returns), scenarios=scenarios, points=points, obj=obj, rf=rf, workers=workers)
+    if obj:
+        return pd.DataFrame(weights, index=portfolio.cov.columns, columns=['weights'])
+    return pd.DataFrame(weights, index=portfolio.cov.columns)
 
-def plot_frontier(portfolio: rp.Portfolio, frontier: pd.DataFrame, rm: str = 'MV', rf: float = 0, label: str = 'Max Risk Adjusted Return Portfolio') -> None:
+def plot_frontier(portfolio: rp.Portfolio, frontier: Optional[pd.DataFrame] = None, rm: str = 'MV', rf: float = 0, label: str = 'Max Risk Adjusted Return Portfolio', path: Optional[str] = None, show: bool = True) -> None:
     """
-    Plot the efficient frontier of the portfolio.
+    Plot the efficient frontier of the portfolio, saved to path if given. The cached frontier is used when none is given.
     """
-    ax = rp.plot_frontier(w_frontier=frontier, mu=portfolio.mu, cov=portfolio.cov, returns=portfolio.returns, rm=rm, rf=rf, alpha=0.05, cmap='viridis', w=portfolio.w, label=label, marker='*', s=16, c='r', height=6, width=10, ax=None)
-    plt.show()
+    if frontier is None:
+        frontier = efficient_frontier(portfolio, rm=rm, rf=rf)
+    densify_cov(portfolio)
+    fig, ax = new_figure(show)
+    rp.plot_frontier(w_frontier=frontier, mu=portfolio.mu, cov=portfolio.cov, returns=portfolio.returns, rm=rm, rf=rf, alpha=0.05, cmap='viridis', w=portfolio.w, label=label, marker='*', s=16, c='r', height=6, width=10, ax=ax)
+    finish_figure(fig, path, show)
 
-def plot_frontier_area(frontier: pd.DataFrame) -> None:
+def plot_frontier_area(frontier: Optional[pd.DataFrame] = None, portfolio: Optional[rp.Portfolio] = None, rm: str = 'MV', rf: float = 0, path: Optional[str] = None, show: bool = True) -> None:
     """
-    Plot the efficient frontier composition as an area chart.
+    Plot the efficient frontier composition as an area chart, saved to path if given. The cached frontier of the portfolio is used when none is given.
     """
-    rp.plot_frontier_area(w_frontier=frontier, cmap="tab20", height=6, width=10, ax=None)
-    plt.show()
+    if frontier is None:
+        frontier = efficient_frontier(portfolio, rm=rm, rf=rf)
+    fig, ax = new_figure(show)
+    rp.plot_frontier_area(w_frontier=frontier, cmap="tab20", height=6, width=10, ax=ax)
+    finish_figure(fig, path, show)
 
 if __name__ == '__main__':
     pass
\ No newline at end of file
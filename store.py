@@ -0,0 +1,256 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from constants import DATA_PATH, PRICE_STORE_PATH
+
+
+class PriceStore:
+    """
+    Columnar store holding the price history of every ticker in a single Parquet file.
+
+    Rows are sorted by (ticker, Date) and every ticker is written as its own row group, so
+    ticker and date filters are pushed down to the row group statistics and only the
+    requested columns are decoded. Dates are stored as int64 nanoseconds since the epoch (UTC).
+    """
+
+    def __init__(self, path: str = PRICE_STORE_PATH):
+        self.path = path
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def tickers(self) -> List[str]:
+        """
+        List the tickers held in the store.
+        """
+        table = pq.read_table(self.path, columns=['ticker'])
+        return sorted(table.column('ticker').unique().to_pylist())
+
+    def last_dates(self) -> Dict[str, pd.Timestamp]:
+        """
+        Return the last stored date of every ticker, reading only the ticker and date columns.
+        """
+        if not self.exists():
+            return {}
+        df = pq.read_table(self.path, columns=['ticker', 'Date']).to_pandas()
+        last = df.groupby('ticker')['Date'].max()
+        return {stock: pd.Timestamp(value) for stock, value in last.items()}
+
+    def read(self, tickers: Optional[List[str]] = None, columns: Optional[List[str]] = None,
+             start: Optional[str] = None, end: Optional[str] = None) -> pd.DataFrame:
+        """
+        Read prices in long format.
+
+        Args:
+            tickers (list, optional): Tickers to read. Default is every ticker in the store.
+            columns (list, optional): Price columns to read, e.g. ['Adj Close']. Default is all of them.
+            start (str, optional): First date to read (inclusive).
+            end (str, optional): Last date to read (inclusive).
+
+        Returns:
+            pd.DataFrame: A DataFrame with a 'ticker' column, a naive datetime 'Date' column and the price columns.
+        """
+        filters = []
+        if tickers is not None:
+            filters.append(('ticker', 'in', list(tickers)))
+        if start is not None:
+            filters.append(('Date', '>=', _to_int64(start)))
+        if end is not None:
+            filters.append(('Date', '<=', _to_int64(end)))
+        if columns is not None:
+            columns = ['ticker', 'Date'] + [c for c in columns if c not in ('ticker', 'Date')]
+
+        table = pq.read_table(self.path, columns=columns, filters=filters or None)
+        df = table.to_pandas()
+        df['Date'] = df['Date'].values.astype('datetime64[ns]')
+        return df
+
+    def read_ticker(self, stock_name: str, columns: Optional[List[str]] = None,
+                    start: Optional[str] = None, end: Optional[str] = None) -> pd.DataFrame:
+        """
+        Read the price history of a single ticker.
+
+        Returns:
+            pd.DataFrame: A DataFrame with a 'Date' column followed by the price columns.
+
+        Raises:
+            KeyError: If the store holds no rows for this ticker in the requested range.
+        """
+        df = self.read([stock_name], columns=columns, start=start, end=end)
+        if df.empty:
+            raise KeyError(stock_name)
+        return df.drop(columns='ticker').reset_index(drop=True)
+
+    def write(self, frames: Dict[str, pd.DataFrame]) -> None:
+        """
+        Replace the stored history of the given tickers, keeping every other ticker untouched.
+
+        Args:
+            frames (dict): Maps a ticker to a DataFrame indexed by date with one column per price field,
+                           as returned by yfinance.
+        """
+        new = pd.concat([_to_long(stock, frame) for stock, frame in frames.items()], ignore_index=True)
+        if self.exists():
+            old = pq.read_table(self.path).to_pandas()
+            old = old[~old['ticker'].isin(list(frames))]
+            new = pd.concat([old, new], ignore_index=True)
+        self._write_table(new)
+
+    def append(self, frames: Dict[str, pd.DataFrame]) -> None:
+        """
+        Append new rows to the stored history of the given tickers in a single atomic write.
+
+        Rows whose date is already stored are replaced by the new values.
+
+        Args:
+            frames (dict): Maps a ticker to a DataFrame indexed by date with one column per price field.
+        """
+        new = pd.concat([_to_long(stock, frame) for stock, frame in frames.items()], ignore_index=True)
+        if self.exists():
+            old = pq.read_table(self.path).to_pandas()
+            new = pd.concat([old, new], ignore_index=True)
+            new = new.drop_duplicates(['ticker', 'Date'], keep='last')
+        self._write_table(new)
+
+    def _write_table(self, data: pd.DataFrame) -> None:
+        # Write to a temporary file first so readers never see a partially written store.
+        data = data.sort_values(['ticker', 'Date'], kind='mergesort')
+        value_columns = [c for c in data.columns if c not in ('ticker', 'Date')]
+        schema = pa.schema([('ticker', pa.string()), ('Date', pa.int64())]
+                           + [(c, pa.float64()) for c in value_columns])
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # A unique temporary name, so concurrent writers never write into each other's file
+        fd, tmp_path = tempfile.mkstemp(dir=directory or '.', prefix=os.path.basename(self.path) + '.', suffix='.tmp')
+        os.close(fd)
+        try:
+            with pq.ParquetWriter(tmp_path, schema) as writer:
+                for _, group in data.groupby('ticker', sort=False):
+                    writer.write_table(pa.Table.from_pandas(group, schema=schema, preserve_index=False))
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+
+def _to_int64(date) -> int:
+    return pd.Timestamp(date).value
+
+
+def _to_long(stock_name: str, frame: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convert a date indexed price frame to the store's long layout.
+    """
+    dates = pd.to_datetime(frame.index, utc=True).tz_localize(None)
+    long = pd.DataFrame({'ticker': stock_name, 'Date': dates.values.astype('datetime64[ns]').astype('int64')})
+    for column in frame.columns:
+        long[column] = frame[column].to_numpy(dtype='float64')
+    return long
+
+
+def read_stock_csv(file_path: str) -> pd.DataFrame:
+    """
+    Read one legacy DATA_PATH/<ticker>/stock_data.csv file, indexed by naive UTC dates.
+    """
+    df = pd.read_csv(file_path)
+    df['Date'] = pd.to_datetime(df['Date'], utc=True).dt.tz_localize(None)
+    return df.set_index('Date')
+
+
+def migrate_csv_tree(data_path: str = DATA_PATH, store: Optional[PriceStore] = None) -> List[str]:
+    """
+    Load every DATA_PATH/<ticker>/stock_data.csv file into the price store in a single write.
+
+    Args:
+        data_path (str): Root of the per-ticker CSV tree.
+        store (PriceStore, optional): Destination store. Default is the store at PRICE_STORE_PATH.
+
+    Returns:
+        list: The migrated tickers.
+    """
+    store = store or PriceStore()
+    frames = {}
+    for stock_name in sorted(os.listdir(data_path)):
+        file_path = os.path.join(data_path, stock_name, "stock_data.csv")
+        if os.path.isfile(file_path):
+            frames[stock_name] = read_stock_csv(file_path)
+    if frames:
+        store.write(frames)
+    return list(frames)
+
+
+# Test cases for the price store
+class TestPriceStore(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        self.store = PriceStore(os.path.join(self.directory, 'store', 'prices.parquet'))
+        dates = pd.date_range('2020-01-01', periods=10, name='Date')
+        self.frames = {stock: pd.DataFrame({'Adj Close': offset + np.arange(10.0), 'Volume': 1000.0 + offset},
+                                           index=dates)
+                       for stock, offset in [('MSFT', 100.0), ('AAPL', 0.0)]}
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.directory)
+
+    def test_filters_and_projection(self) -> None:
+        self.store.write(self.frames)
+        self.assertEqual(self.store.tickers(), ['AAPL', 'MSFT'])
+        self.assertEqual(pq.ParquetFile(self.store.path).num_row_groups, 2)
+
+        df = self.store.read(['MSFT'], columns=['Adj Close'], start='2020-01-03', end='2020-01-05')
+        self.assertEqual(list(df.columns), ['ticker', 'Date', 'Adj Close'])
+        self.assertEqual(df['Date'].tolist(), list(pd.date_range('2020-01-03', '2020-01-05')))
+        self.assertEqual(df['Adj Close'].tolist(), [102.0, 103.0, 104.0])
+        self.assertEqual(len(self.store.read(start='2020-01-09')), 4)
+
+        history = self.store.read_ticker('AAPL', columns=['Volume'])
+        self.assertEqual(list(history.columns), ['Date', 'Volume'])
+        self.assertRaises(KeyError, self.store.read_ticker, 'AAPL', start='2021-01-01')
+        self.assertRaises(KeyError, self.store.read_ticker, 'TSLA')
+
+    def test_append_and_last_dates(self) -> None:
+        self.assertEqual(self.store.last_dates(), {})
+        self.store.write(self.frames)
+        update = pd.DataFrame({'Adj Close': [-1.0, 10.0], 'Volume': 0.0},
+                              index=pd.to_datetime(['2020-01-10', '2020-01-11']))
+        self.store.append({'AAPL': update})
+        self.assertEqual(self.store.last_dates(), {'AAPL': pd.Timestamp('2020-01-11'), 'MSFT': pd.Timestamp('2020-01-10')})
+        history = self.store.read_ticker('AAPL')
+        self.assertEqual(len(history), 11)
+        self.assertEqual(history['Adj Close'].tolist()[-2:], [-1.0, 10.0])
+        self.assertEqual(len(self.store.read_ticker('MSFT')), 10)
+
+    def test_failed_write_leaves_store(self) -> None:
+        self.store.write(self.frames)
+        with mock.patch.object(pq.ParquetWriter, 'write_table', side_effect=OSError('disk full')):
+            self.assertRaises(OSError, self.store.append, {'AAPL': self.frames['AAPL']})
+        self.assertEqual(self.store.tickers(), ['AAPL', 'MSFT'])
+        self.assertEqual(os.listdir(os.path.dirname(self.store.path)), ['prices.parquet'])
+
+    def test_migrate_csv_tree(self) -> None:
+        tree = os.path.join(self.directory, 'original')
+        for stock, frame in self.frames.items():
+            os.makedirs(os.path.join(tree, stock))
+            frame.tz_localize('America/New_York').to_csv(os.path.join(tree, stock, 'stock_data.csv'))
+        os.makedirs(os.path.join(tree, 'EMPTY'))
+        self.assertEqual(migrate_csv_tree(tree, self.store), ['AAPL', 'MSFT'])
+        history = self.store.read_ticker('MSFT')
+        self.assertEqual(history['Adj Close'].tolist(), self.frames['MSFT']['Adj Close'].tolist())
+        self.assertEqual(history['Date'].iloc[0], pd.Timestamp('2020-01-01 05:00'))
+
+
+if __name__ == '__main__':
+    migrated = migrate_csv_tree()
+    print('migrated ' + str(len(migrated)) + ' tickers to ' + PRICE_STORE_PATH)